@@ -156,6 +156,43 @@ LOGGING = {
 }
 
 GITHUB_APP_ID = os.getenv("GITHUB_APP_ID")
+GITHUB_API_URL = os.getenv("GITHUB_API_URL", "https://api.github.com")
+# connections kept alive to the GitHub API per process
+GITHUB_HTTP_POOL_SIZE = int(os.getenv("GITHUB_HTTP_POOL_SIZE", "10"))
+# secret the app's webhook deliveries are signed with, they aren't validated without one
+GITHUB_WEBHOOK_SECRET = os.getenv("GITHUB_WEBHOOK_SECRET")
+# save the check runs of a rule set concurrently through asyncio, needs the "async" extra
+GITHUB_ASYNC_CLIENT = os.getenv("GITHUB_ASYNC_CLIENT", "false").lower() == "true"
+# calls an installation may have in flight at once with the async client
+GITHUB_ASYNC_CONCURRENCY = int(os.getenv("GITHUB_ASYNC_CONCURRENCY", "8"))
+
+# queues repository events are partitioned over, see sleuthpr.partitions, or 0 to process them in any order under
+# a lock instead
+REPOSITORY_PARTITIONS = int(os.getenv("REPOSITORY_PARTITIONS", "0"))
+
+# where repository locks are kept, the cache backend needs a cache shared between the workers, e.g. Redis
+LOCK_BACKEND = os.getenv("LOCK_BACKEND", "sleuthpr.lock.DatabaseLockBackend")
+
+# seconds the events of a pull request are collected for before its rules are evaluated once for all of them
+RULES_DEBOUNCE_WINDOW = float(os.getenv("RULES_DEBOUNCE_WINDOW", "2"))
+
+# queues of the interactive and bulk lanes, see sleuthpr.lanes
+INTERACTIVE_QUEUE = os.getenv("INTERACTIVE_QUEUE", "interactive")
+BULK_QUEUE = os.getenv("BULK_QUEUE", "bulk")
+CELERY_TASK_DEFAULT_QUEUE = INTERACTIVE_QUEUE
+# tasks of an installation running at the same time per lane, the rest wait for a free slot, e.g. repositories
+# being onboarded
+INTERACTIVE_INSTALLATION_CONCURRENCY = int(os.getenv("INTERACTIVE_INSTALLATION_CONCURRENCY", "8"))
+BULK_INSTALLATION_CONCURRENCY = int(os.getenv("BULK_INSTALLATION_CONCURRENCY", "4"))
+
+# seconds between retries of webhook deliveries that failed or were lost, and cleanups of expired ones
+DELIVERY_SWEEP_INTERVAL = float(os.getenv("DELIVERY_SWEEP_INTERVAL", "300"))
+CELERY_BEAT_SCHEDULE = {
+    "sweep-deliveries": {
+        "task": "sleuthpr.services.github.tasks.sweep_deliveries_task",
+        "schedule": DELIVERY_SWEEP_INTERVAL,
+    },
+}
 
 tracer = BasicTracer(scope_manager=TornadoScopeManager())
 tracer.register_required_propagators()
@@ -4,10 +4,10 @@ from typing import Tuple
 from marshmallow import fields
 from marshmallow import Schema
 
-from sleuthpr.models import Action
 from sleuthpr.models import ActionType
 from sleuthpr.models import CheckStatus
 from sleuthpr.models import PullRequest
+from sleuthpr.services.rule_sets import CompiledAction
 
 
 class AddPullRequestLabelActionType(ActionType):
@@ -16,11 +16,11 @@ class AddPullRequestLabelActionType(ActionType):
             "add_pull_request_label", "Add a label to the pull request", AddPullRequestLabelActionSchema()
         )
 
-    def execute(self, action: Action, context: Dict) -> Tuple[CheckStatus, str]:
+    def execute(self, action: CompiledAction, context: Dict) -> Tuple[CheckStatus, str]:
         pull_request: PullRequest = context["pull_request"]
         label_name = action.parameters["value"]
-        action.rule.repository.installation.client.add_label(
-            action.rule.repository.identifier, int(pull_request.remote_id), label_name
+        pull_request.repository.installation.client.add_label(
+            pull_request.repository.identifier, int(pull_request.remote_id), label_name
         )
         return CheckStatus.SUCCESS, "Label {label_name} added"
 
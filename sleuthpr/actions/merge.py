@@ -6,11 +6,11 @@ from marshmallow import fields
 from marshmallow import Schema
 from marshmallow import validate
 
-from sleuthpr.models import Action
 from sleuthpr.models import ActionType
 from sleuthpr.models import CheckStatus
 from sleuthpr.models import MergeMethod
 from sleuthpr.models import PullRequest
+from sleuthpr.services.rule_sets import CompiledAction
 
 
 logger = logging.getLogger(__name__)
@@ -25,13 +25,13 @@ class MergePullRequestActionType(ActionType):
             conditions=["draft=false", "merged=false", "closed=false"],
         )
 
-    def execute(self, action: Action, context: Dict) -> Tuple[CheckStatus, str]:
+    def execute(self, action: CompiledAction, context: Dict) -> Tuple[CheckStatus, str]:
         pull_request: PullRequest = context["pull_request"]
         if pull_request.merged or not pull_request.mergeable:
             logger.info("PR cannot be merged, skipping merge")
             return CheckStatus.FAILURE, "Pull request was not mergeable"
 
-        new_sha = action.rule.repository.installation.client.merge(
+        new_sha = pull_request.repository.installation.client.merge(
             pull_request.repository,
             int(pull_request.remote_id),
             commit_title=action.parameters["commit_title"],
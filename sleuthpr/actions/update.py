@@ -4,10 +4,10 @@ from typing import Tuple
 
 from marshmallow import Schema
 
-from sleuthpr.models import Action
 from sleuthpr.models import ActionType
 from sleuthpr.models import CheckStatus
 from sleuthpr.models import PullRequest
+from sleuthpr.services.rule_sets import CompiledAction
 from sleuthpr.services.scm import OperationException
 
 
@@ -25,13 +25,13 @@ class UpdatePullRequestBaseActionType(ActionType):
             ],
         )
 
-    def execute(self, action: Action, context: Dict) -> Tuple[CheckStatus, str]:
+    def execute(self, action: CompiledAction, context: Dict) -> Tuple[CheckStatus, str]:
         pull_request: PullRequest = context["pull_request"]
         if pull_request.merged:
             logger.info("PR already merged, skipping update")
             return CheckStatus.SUCCESS, "Pull request already up to date, skipping update"
         try:
-            action.rule.repository.installation.client.update_pull_request(
+            pull_request.repository.installation.client.update_pull_request(
                 pull_request.repository,
                 int(pull_request.remote_id),
                 sha=pull_request.source_sha,
@@ -0,0 +1,63 @@
+import time
+from typing import Optional
+
+from django.conf import settings
+
+from sleuthpr import lock
+from sleuthpr.lock import Lease
+
+# Work is split into two lanes with a queue each, so a large installation being onboarded can't delay the reviews,
+# statuses and pushes people are waiting on.  Each queue gets workers of its own, sized for its work, e.g.
+#
+#   celery -A app worker -Q interactive -c 8
+#   celery -A app worker -Q bulk -c 2
+#
+# Within a lane an installation has at most a fixed number of slots, the tasks of an installation that has all of
+# them in use go back to the end of the queue so the other installations get their turn.  Partitioned repository
+# events keep their order instead and wait for a slot on their partition.
+INTERACTIVE = "interactive"
+BULK = "bulk"
+
+BULK_EVENTS = {"installation", "installation_repositories"}
+
+# how long a task waits before trying again when its installation has no free slot in the lane
+RETRY_DELAYS = {INTERACTIVE: 1, BULK: 30}
+# frees the slot of a worker that died
+SLOT_TIMEOUTS = {INTERACTIVE: 10 * 60, BULK: 60 * 60}
+SLOT_POLL_INTERVAL = 0.5
+
+
+def lane_for(event_name: str) -> str:
+    return BULK if event_name in BULK_EVENTS else INTERACTIVE
+
+
+def queue_for(lane: str) -> str:
+    return settings.BULK_QUEUE if lane == BULK else settings.INTERACTIVE_QUEUE
+
+
+def installation_concurrency(lane: str) -> int:
+    return settings.BULK_INSTALLATION_CONCURRENCY if lane == BULK else settings.INTERACTIVE_INSTALLATION_CONCURRENCY
+
+
+# Slots are leases of the lock backend, so they are shared by every worker
+def acquire_slot(lane: str, installation_key: str) -> Optional[Lease]:
+    for index in range(installation_concurrency(lane)):
+        name = f"lane.{lane}.{installation_key}.{index}"
+        token = lock.get_backend().acquire(name, SLOT_TIMEOUTS[lane])
+        if token is not None:
+            return Lease(name=name, token=token, acquired_at=time.time())
+    return None
+
+
+# For work that can't go back to the end of the queue, gives up waiting once a slot of a dead worker would be free
+def wait_for_slot(lane: str, installation_key: str) -> Optional[Lease]:
+    deadline = time.monotonic() + SLOT_TIMEOUTS[lane]
+    slot = acquire_slot(lane, installation_key)
+    while slot is None and time.monotonic() < deadline:
+        time.sleep(SLOT_POLL_INTERVAL)
+        slot = acquire_slot(lane, installation_key)
+    return slot
+
+
+def release_slot(slot: Lease):
+    lock.get_backend().release(slot.name, slot.token)
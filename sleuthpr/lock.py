@@ -1,21 +1,264 @@
+import logging
+import threading
+import time
 from contextlib import contextmanager
-from threading import Lock
+from dataclasses import dataclass
 from typing import Dict
+from typing import Optional
+from typing import Tuple
 
-_locks: Dict[str, Lock] = {}
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.db.models import F
+from django.utils.module_loading import import_string
+from django.utils.text import slugify
 
+from sleuthpr.models import LockLease
 
-# todo: This should be swapped with redlock in prod
+logger = logging.getLogger(__name__)
+
+# how long a lock is held at most, so the lock of a worker that died frees itself
+DEFAULT_LEASE = 10 * 60
+POLL_INTERVAL = 0.1
+
+
+@dataclass(frozen=True)
+class Lease:
+    name: str
+    # increases with every acquisition of the lock, so writes can be checked against the latest holder
+    token: int
+    acquired_at: float
+
+
+class LockBackend:
+    # Takes the lock without waiting, returning its fencing token or None if it is held
+    def acquire(self, name: str, lease: float) -> Optional[int]:
+        pass
+
+    def release(self, name: str, token: int) -> bool:
+        pass
+
+    def is_held(self, name: str, token: int) -> bool:
+        pass
+
+
+# Only locks within the process, for development and single worker setups
+class LocalLockBackend(LockBackend):
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name to the fencing token and expiry of the current lease, dropped on release
+        self._leases: Dict[str, Tuple[int, float]] = {}
+        self._tokens: Dict[str, int] = {}
+
+    def acquire(self, name: str, lease: float) -> Optional[int]:
+        now = time.monotonic()
+        with self._lock:
+            current = self._leases.get(name)
+            if current and current[1] > now:
+                return None
+            token = self._tokens.get(name, 0) + 1
+            self._tokens[name] = token
+            self._leases[name] = (token, now + lease)
+            return token
+
+    def release(self, name: str, token: int) -> bool:
+        with self._lock:
+            current = self._leases.get(name)
+            if not current or current[0] != token:
+                return False
+            del self._leases[name]
+            return True
+
+    def is_held(self, name: str, token: int) -> bool:
+        with self._lock:
+            current = self._leases.get(name)
+            return bool(current and current[0] == token and current[1] > time.monotonic())
+
+
+# Leases kept in a database row per lock, which every worker shares.  The row is deleted on release, so the locks
+# of e.g. every scheduled evaluation don't pile up.
+class DatabaseLockBackend(LockBackend):
+    def acquire(self, name: str, lease: float) -> Optional[int]:
+        now = time.time()
+        # a row created again starts from the clock, so its tokens stay above those of the deleted row
+        LockLease.objects.get_or_create(name=name, defaults=dict(token=int(now * 1000000)))
+        with transaction.atomic():
+            taken = LockLease.objects.filter(name=name, expires_at__lte=now).update(
+                token=F("token") + 1, expires_at=now + lease
+            )
+            if not taken:
+                return None
+            return LockLease.objects.filter(name=name).values_list("token", flat=True).get()
+
+    def release(self, name: str, token: int) -> bool:
+        # a lease that expired may have been taken over, which mustn't be released by the old holder
+        deleted, _ = LockLease.objects.filter(name=name, token=token, expires_at__gt=time.time()).delete()
+        return bool(deleted)
+
+    def is_held(self, name: str, token: int) -> bool:
+        return LockLease.objects.filter(name=name, token=token, expires_at__gt=time.time()).exists()
+
+
+# Leases kept in the Django cache, which needs a Redis cache shared between the workers
+class CacheLockBackend(LockBackend):
+    def __init__(self):
+        self._client = _redis_client(caches["default"])
+        if self._client is None:
+            raise ImproperlyConfigured(
+                "The cache lock backend needs a Redis cache shared between the workers, configure one in CACHES or "
+                "use sleuthpr.lock.DatabaseLockBackend"
+            )
+
+    def acquire(self, name: str, lease: float) -> Optional[int]:
+        fence_key = f"lock.{name}.fence"
+        cache.add(fence_key, 0, timeout=None)
+        token = cache.incr(fence_key)
+        if cache.add(f"lock.{name}", token, timeout=lease):
+            return token
+        return None
+
+    def release(self, name: str, token: int) -> bool:
+        # a lease that expired may have been taken over, which mustn't be released by the old holder, so the token
+        # is compared and the lease deleted in one step
+        return bool(self._client.eval(_RELEASE_SCRIPT, 1, cache.make_key(f"lock.{name}"), token))
+
+    def is_held(self, name: str, token: int) -> bool:
+        return cache.get(f"lock.{name}") == token
+
+
+_RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+# The Redis client of django-redis' cache or of Django's own Redis cache, None for other caches
+def _redis_client(backend):
+    for attribute in ("client", "_cache"):
+        client = getattr(backend, attribute, None)
+        if hasattr(client, "get_client"):
+            return client.get_client(write=True)
+    return None
+
+
+# Removes the rows of leases that ran out without being released, e.g. as their worker died
+def delete_expired_leases() -> int:
+    deleted, _ = LockLease.objects.filter(expires_at__lte=time.time()).delete()
+    return deleted
+
+
+_backend: Optional[LockBackend] = None
+_backend_lock = threading.Lock()
+# the leases taken with with_lock by the current thread
+_held = threading.local()
+
+
+def get_backend() -> LockBackend:
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = import_string(settings.LOCK_BACKEND)()
+    return _backend
+
+
+def reset_backend():
+    global _backend
+    with _backend_lock:
+        _backend = None
+
+
+def try_acquire(name: str, lease: float = DEFAULT_LEASE, requested_at: Optional[float] = None) -> Optional[Lease]:
+    token = get_backend().acquire(name, lease)
+    if token is None:
+        _record(name, busy=1)
+        return None
+
+    now = time.time()
+    waited = now - requested_at if requested_at is not None else 0
+    _record(name, acquired=1, wait_ms=int(waited * 1000))
+    return Lease(name=name, token=token, acquired_at=now)
+
+
+def release(lease: Lease):
+    held = time.time() - lease.acquired_at
+    _record(lease.name, hold_ms=int(held * 1000))
+    if not get_backend().release(lease.name, lease.token):
+        logger.warning(f"Lock {lease.name} was held for {held:.1f}s, past its lease, and may have been taken over")
+
+
+def is_held(lease: Lease) -> bool:
+    return get_backend().is_held(lease.name, lease.token)
+
+
+def repository_lock_name(installation_key: str, repository_full_name: str) -> str:
+    return f"{installation_key}:{slugify(repository_full_name)}"
+
+
+# Holds the lock for the block, waiting up to timeout seconds for it.  A timeout of 0 doesn't wait at all, so a
+# task can be retried later instead of blocking its worker.  The thread holding the lock may take it again, e.g. for
+# a task run eagerly from within the locked one.
 @contextmanager
-def with_lock(name: str, timeout=1000):
-    lock = _locks.get(name)
-    if lock is None:
-        lock = Lock()
-        _locks[name] = lock
-    if lock.acquire(timeout=timeout):
-        try:
-            yield
-        finally:
-            lock.release()
-    else:
+def with_lock(name: str, timeout: float = 0, lease: float = DEFAULT_LEASE, requested_at: Optional[float] = None):
+    held: Dict[str, Lease] = _held.__dict__.setdefault("leases", {})
+    if name in held:
+        yield held[name]
+        return
+
+    requested_at = requested_at if requested_at is not None else time.time()
+    deadline = time.monotonic() + timeout
+    acquired = try_acquire(name, lease, requested_at)
+    while acquired is None and time.monotonic() < deadline:
+        time.sleep(POLL_INTERVAL)
+        acquired = try_acquire(name, lease, requested_at)
+    if acquired is None:
         raise TimeoutError()
+
+    held[name] = acquired
+    try:
+        yield acquired
+    finally:
+        del held[name]
+        release(acquired)
+
+
+@dataclass
+class LockStats:
+    acquired: int = 0
+    # attempts that found the lock held
+    busy: int = 0
+    wait_ms: int = 0
+    hold_ms: int = 0
+
+    @property
+    def average_wait(self) -> float:
+        return self.wait_ms / self.acquired / 1000 if self.acquired else 0.0
+
+    @property
+    def average_hold(self) -> float:
+        return self.hold_ms / self.acquired / 1000 if self.acquired else 0.0
+
+
+_STATS_FIELDS = ("acquired", "busy", "wait_ms", "hold_ms")
+
+
+def lock_stats(name: str) -> LockStats:
+    values = cache.get_many([_stats_key(name, field) for field in _STATS_FIELDS])
+    return LockStats(**{field: values.get(_stats_key(name, field), 0) for field in _STATS_FIELDS})
+
+
+# counted in the cache, so the stats of a lock cover every worker
+def _record(name: str, **counts: int):
+    for field, value in counts.items():
+        key = _stats_key(name, field)
+        cache.add(key, 0, timeout=None)
+        cache.incr(key, value)
+
+
+def _stats_key(name: str, field: str) -> str:
+    return f"lock.stats.{name}.{field}"
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.14 on 2026-10-17 19:47
+from django.db import migrations
+from django.db import models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("sleuthpr", "0017_auto_20201026_2137"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="trigger",
+            name="type",
+            field=models.CharField(db_index=True, max_length=255),
+        ),
+    ]
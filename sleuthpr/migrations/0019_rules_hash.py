@@ -0,0 +1,23 @@
+# Generated by Django 3.1.14 on 2026-10-17 19:48
+from django.db import migrations
+from django.db import models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("sleuthpr", "0018_trigger_type_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="repository",
+            name="rules_hash",
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name="rule",
+            name="fingerprint",
+            field=models.CharField(blank=True, db_index=True, default="", max_length=64),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.1.14 on 2026-10-17 20:22
+from django.db import migrations
+from django.db import models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("sleuthpr", "0019_rules_hash"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="installation",
+            name="onboarding_completed",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="installation",
+            name="onboarding_failed",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="installation",
+            name="onboarding_total",
+            field=models.IntegerField(default=0),
+        ),
+    ]
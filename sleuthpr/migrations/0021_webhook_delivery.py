@@ -0,0 +1,29 @@
+# Generated by Django 3.1.14 on 2026-10-17 20:23
+import django.utils.timezone
+from django.db import migrations
+from django.db import models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("sleuthpr", "0020_installation_onboarding"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="WebhookDelivery",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("delivery_id", models.CharField(max_length=255, unique=True, verbose_name="delivery id")),
+                ("event_name", models.CharField(max_length=255, verbose_name="event name")),
+                ("payload", models.BinaryField(verbose_name="payload")),
+                (
+                    "on",
+                    models.DateTimeField(
+                        db_index=True, default=django.utils.timezone.now, verbose_name="received on"
+                    ),
+                ),
+            ],
+        ),
+    ]
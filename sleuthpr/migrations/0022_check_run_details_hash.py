@@ -0,0 +1,18 @@
+# Generated by Django 3.1.14 on 2026-10-17 20:25
+from django.db import migrations
+from django.db import models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("sleuthpr", "0021_webhook_delivery"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="rulecheckrun",
+            name="details_hash",
+            field=models.CharField(blank=True, default="", max_length=64),
+        ),
+    ]
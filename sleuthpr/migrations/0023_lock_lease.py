@@ -0,0 +1,22 @@
+# Generated by Django 3.1.14 on 2026-10-17 20:45
+from django.db import migrations
+from django.db import models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("sleuthpr", "0022_check_run_details_hash"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LockLease",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("name", models.CharField(max_length=255, unique=True, verbose_name="name")),
+                ("token", models.BigIntegerField(default=0, verbose_name="token")),
+                ("expires_at", models.FloatField(default=0, verbose_name="expires at")),
+            ],
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.1.14 on 2026-10-17 20:47
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations
+from django.db import models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("sleuthpr", "0023_lock_lease"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PendingEvaluation",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("trigger_type", models.CharField(max_length=255, verbose_name="trigger type")),
+                ("on", models.DateTimeField(default=django.utils.timezone.now, verbose_name="created on")),
+                (
+                    "pull_request",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="pending_evaluations",
+                        to="sleuthpr.pullrequest",
+                        verbose_name="pull request",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("pull_request", "trigger_type")},
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.1.14 on 2026-10-17 20:51
+from django.db import migrations
+from django.db import models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("sleuthpr", "0024_pending_evaluation"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RateLimitState",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("installation_key", models.CharField(max_length=255, unique=True, verbose_name="installation key")),
+                ("limit", models.IntegerField(verbose_name="limit")),
+                ("remaining", models.IntegerField(verbose_name="remaining")),
+                ("reset_at", models.FloatField(null=True, verbose_name="reset at")),
+                ("blocked_until", models.FloatField(default=0, verbose_name="blocked until")),
+            ],
+        ),
+    ]
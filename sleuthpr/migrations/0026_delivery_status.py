@@ -0,0 +1,40 @@
+# Generated by Django 3.1.14 on 2026-10-17 20:56
+import django.utils.timezone
+from django.db import migrations
+from django.db import models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("sleuthpr", "0025_rate_limit_state"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="webhookdelivery",
+            name="attempts",
+            field=models.IntegerField(default=0, verbose_name="attempts"),
+        ),
+        migrations.AddField(
+            model_name="webhookdelivery",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("pending", "Pending"),
+                    ("processing", "Processing"),
+                    ("processed", "Processed"),
+                    ("failed", "Failed"),
+                ],
+                db_index=True,
+                default="pending",
+                max_length=50,
+                verbose_name="status",
+            ),
+        ),
+        migrations.AddField(
+            model_name="webhookdelivery",
+            name="updated_on",
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name="updated on"),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.14 on 2026-10-17 20:57
+from django.db import migrations
+from django.db import models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("sleuthpr", "0026_delivery_status"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="pendingevaluation",
+            name="replayed",
+            field=models.BooleanField(default=False, verbose_name="replayed"),
+        ),
+    ]
@@ -8,11 +8,13 @@ from typing import List
 from typing import Optional
 from typing import Tuple
 from typing import Type
+from typing import TYPE_CHECKING
 
 from django.db import models
 from django.db.models import CASCADE
 from django.db.models import SET_NULL
 from django.db.models import TextChoices
+from django.utils.functional import cached_property
 from django.utils.timezone import now
 from django.utils.translation import gettext_lazy as _
 from marshmallow import Schema
@@ -20,6 +22,9 @@ from marshmallow import Schema
 from sleuthpr.services import scm
 from sleuthpr.services.scm import InstallationClient
 
+if TYPE_CHECKING:
+    from sleuthpr.services.rule_sets import CompiledAction
+
 
 # pylint: disable=W0622
 
@@ -50,6 +55,13 @@ class CheckStatus(TextChoices):
     ERROR = ("error", "Error")
 
 
+class DeliveryStatus(TextChoices):
+    PENDING = ("pending", "Pending")
+    PROCESSING = ("processing", "Processing")
+    PROCESSED = ("processed", "Processed")
+    FAILED = ("failed", "Failed")
+
+
 class TriState(TextChoices):
     TRUE = ("true", "True")
     FALSE = ("false", "False")
@@ -93,10 +105,19 @@ class Installation(models.Model):
     provider = models.CharField(max_length=50, choices=Provider.choices)
     active = models.BooleanField(default=True)
 
-    @property
+    # progress of onboarding the installation's repositories, counted across every round of added repositories
+    onboarding_total = models.IntegerField(default=0)
+    onboarding_completed = models.IntegerField(default=0)
+    onboarding_failed = models.IntegerField(default=0)
+
+    @cached_property
     def client(self) -> InstallationClient:
         return scm.get_client(self)
 
+    @property
+    def onboarded(self) -> bool:
+        return self.onboarding_completed + self.onboarding_failed >= self.onboarding_total
+
 
 class Repository(models.Model):
     installation = models.ForeignKey(
@@ -107,6 +128,8 @@ class Repository(models.Model):
     )
     full_name = models.CharField(max_length=255)
     remote_id = models.CharField(max_length=512, db_index=True, null=True)
+    # hash of the last loaded rules document
+    rules_hash = models.CharField(max_length=64, blank=True, null=True)
 
     @property
     def identifier(self):
@@ -341,6 +364,8 @@ class Rule(models.Model):
         verbose_name=_("repository"),
     )
     order = models.IntegerField()
+    # hash of the rule's source in the rules document
+    fingerprint = models.CharField(max_length=64, blank=True, default="", db_index=True)
 
     @property
     def ordered_conditions(self):
@@ -370,7 +395,7 @@ class ActionType:
     def __eq__(self, o: Trigger) -> bool:
         return o.key == self.key
 
-    def execute(self, action: Action, context: Dict) -> Tuple[CheckStatus, str]:
+    def execute(self, action: CompiledAction, context: Dict) -> Tuple[CheckStatus, str]:
         pass
 
 
@@ -383,12 +408,15 @@ class ConditionVariableType:
         type: Type,
         default_triggers: List[TriggerType],
         evaluate: Optional[Callable[[Dict], Any]] = None,
+        prefetch: Optional[List[str]] = None,
     ):
         self.key = key
         self.label = label
         self.type = type
         self.default_triggers = default_triggers
         self._evaluate = evaluate
+        # pull request relations the evaluation reads, loaded up front via prefetch_related
+        self.prefetch = prefetch if prefetch is not None else []
 
     def __call__(self, context: Dict):
         if self._evaluate:
@@ -402,7 +430,7 @@ class Trigger(models.Model):
         related_name="triggers",
         verbose_name=_("installation"),
     )
-    type = models.CharField(max_length=255)
+    type = models.CharField(max_length=255, db_index=True)
     description = models.TextField(max_length=16384, blank=True, default="", verbose_name=_("description"))
     line_number = models.IntegerField(default=-1)
 
@@ -441,6 +469,8 @@ class RuleCheckRun(models.Model):
     status = models.CharField(max_length=50, db_index=True, choices=CheckStatus.choices)
 
     remote_id = models.CharField(max_length=512, db_index=True)
+    # hash of what was last sent for the check run
+    details_hash = models.CharField(max_length=64, blank=True, default="")
 
 
 class Action(models.Model):
@@ -478,3 +508,60 @@ class ActionResult(models.Model):
     status = models.CharField(max_length=50, db_index=True, choices=CheckStatus.choices)
     message = models.TextField(max_length=16384, blank=True, verbose_name=_("message"))
     on = models.DateTimeField(default=now, verbose_name=_("created on"), db_index=True)
+
+
+# A webhook delivery, see sleuthpr.services.github.deliveries.  The raw body is kept until the event is processed so
+# only its id goes through the broker, the row until GitHub can no longer redeliver it.
+class WebhookDelivery(models.Model):
+    delivery_id = models.CharField(max_length=255, unique=True, verbose_name=_("delivery id"))
+    event_name = models.CharField(max_length=255, verbose_name=_("event name"))
+    payload = models.BinaryField(verbose_name=_("payload"))
+    on = models.DateTimeField(default=now, verbose_name=_("received on"), db_index=True)
+    status = models.CharField(
+        max_length=50,
+        db_index=True,
+        choices=DeliveryStatus.choices,
+        default=DeliveryStatus.PENDING,
+        verbose_name=_("status"),
+    )
+    attempts = models.IntegerField(default=0, verbose_name=_("attempts"))
+    updated_on = models.DateTimeField(default=now, verbose_name=_("updated on"), db_index=True)
+
+
+# The lease on a named lock, for the database lock backend
+class LockLease(models.Model):
+    name = models.CharField(max_length=255, unique=True, verbose_name=_("name"))
+    # fencing token, increases with every acquisition
+    token = models.BigIntegerField(default=0, verbose_name=_("token"))
+    # unix time the lease runs out at
+    expires_at = models.FloatField(default=0, verbose_name=_("expires at"))
+
+
+# A trigger that fired for a pull request whose rules are evaluated once the debounce window is over
+class PendingEvaluation(models.Model):
+    class Meta:
+        unique_together = (
+            "pull_request",
+            "trigger_type",
+        )
+
+    pull_request = models.ForeignKey(
+        PullRequest,
+        on_delete=CASCADE,
+        related_name="pending_evaluations",
+        verbose_name=_("pull request"),
+    )
+    trigger_type = models.CharField(max_length=255, verbose_name=_("trigger type"))
+    # only fired by events processed again, see sleuthpr.services.rules.replaying
+    replayed = models.BooleanField(default=False, verbose_name=_("replayed"))
+    on = models.DateTimeField(default=now, verbose_name=_("created on"))
+
+
+# An installation's GitHub quota as last seen by any worker, see sleuthpr.services.github.rate_limit
+class RateLimitState(models.Model):
+    installation_key = models.CharField(max_length=255, unique=True, verbose_name=_("installation key"))
+    limit = models.IntegerField(verbose_name=_("limit"))
+    remaining = models.IntegerField(verbose_name=_("remaining"))
+    # unix times
+    reset_at = models.FloatField(null=True, verbose_name=_("reset at"))
+    blocked_until = models.FloatField(default=0, verbose_name=_("blocked until"))
@@ -0,0 +1,52 @@
+import hashlib
+import logging
+import time
+from typing import Callable
+from typing import List
+
+from django.conf import settings
+
+from sleuthpr import lanes
+from sleuthpr.services.scm import TransientOperationException
+
+logger = logging.getLogger(__name__)
+
+# Repository events are spread over REPOSITORY_PARTITIONS queues of the interactive lane by the hash of the
+# repository.  Every partition queue is meant to be consumed by a single worker process with a concurrency of 1, so
+# the events of a repository are processed one after the other in the order they arrived, while different
+# repositories scale out across the partitions, e.g.
+#
+#   celery -A app worker -Q interactive-repository-0 -c 1
+
+_sleep = time.sleep
+
+
+def partition_for(key: str) -> int:
+    # python's hash() differs between processes, the partition must not
+    digest = hashlib.sha1(key.encode("utf8")).digest()
+    return int.from_bytes(digest[:8], "big") % settings.REPOSITORY_PARTITIONS
+
+
+def queue_name(partition: int) -> str:
+    return f"{lanes.queue_for(lanes.INTERACTIVE)}-repository-{partition}"
+
+
+def queue_names() -> List[str]:
+    return [queue_name(partition) for partition in range(settings.REPOSITORY_PARTITIONS)]
+
+
+# Runs a task of a partition with a slot of its installation.  A transient failure is waited out in place with the
+# slot given back meanwhile, as retrying the task would queue it behind the repository's later events.
+def run_in_order(lane: str, installation_key: str, description: str, run: Callable[[], None]):
+    while True:
+        slot = lanes.wait_for_slot(lane, installation_key)
+        try:
+            run()
+            return
+        except TransientOperationException as e:
+            delay = e.delay
+            logger.info(f"Holding the partition of {description} for {delay:.0f}s: {e}")
+        finally:
+            if slot:
+                lanes.release_slot(slot)
+        _sleep(delay)
@@ -1,6 +1,9 @@
+import hashlib
 import logging
 from typing import Dict
+from typing import List
 from typing import Optional
+from typing import Tuple
 
 from django.utils.text import slugify
 
@@ -11,12 +14,13 @@ from sleuthpr.models import ConditionVariableType
 from sleuthpr.models import Installation
 from sleuthpr.models import PullRequest
 from sleuthpr.models import Repository
-from sleuthpr.models import Rule
 from sleuthpr.models import RuleCheckRun
 from sleuthpr.services import rules
-from sleuthpr.services.expression import ParsedExpression
+from sleuthpr.services.expression import EvaluationContext
+from sleuthpr.services.rule_sets import CompiledRule
 from sleuthpr.services.rules import EvaluatedRule
 from sleuthpr.services.scm import CheckDetails
+from sleuthpr.services.scm import CheckUpdate
 
 logger = logging.getLogger(__name__)
 
@@ -27,63 +31,138 @@ def clear_checks(pull_request: PullRequest):
 
 
 def update_checks(installation: Installation, repository: Repository, pull_request: PullRequest):
-    for rule in rules.evaluate_rules_no_execute(repository, {"pull_request": pull_request}):
-        update_checks_for_rule(installation, repository, pull_request, rule)
+    ctx = EvaluationContext(pull_request=pull_request)
+    evaluated_rules = rules.evaluate_rules_no_execute(repository, ctx)
+
+    existing_checks = _get_existing_checks(pull_request)
+    changed: List[Tuple[EvaluatedRule, CheckUpdate]] = []
+    for evaluated_rule in evaluated_rules:
+        update = _make_update(ctx, repository, pull_request, evaluated_rule, existing_checks)
+        if not _is_unchanged(update, existing_checks.get(evaluated_rule.id)):
+            changed.append((evaluated_rule, update))
+
+    # the client is free to make the calls for all rules at once
+    check_ids = installation.client.save_checks(repository.identifier, [update for _, update in changed])
+    for (evaluated_rule, update), check_id in zip(changed, check_ids):
+        _record_check(pull_request, evaluated_rule, update, check_id, existing_checks.get(evaluated_rule.id))
+
+    if ctx.timings:
+        logger.info(f"Computed variables for checks: {ctx.report()}")
 
 
 def update_checks_for_rule(
-    installation: Installation, repository: Repository, pull_request: PullRequest, evaluated_rule: EvaluatedRule
+    installation: Installation,
+    repository: Repository,
+    pull_request: PullRequest,
+    evaluated_rule: EvaluatedRule,
+    context: Optional[EvaluationContext] = None,
 ):
-    ctx = {"pull_request": pull_request}
+    ctx = context if context is not None else EvaluationContext(pull_request=pull_request)
 
-    existing_checks: Dict = {run.rule.id: run for run in RuleCheckRun.objects.filter(pull_request=pull_request).all()}
+    existing_checks = _get_existing_checks(pull_request)
+    existing = existing_checks.get(evaluated_rule.id)
+    update = _make_update(ctx, repository, pull_request, evaluated_rule, existing_checks)
+    if _is_unchanged(update, existing):
+        return
 
-    logger.info(f"Updating pr {pull_request.remote_id} for rule {evaluated_rule.id} to {evaluated_rule.evaluation}")
-    if not existing_checks.get(evaluated_rule.id):
-        logger.info(f"No existing check for rule {evaluated_rule.id} found, creating a new one")
+    if update.remote_check_id:
+        check_id = update.remote_check_id
+        installation.client.update_check(
+            repository.identifier,
+            update.key,
+            update.source_sha,
+            details=update.details,
+            remote_check_id=update.remote_check_id,
+        )
+    else:
         check_id = installation.client.add_check(
             repository.identifier,
-            _make_key(evaluated_rule.rule),
-            pull_request.source_sha,
-            details=_make_details(ctx, evaluated_rule),
+            update.key,
+            update.source_sha,
+            details=update.details,
         )
+    _record_check(pull_request, evaluated_rule, update, check_id, existing)
+
+
+def _get_existing_checks(pull_request: PullRequest) -> Dict[int, RuleCheckRun]:
+    return {run.rule_id: run for run in RuleCheckRun.objects.filter(pull_request=pull_request).all()}
+
+
+def _make_update(
+    ctx: EvaluationContext,
+    repository: Repository,
+    pull_request: PullRequest,
+    evaluated_rule: EvaluatedRule,
+    existing_checks: Dict[int, RuleCheckRun],
+) -> CheckUpdate:
+    logger.info(f"Updating pr {pull_request.remote_id} for rule {evaluated_rule.id} to {evaluated_rule.evaluation}")
+    existing = existing_checks.get(evaluated_rule.id)
+    if existing:
+        logger.info(f"Check exists for rule {evaluated_rule.id}, updating")
+    else:
+        logger.info(f"No existing check for rule {evaluated_rule.id} found, creating a new one")
+    return CheckUpdate(
+        key=_make_key(evaluated_rule.rule),
+        source_sha=pull_request.source_sha,
+        details=_make_details(ctx, repository, evaluated_rule),
+        remote_check_id=existing.remote_id if existing else None,
+    )
+
+
+# Replayed events render the same check run again, which doesn't need to be sent to the provider
+def _is_unchanged(update: CheckUpdate, existing: Optional[RuleCheckRun]) -> bool:
+    if existing and existing.details_hash == _details_hash(update):
+        logger.info(f"Check {update.key} on {update.source_sha} is unchanged, skipping")
+        return True
+    return False
+
+
+def _details_hash(update: CheckUpdate) -> str:
+    details = update.details
+    content = "\n".join([update.key, update.source_sha, details.status, details.title, details.summary, details.body])
+    return hashlib.sha256(content.encode("utf8")).hexdigest()
+
+
+def _record_check(
+    pull_request: PullRequest,
+    evaluated_rule: EvaluatedRule,
+    update: CheckUpdate,
+    check_id: str,
+    existing: Optional[RuleCheckRun],
+):
+    if existing:
+        existing.status = evaluated_rule.evaluation
+        existing.details_hash = _details_hash(update)
+        existing.save(update_fields=["status", "details_hash"])
+    else:
         RuleCheckRun.objects.create(
-            rule=evaluated_rule.rule,
+            rule_id=evaluated_rule.id,
             status=evaluated_rule.evaluation,
             remote_id=check_id,
             pull_request=pull_request,
-        )
-    else:
-        logger.info(f"Check exists for rule {evaluated_rule.id}, updating")
-        installation.client.update_check(
-            repository.identifier,
-            _make_key(evaluated_rule.rule),
-            pull_request.source_sha,
-            details=_make_details(ctx, evaluated_rule),
-            remote_check_id=existing_checks[evaluated_rule.id].remote_id,
+            details_hash=_details_hash(update),
         )
 
 
-def _make_key(rule: Rule):
+def _make_key(rule: CompiledRule):
     return f"{slugify(rule.title)}"
 
 
-def _make_details(ctx: Dict, rule: EvaluatedRule):
+def _make_details(ctx: EvaluationContext, repository: Repository, rule: EvaluatedRule):
     summary = ""
     var_types: Dict[str, ConditionVariableType] = {}
     for cond in rule.conditions:
         emoji = ":heavy_check_mark:" if cond.evaluation else ":heavy_multiplication_x:"
         summary += f"{emoji} `{cond.condition.expression}`\n"
-        for var in ParsedExpression(cond.condition.expression).variables:
+        for var in cond.condition.parsed.variables:
             var_types[var.key] = var
 
     body = "**Triggers**\n"
-    triggers = list(rule.rule.triggers.all())
-    for trigger in triggers:
+    for trigger in rule.rule.triggers:
         trigger_type = registry.get_trigger_type(trigger.type)
         desc = f" -- {trigger.description}" if trigger.description else ""
         body += f"* {trigger_type.label} (`{trigger.type}`){desc}\n"
-    if not triggers:
+    if not rule.rule.triggers:
         body += "\nNone\n"
     body += "\n"
     body += "**Conditions**\n"
@@ -95,7 +174,7 @@ def _make_details(ctx: Dict, rule: EvaluatedRule):
     body += "\n"
     body += "**Variable values**\n"
     for var in var_types.values():
-        value = var(ctx)
+        value = ctx.resolve(var)
         if isinstance(value, list):
             value = ", ".join(value)
         body += f"* {var.label} (`{var.key}`) = `{value}`\n"
@@ -104,11 +183,10 @@ def _make_details(ctx: Dict, rule: EvaluatedRule):
     body += "\n"
     body += "**Actions when successful**\n"
 
-    head = ctx["pull_request"].source_commit
-    for action in rule.rule.ordered_actions:
+    for action in rule.rule.actions:
         action_type = registry.get_action_type(action.type)
         desc = f" -- {action.description}" if action.description else ""
-        result: Optional[ActionResult] = action.results.filter(commit=head).first()
+        result: Optional[ActionResult] = rule.recorded_results.get(action.id)
         if result:
             result_status = CheckStatus(result.status)
             if result_status == CheckStatus.SUCCESS:
@@ -122,7 +200,7 @@ def _make_details(ctx: Dict, rule: EvaluatedRule):
         body += f"* {emoji} {action_type.label} (`{action.type}`){desc}{result_desc}\n"
     body += "\n(see the pull request history for results)\n"
 
-    body += f"\n[Rule source]({rule.rule.repository.source_url('.sleuth/rules.yml')})"
+    body += f"\n[Rule source]({repository.source_url('.sleuth/rules.yml')})"
 
     return CheckDetails(
         title=rule.rule.description,
@@ -1,7 +1,10 @@
+from functools import lru_cache
+from time import perf_counter
 from typing import Any
 from typing import Callable
 from typing import Dict
 from typing import List
+from typing import Tuple
 
 import pyparsing as pp
 
@@ -11,22 +14,69 @@ from sleuthpr.models import TriState
 from sleuthpr.services.operators import OPERATORS
 
 
+# Number of distinct expression strings kept parsed in memory per process
+EXPRESSION_CACHE_SIZE = 1024
+
+
 class ParsedExpression:
     def __init__(self, text: str):
-        self.expression = expr.parseString(text)[0]
-
-        self.variables: List[ConditionVariableType] = []
+        self.expression, self.compiled, variables = _parse(text.strip())
+        self.variables: List[ConditionVariableType] = list(variables)
 
-        def collect_vars(token):
-            if isinstance(token, Identifier):
-                self.variables.append(registry.get_condition_variable_type(token.name))
+    def execute(self, **context):
+        return self.compiled(context)
 
-        self.expression.visit(collect_vars)
+    def evaluate(self, context: Dict):
+        return self.compiled(context)
 
-    def execute(self, **context):
+    def interpret(self, **context):
         return self.expression.eval(context)
 
 
+# parsed trees are never mutated, so they are shared between every ParsedExpression built from the same text
+@lru_cache(maxsize=EXPRESSION_CACHE_SIZE)
+def _parse(text: str) -> Tuple[Any, Callable[[Dict], Any], Tuple[ConditionVariableType, ...]]:
+    expression = expr.parseString(text)[0]
+
+    variables: List[ConditionVariableType] = []
+
+    def collect_vars(token):
+        if isinstance(token, Identifier):
+            variables.append(registry.get_condition_variable_type(token.name))
+
+    expression.visit(collect_vars)
+    return expression, expression.compile(), tuple(variables)
+
+
+# Context for evaluating all the rules for a single pull request event, computing each variable at most once
+class EvaluationContext(dict):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[str, Any] = {}
+        self.timings: Dict[str, float] = {}
+
+    def resolve(self, variable: ConditionVariableType) -> Any:
+        if variable.key in self.values:
+            return self.values[variable.key]
+
+        start = perf_counter()
+        value = variable(self)
+        self.timings[variable.key] = perf_counter() - start
+        self.values[variable.key] = value
+        return value
+
+    def report(self) -> str:
+        return ", ".join(f"{key}={duration * 1000:.1f}ms" for key, duration in self.timings.items())
+
+
+def cache_info():
+    return _parse.cache_info()
+
+
+def clear_cache():
+    _parse.cache_clear()
+
+
 class Expression:
     def __init__(self, tokens):
         self.and_conditions = tokens[::2]
@@ -42,6 +92,19 @@ class Expression:
 
         return False
 
+    def compile(self) -> Callable[[Dict], Any]:
+        and_conditions = tuple(cond.compile() for cond in self.and_conditions)
+        if len(and_conditions) == 1:
+            return and_conditions[0]
+
+        def evaluate(context: Dict):
+            for cond in and_conditions:
+                if cond(context):
+                    return True
+            return False
+
+        return evaluate
+
     def visit(self, visitor: Callable[[Any], None]):
         visitor(self)
         for cond in self.and_conditions:
@@ -66,6 +129,19 @@ class AndCondition:
 
         return True
 
+    def compile(self) -> Callable[[Dict], Any]:
+        conditions = tuple(cond.compile() for cond in self.conditions)
+        if len(conditions) == 1:
+            return conditions[0]
+
+        def evaluate(context: Dict):
+            for cond in conditions:
+                if not cond(context):
+                    return False
+            return True
+
+        return evaluate
+
     def visit(self, visitor: Callable[[Any], None]):
         visitor(self)
         for cond in self.conditions:
@@ -93,6 +169,20 @@ class Condition:
             return result.evaluate(leval, reval)
         raise ValueError()
 
+    def compile(self) -> Callable[[Dict], Any]:
+        operator = OPERATORS.get(self.op)
+        if not operator:
+            raise ValueError()
+        compare = operator.evaluate
+        lval = self.identifier.compile()
+
+        if isinstance(self.rval, Identifier):
+            rval = self.rval.compile()
+            return lambda context: compare(lval(context), rval(context))
+
+        value = self.rval.eval({})
+        return lambda context: compare(lval(context), value)
+
     def visit(self, visitor: Callable[[Any], None]):
         visitor(self)
         self.identifier.visit(visitor)
@@ -110,6 +200,10 @@ class String:
     def eval(self, _: Dict):
         return self.value
 
+    def compile(self) -> Callable[[Dict], Any]:
+        value = self.value
+        return lambda _: value
+
     def visit(self, visitor: Callable[[Any], None]):
         visitor(self)
         visitor(self.value)
@@ -125,6 +219,10 @@ class Number:
     def eval(self, _: Dict):
         return int(self.value)
 
+    def compile(self) -> Callable[[Dict], Any]:
+        value = int(self.value)
+        return lambda _: value
+
     def visit(self, visitor: Callable[[Any], None]):
         visitor(self)
         visitor(self.value)
@@ -139,7 +237,7 @@ class Identifier:
         return self.name
 
     def eval(self, context: Dict):
-        result = self.variable(context)
+        result = _resolve(self.variable, context)
         if isinstance(result, TriState):
             if result == TriState.UNKNOWN:
                 return False
@@ -147,11 +245,29 @@ class Identifier:
                 return result == TriState.TRUE
         return result
 
+    def compile(self) -> Callable[[Dict], Any]:
+        variable = self.variable
+
+        def evaluate(context: Dict):
+            result = _resolve(variable, context)
+            if isinstance(result, TriState):
+                # unknown is treated as false
+                return result == TriState.TRUE
+            return result
+
+        return evaluate
+
     def visit(self, visitor: Callable[[Any], None]):
         visitor(self)
         visitor(self.name)
 
 
+def _resolve(variable: ConditionVariableType, context: Dict) -> Any:
+    if isinstance(context, EvaluationContext):
+        return context.resolve(variable)
+    return variable(context)
+
+
 class Boolean:
     def __init__(self, result):
         self.value = result[0].lower() == "true"
@@ -162,6 +278,10 @@ class Boolean:
     def eval(self, _: Dict):
         return self.value
 
+    def compile(self) -> Callable[[Dict], Any]:
+        value = self.value
+        return lambda _: value
+
     def visit(self, visitor: Callable[[Any], None]):
         visitor(self)
         visitor(self.value)
@@ -14,9 +14,12 @@ def get_or_create(
     remote_id: Optional[str] = None,
 ):
 
-    existing_user = ExternalUser.objects.filter(
-        Q(installation=installation) & (Q(username=username) | Q(remote_id=remote_id) | Q(email=email))
-    ).first()
+    # only match on the identifiers we have, users without an email would otherwise all match each other
+    lookup = Q()
+    for key, value in (("username", username), ("remote_id", remote_id), ("email", email)):
+        if value:
+            lookup |= Q(**{key: value})
+    existing_user = ExternalUser.objects.filter(Q(installation=installation) & lookup).first() if lookup else None
     if not existing_user:
         return ExternalUser.objects.create(
             installation=installation,
@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import threading
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import TypeVar
+
+from django.conf import settings
+
+from sleuthpr.models import RepositoryIdentifier
+from sleuthpr.services.github import rate_limit
+from sleuthpr.services.github.rate_limit import Priority
+from sleuthpr.services.github.rate_limit import RateLimiter
+from sleuthpr.services.github.rate_limit import RateLimitExceeded
+from sleuthpr.services.github.scm import GitHubActionInstallationClient
+from sleuthpr.services.github.scm import GitHubInstallationClient
+from sleuthpr.services.scm import CheckDetails
+from sleuthpr.services.scm import CheckUpdate
+from sleuthpr.services.scm import OperationException
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+REQUEST_TIMEOUT = 15.0
+
+
+class _SharedLoop:
+    def __init__(self):
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.lock = threading.Lock()
+        # only used from the loop's thread
+        self.http: Optional["httpx.AsyncClient"] = None
+        self.semaphores: Dict[str, asyncio.Semaphore] = {}
+
+
+_shared = _SharedLoop()
+
+
+# Check runs saved with asyncio, so a rule set's checks are in flight at the same time.  The calls share the
+# installation's rate limiter with the sync client, and the worker's event loop and connections with each other.  At
+# most GITHUB_ASYNC_CONCURRENCY calls of an installation run at once.
+class AsyncGitHubInstallationClient:
+    def __init__(self, installation_key: str, token: str):
+        self.installation_key = installation_key
+        self.token = token
+
+    async def add_check(self, repository: RepositoryIdentifier, key: str, source_sha: str, details: CheckDetails):
+        response = await self._request(
+            Priority.LOW,
+            "POST",
+            f"/repos/{repository.full_name}/check-runs",
+            json=_check_run(key, source_sha, details),
+        )
+        data = _json(response)
+        logger.info(f"Status check on {source_sha} created for {key}: {details.status}")
+        return data["id"]
+
+    async def update_check(
+        self,
+        repository: RepositoryIdentifier,
+        key: str,
+        source_sha: str,
+        details: CheckDetails,
+        remote_check_id: str,
+    ):
+        response = await self._request(
+            Priority.LOW,
+            "PATCH",
+            f"/repos/{repository.full_name}/check-runs/{remote_check_id}",
+            json=_check_run(key, source_sha, details),
+        )
+        data = _json(response)
+        logger.info(f"Status check on {source_sha} updated for {key}: {details.status}")
+        return data["id"]
+
+    async def save_checks(self, repository: RepositoryIdentifier, updates: List[CheckUpdate]) -> List[str]:
+        async def save(update: CheckUpdate):
+            if update.remote_check_id:
+                await self.update_check(
+                    repository, update.key, update.source_sha, update.details, update.remote_check_id
+                )
+                return update.remote_check_id
+            return await self.add_check(repository, update.key, update.source_sha, update.details)
+
+        return list(await asyncio.gather(*(save(update) for update in updates)))
+
+    async def _request(self, priority: Priority, method: str, path: str, **kwargs) -> "httpx.Response":
+        limiter = rate_limit.get_limiter(self.installation_key)
+        headers = {"Authorization": f"token {self.token}", "Accept": "application/vnd.github.v3+json"}
+        async with _semaphore(self.installation_key):
+            attempt = 0
+            while True:
+                await _acquire(limiter, priority)
+                url = f"{settings.GITHUB_API_URL}{path}"
+                response = await _client().request(method, url, headers=headers, **kwargs)
+                delay = limiter.observe(response.status_code, response.headers, response.text)
+                if delay is None:
+                    return response
+                if attempt >= rate_limit.MAX_RETRIES or delay > rate_limit.MAX_DELAY:
+                    raise RateLimitExceeded(delay)
+                attempt += 1
+
+
+def _client() -> "httpx.AsyncClient":
+    if _shared.http is None:
+        _shared.http = httpx.AsyncClient(timeout=REQUEST_TIMEOUT)
+    return _shared.http
+
+
+def _semaphore(installation_key: str) -> asyncio.Semaphore:
+    semaphore = _shared.semaphores.get(installation_key)
+    if semaphore is None:
+        semaphore = _shared.semaphores[installation_key] = asyncio.Semaphore(settings.GITHUB_ASYNC_CONCURRENCY)
+    return semaphore
+
+
+# The worker's event loop, running on a thread of its own for as long as the worker does
+def _get_loop() -> asyncio.AbstractEventLoop:
+    with _shared.lock:
+        if _shared.loop is None:
+            _shared.loop = asyncio.new_event_loop()
+            threading.Thread(target=_shared.loop.run_forever, name="github-async", daemon=True).start()
+        return _shared.loop
+
+
+def reset():
+    async def close():
+        if _shared.http is not None:
+            await _shared.http.aclose()
+        _shared.http = None
+        _shared.semaphores.clear()
+
+    if _shared.loop is not None:
+        asyncio.run_coroutine_threadsafe(close(), _shared.loop).result()
+
+
+async def _acquire(limiter: RateLimiter, priority: Priority):
+    while True:
+        delay = limiter.reserve(priority)
+        if not delay:
+            return
+        if delay > rate_limit.MAX_DELAY:
+            raise RateLimitExceeded(delay)
+        logger.info(f"Delaying {priority.name} priority GitHub call by {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+
+def _json(response: "httpx.Response"):
+    data = response.json() if response.content else {}
+    if response.status_code >= 400:
+        raise OperationException(data.get("message") or f"GitHub responded with {response.status_code}")
+    return data
+
+
+def _check_run(key: str, source_sha: str, details: CheckDetails) -> Dict:
+    return dict(
+        head_sha=source_sha,
+        name=key,
+        output=dict(title=details.title, summary=details.summary, text=details.body),
+        status="completed",
+        conclusion=GitHubInstallationClient._status_to_check_conclusion(details),
+    )
+
+
+# Sync facade over the async client for the calls it makes concurrently, the others stay with the sync client
+class AsyncFacadeMixin:
+    def save_checks(self, repository: RepositoryIdentifier, updates: List[CheckUpdate]) -> List[str]:
+        return self._run(lambda client: client.save_checks(repository, updates))
+
+    def _run(self, call: Callable[[AsyncGitHubInstallationClient], Awaitable[T]]) -> T:
+        # the token may need the database, which isn't allowed from within the event loop
+        token = self._get_installation_token()
+        installation_key = self.installation.remote_id
+        client = AsyncGitHubInstallationClient(installation_key, token)
+
+        # the quota is shared with the other workers around the loop, as that too needs the database
+        rate_limit.sync(installation_key)
+        try:
+            return asyncio.run_coroutine_threadsafe(call(client), _get_loop()).result()
+        finally:
+            rate_limit.sync(installation_key, force=True)
+
+
+class GitHubAsyncInstallationClient(AsyncFacadeMixin, GitHubInstallationClient):
+    pass
+
+
+class GitHubActionAsyncInstallationClient(AsyncFacadeMixin, GitHubActionInstallationClient):
+    pass
@@ -0,0 +1,205 @@
+import hashlib
+import threading
+from dataclasses import dataclass
+from typing import Dict
+from typing import Optional
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from github import Github
+from github.Requester import Requester
+from github.Requester import RequestsResponse
+from requests.adapters import HTTPAdapter
+
+from sleuthpr.services.github import rate_limit
+
+# how long responses are kept around for conditional requests
+CONDITIONAL_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+class _SharedSession:
+    def __init__(self):
+        self.session: Optional[requests.Session] = None
+        self.lock = threading.Lock()
+
+
+_shared = _SharedSession()
+
+
+# One keep-alive connection pool shared by every GitHub client in the process, so API calls don't each pay for a
+# new TCP and TLS handshake
+def session() -> requests.Session:
+    if _shared.session is None:
+        with _shared.lock:
+            if _shared.session is None:
+                new_session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.GITHUB_HTTP_POOL_SIZE)
+                new_session.mount("https://", adapter)
+                new_session.mount("http://", adapter)
+                _shared.session = new_session
+    return _shared.session
+
+
+def reset_session():
+    with _shared.lock:
+        if _shared.session is not None:
+            _shared.session.close()
+        _shared.session = None
+
+
+def github(token: str) -> Github:
+    return Github(token, base_url=settings.GITHUB_API_URL)
+
+
+@dataclass
+class ConditionalCacheStats:
+    hits: int = 0
+    misses: int = 0
+    # responses without an ETag or Last-Modified header
+    uncacheable: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+_stats = ConditionalCacheStats()
+_stats_lock = threading.Lock()
+
+
+def conditional_cache_stats() -> ConditionalCacheStats:
+    with _stats_lock:
+        return ConditionalCacheStats(hits=_stats.hits, misses=_stats.misses, uncacheable=_stats.uncacheable)
+
+
+def reset_conditional_cache_stats():
+    with _stats_lock:
+        _stats.hits = _stats.misses = _stats.uncacheable = 0
+
+
+def _count(**counts: int):
+    with _stats_lock:
+        for key, value in counts.items():
+            setattr(_stats, key, getattr(_stats, key) + value)
+
+
+# Mimics the httplib response object for a response replayed from the conditional request cache
+class _CachedResponse:
+    def __init__(self, entry: Dict):
+        self.status = entry["status"]
+        self.headers = entry["headers"]
+        self.text = entry["text"]
+
+    def getheaders(self):
+        return self.headers.items()
+
+    def read(self):
+        return self.text
+
+
+# Mimics the httplib connection object PyGithub's requester expects, sending requests through the shared session
+class _SessionConnection:
+    protocol = "https"
+
+    def __init__(self, host, port=None, strict=False, timeout=None, retry=None, **kwargs):
+        self.host = host
+        self.port = port if port else 443
+        self.timeout = timeout
+        self.verify = kwargs.get("verify", True)
+        self.verb = None
+        self.url = None
+        self.input = None
+        self.headers = None
+
+    # PyGithub 2 also passes whether to stream the response, which its downloads need and these calls don't
+    def request(self, verb, url, input, headers, *args, **kwargs):
+        self.verb = verb
+        self.url = url
+        self.input = input
+        self.headers = headers
+
+    def getresponse(self):
+        url = f"{self.protocol}://{self.host}:{self.port}{self.url}"
+        if self.verb != "GET":
+            return RequestsResponse(self._send(url, self.headers))
+
+        # reads are revalidated with the ETag of the last response, a 304 doesn't count against the rate limit
+        key = self._cache_key(url)
+        entry = cache.get(key)
+        headers = dict(self.headers or {})
+        if entry:
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        response = self._send(url, headers)
+        if entry and response.status_code == 304:
+            _count(hits=1)
+            return _CachedResponse(entry)
+
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if response.status_code == 200 and (etag or last_modified):
+            _count(misses=1)
+            cache.set(
+                key,
+                dict(
+                    etag=etag,
+                    last_modified=last_modified,
+                    status=response.status_code,
+                    headers=dict(response.headers),
+                    text=response.text,
+                ),
+                timeout=CONDITIONAL_CACHE_TIMEOUT,
+            )
+        else:
+            _count(uncacheable=1)
+        return RequestsResponse(response)
+
+    def _send(self, url: str, headers: Optional[Dict]) -> requests.Response:
+        attempt = 0
+        while True:
+            rate_limit.before_request()
+            response = session().request(
+                self.verb,
+                url,
+                headers=headers,
+                data=self.input,
+                timeout=self.timeout,
+                verify=self.verify,
+                allow_redirects=False,
+            )
+            delay = rate_limit.after_response(response.status_code, response.headers, response.text)
+            if delay is None:
+                return response
+            if attempt >= rate_limit.MAX_RETRIES or delay > rate_limit.MAX_DELAY:
+                # retried by the task later, rather than failing it like an error response would
+                raise rate_limit.RateLimitExceeded(delay)
+            attempt += 1
+
+    def _cache_key(self, url: str) -> str:
+        # responses are only shared between requests of the same installation, which outlives its hourly tokens, or
+        # else made with the same credentials
+        installation_key = rate_limit.current_key()
+        if installation_key:
+            credentials = f"installation {installation_key}"
+        else:
+            credentials = (self.headers or {}).get("Authorization", "")
+        digest = hashlib.sha256(f"{credentials}\n{url}".encode("utf8")).hexdigest()
+        return f"github.conditional.{digest}"
+
+    def close(self):
+        pass
+
+
+class _HttpSessionConnection(_SessionConnection):
+    protocol = "http"
+
+    def __init__(self, host, port=None, strict=False, timeout=None, retry=None, **kwargs):
+        super().__init__(host, port if port else 80, strict, timeout, retry, **kwargs)
+
+
+Requester.injectConnectionClasses(_HttpSessionConnection, _SessionConnection)
@@ -0,0 +1,82 @@
+import logging
+from datetime import timedelta
+from typing import List
+from typing import Optional
+
+from django.db.models import F
+from django.utils.timezone import now
+
+from sleuthpr.models import DeliveryStatus
+from sleuthpr.models import WebhookDelivery
+
+logger = logging.getLogger(__name__)
+
+# GitHub only lets deliveries of the last few days be redelivered
+DELIVERY_TTL = 3 * 24 * 60 * 60
+# a delivery pending or processing for longer than this was lost, e.g. with the worker processing it
+STALE_AFTER = 10 * 60
+# times a delivery is processed before it is left failed, until a redelivery
+MAX_ATTEMPTS = 5
+
+
+# Stores the delivery, false if it is a duplicate.  A redelivery of a failed delivery is processed again.
+def record(delivery_id: str, event_name: str, payload: bytes) -> bool:
+    delivery, created = WebhookDelivery.objects.get_or_create(
+        delivery_id=delivery_id, defaults=dict(event_name=event_name, payload=payload)
+    )
+    if created:
+        return True
+    if WebhookDelivery.objects.filter(id=delivery.id, status=DeliveryStatus.FAILED).update(
+        status=DeliveryStatus.PENDING, payload=payload, updated_on=now()
+    ):
+        logger.info(f"Delivery {delivery_id} failed before, processing it again")
+        return True
+    logger.info(f"Delivery {delivery_id} was already received, dropping it")
+    return False
+
+
+# Marks the delivery as being processed, none if it already is or was
+def claim(delivery_id: str) -> Optional[WebhookDelivery]:
+    claimed = WebhookDelivery.objects.filter(
+        delivery_id=delivery_id, status__in=(DeliveryStatus.PENDING, DeliveryStatus.FAILED)
+    ).update(status=DeliveryStatus.PROCESSING, attempts=F("attempts") + 1, updated_on=now())
+    if not claimed:
+        logger.info(f"Delivery {delivery_id} is already processed, skipping")
+        return None
+    return WebhookDelivery.objects.get(delivery_id=delivery_id)
+
+
+# Only the id is kept, to recognize redeliveries
+def mark_processed(delivery: WebhookDelivery):
+    WebhookDelivery.objects.filter(id=delivery.id).update(
+        status=DeliveryStatus.PROCESSED, payload=b"", updated_on=now()
+    )
+
+
+def mark_failed(delivery: WebhookDelivery):
+    WebhookDelivery.objects.filter(id=delivery.id).update(status=DeliveryStatus.FAILED, updated_on=now())
+
+
+# Drops the deliveries GitHub can't redeliver anymore and returns the ones to process again, that failed or were lost
+def sweep() -> List[WebhookDelivery]:
+    deleted, _ = WebhookDelivery.objects.filter(on__lt=now() - timedelta(seconds=DELIVERY_TTL)).delete()
+    if deleted:
+        logger.info(f"Deleted {deleted} expired deliveries")
+
+    stale = now() - timedelta(seconds=STALE_AFTER)
+    lost = WebhookDelivery.objects.filter(status=DeliveryStatus.PROCESSING, updated_on__lt=stale).update(
+        status=DeliveryStatus.FAILED
+    )
+    if lost:
+        logger.warning(f"{lost} deliveries were lost while being processed")
+
+    retried = list(
+        WebhookDelivery.objects.filter(
+            status__in=(DeliveryStatus.PENDING, DeliveryStatus.FAILED),
+            updated_on__lt=stale,
+            attempts__lt=MAX_ATTEMPTS,
+        ).only("delivery_id", "event_name")
+    )
+    # not picked up again by the next sweep while they are queued
+    WebhookDelivery.objects.filter(id__in=[delivery.id for delivery in retried]).update(updated_on=now())
+    return retried
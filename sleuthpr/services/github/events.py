@@ -27,6 +27,7 @@ from sleuthpr.services import pull_requests
 from sleuthpr.services import repositories
 from sleuthpr.services import rules
 from sleuthpr.services.scm import Commit
+from sleuthpr.services.scm import PullRequestDetails
 from sleuthpr.triggers import PR_CLOSED
 from sleuthpr.triggers import PR_CREATED
 from sleuthpr.triggers import PR_REOPENED
@@ -46,12 +47,14 @@ def on_check_suite_requested(installation: Installation, repository: Repository,
 def on_pull_request_review(installation: Installation, repository: Repository, data: Dict):
     pr_data = data["pull_request"]
     pr, was_changed = _update_pull_request(installation, repository, pr_data)
-    if was_changed:
-        pull_requests.on_updated(installation, repository, pr)
 
-    reviewer = (_get_user(installation, data["review"]["user"]),)
+    # the review is recorded first as hydrating the pull request would otherwise pick up its state silently
+    reviewer = _get_user(installation, data["review"]["user"])
     pull_requests.update_review(installation, repository, pr, reviewer, ReviewState(data["action"].lower()))
 
+    if was_changed:
+        pull_requests.on_updated(installation, repository, pr)
+
 
 def on_status(installation: Installation, repository: Repository, data: Dict):
     context = data["context"]
@@ -67,11 +70,11 @@ def on_check_run(installation: Installation, repository: Repository, data: Dict)
 
 def on_push(installation: Installation, repository: Repository, data: Dict):
     logger.info(f"Push: {data['commits']}")
-    commits = installation.client.get_commits(repository, [c["id"] for c in data["commits"]])
-    pull_requests.add_commits(
-        repository,
-        commits,
-    )
+    for commits in installation.client.stream_commits(repository, [c["id"] for c in data["commits"]]):
+        pull_requests.add_commits(
+            repository,
+            commits,
+        )
     if "refs/heads/master" == data["ref"]:
         files = {}
         for commit in data["commits"]:
@@ -95,13 +98,11 @@ def on_push(installation: Installation, repository: Repository, data: Dict):
 
 
 def on_pr_created(installation: Installation, repository: Repository, pr_data: Dict):
-    pr = _update_pull_request_and_process(installation, repository, pr_data, event=PR_CREATED)
-    pull_requests.refresh_commits(installation, repository, pr)
+    _update_pull_request_and_process(installation, repository, pr_data, event=PR_CREATED)
 
 
-def on_pr_updated(installation: Installation, repository: Repository, pr_data: Dict):
-    pr = _update_pull_request_and_process(installation, repository, pr_data)
-    pull_requests.refresh_commits(installation, repository, pr)
+def on_pr_updated(installation: Installation, repository: Repository, pr_data: Dict, before: Optional[str] = None):
+    _update_pull_request_and_process(installation, repository, pr_data, before=before)
 
 
 def on_pr_closed(installation: Installation, repository: Repository, pr_data: Dict):
@@ -173,17 +174,98 @@ def graphql_commit_data_to_commit(c) -> Commit:
     )
 
 
+def graphql_pull_request_data_to_details(pr) -> PullRequestDetails:
+    head_commits = pr["headCommit"]["nodes"]
+    status = head_commits[0]["commit"]["status"] if head_commits else None
+    return PullRequestDetails(
+        data=dict(
+            number=pr["number"],
+            title=pr["title"],
+            body=pr["body"],
+            html_url=pr["url"],
+            created_at=pr["createdAt"],
+            user=_graphql_user_data(pr["author"]),
+            draft=pr["isDraft"],
+            merged=pr["merged"],
+            mergeable={"MERGEABLE": True, "CONFLICTING": False}.get(pr["mergeable"]),
+            mergeable_state={"MERGEABLE": "clean", "CONFLICTING": "dirty"}.get(pr["mergeable"]),
+            head=dict(ref=pr["headRefName"], sha=pr["headRefOid"]),
+            base=dict(ref=pr["baseRefName"], sha=pr["baseRefOid"]),
+            labels=[dict(name=label["name"]) for label in pr["labels"]["nodes"]],
+            assignees=[_graphql_user_data(user) for user in pr["assignees"]["nodes"]],
+            # team review requests come back empty
+            requested_reviewers=[
+                _graphql_user_data(request["requestedReviewer"])
+                for request in pr["reviewRequests"]["nodes"]
+                if request["requestedReviewer"]
+            ],
+        ),
+        statuses=[
+            (
+                context["context"],
+                CheckStatus.PENDING if context["state"] == "EXPECTED" else CheckStatus(context["state"].lower()),
+            )
+            for context in (status["contexts"] if status else [])
+        ],
+        reviews={
+            review["author"]["login"]: ReviewState(review["state"].lower())
+            for review in pr["latestReviews"]["nodes"]
+            if review["author"]
+        },
+    )
+
+
+def _graphql_user_data(user: Optional[Dict]) -> Dict:
+    if not user:
+        return {}
+    return dict(login=user["login"], id=user.get("databaseId"))
+
+
 def _update_pull_request_and_process(
-    installation: Installation, repository: Repository, data: Dict, event=PR_UPDATED
+    installation: Installation, repository: Repository, data: Dict, event=PR_UPDATED, before: Optional[str] = None
 ):
+    details = _get_pull_request_details(installation, repository, data, before)
+    if details and "title" not in data:
+        # payloads like check runs only carry the pull request's refs
+        data = details.data
     pr, _ = _update_pull_request(installation, repository, data)
     if event == PR_CREATED:
-        pull_requests.on_created(installation, repository, pr)
+        pull_requests.on_created(installation, repository, pr, details)
     else:
-        pull_requests.on_updated(installation, repository, pr)
+        pull_requests.on_updated(installation, repository, pr, details)
     return pr
 
 
+# A push on top of the head the pull request's commits were last synced for only loads the commits it added.  The
+# full list is loaded again if the base was merged in, as the comparison then lists the base's commits too, or if the
+# pull request was retargeted, as its commits are those missing from the new base.
+def _get_pull_request_details(
+    installation: Installation, repository: Repository, data: Dict, before: Optional[str]
+) -> Optional[PullRequestDetails]:
+    pr_id = int(data["number"])
+    after = data.get("head", {}).get("sha")
+    if (
+        before
+        and after
+        and pull_requests.has_synced_head(repository, str(pr_id), before)
+        and not _is_retargeted(repository, str(pr_id), data)
+    ):
+        commits = installation.client.compare_commits(repository.identifier, before, after)
+        if commits is not None and all(len(commit.parents) <= 1 for commit in commits):
+            details = installation.client.get_pull_request_details(repository.identifier, pr_id, with_commits=False)
+            if details:
+                details.commits = commits
+                details.commits_since = before
+            return details
+
+    return installation.client.get_pull_request_details(repository.identifier, pr_id)
+
+
+def _is_retargeted(repository: Repository, pr_id: str, data: Dict) -> bool:
+    base = data.get("base", {}).get("ref")
+    return base is not None and not repository.pull_requests.filter(remote_id=pr_id, base_branch_name=base).exists()
+
+
 @transaction.atomic
 def _update_pull_request(installation: Installation, repository: Repository, data: Dict) -> Tuple[PullRequest, bool]:
     logger.info("Transaction started")
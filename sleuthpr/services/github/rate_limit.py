@@ -0,0 +1,248 @@
+import inspect
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from enum import IntEnum
+from functools import wraps
+from typing import Dict
+from typing import Mapping
+from typing import Optional
+from typing import Tuple
+
+from django.db import DatabaseError
+from django.db import transaction
+
+from sleuthpr.models import RateLimitState
+from sleuthpr.services.scm import TransientOperationException
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    LOW = 0
+    NORMAL = 1
+    HIGH = 2
+
+
+# share of the quota each priority leaves for the ones above it
+RESERVES = {Priority.LOW: 0.2, Priority.NORMAL: 0.05, Priority.HIGH: 0.0}
+DEFAULT_LIMIT = 5000
+# used when the quota ran out and GitHub didn't say when it resets
+DEFAULT_RESET_DELAY = 60.0
+# calls that would have to wait longer than this raise RateLimitExceeded, so their task is retried later instead
+MAX_DELAY = 30.0
+BACKOFF_BASE = 1.0
+MAX_RETRIES = 3
+# how often a worker shares what it learned about an installation's quota with the others, and learns theirs
+SYNC_INTERVAL = 5.0
+
+
+# Raised for calls that would have to wait too long, the task making them is retried once the quota allows it
+class RateLimitExceeded(TransientOperationException):
+    def __init__(self, delay: float):
+        super().__init__(f"GitHub rate limit exceeded, retry in {delay:.0f}s", delay)
+
+
+# The installation's quota as last reported by GitHub.  The quota is a fixed window that GitHub refills at the
+# reset time, so calls that would dig into the reserve of a higher priority wait for the reset.
+class RateLimiter:
+    def __init__(self, limit: int = DEFAULT_LIMIT):
+        self.limit = limit
+        self.remaining = limit
+        self.reset_at: Optional[float] = None
+        self.blocked_until = 0.0
+        self.failures = 0
+        self.synced_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    # Takes one call from the quota if the priority may make it now, otherwise returns how long to wait
+    def reserve(self, priority: Priority, now: Optional[float] = None) -> float:
+        now = _clock() if now is None else now
+        with self._lock:
+            if self.reset_at is not None and now >= self.reset_at:
+                self.remaining = self.limit
+                self.reset_at = None
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            if self.remaining - 1 >= self.limit * RESERVES[priority]:
+                self.remaining -= 1
+                return 0.0
+            return self.reset_at - now if self.reset_at is not None else DEFAULT_RESET_DELAY
+
+    def acquire(self, priority: Priority):
+        while True:
+            delay = self.reserve(priority)
+            if not delay:
+                return
+            if delay > MAX_DELAY:
+                raise RateLimitExceeded(delay)
+            logger.info(f"Delaying {priority.name} priority GitHub call by {delay:.1f}s")
+            _sleep(delay)
+
+    # Updates the quota from a response, returning how long to back off if it was rate limited
+    def observe(
+        self, status: int, headers: Mapping[str, str], body: str = "", now: Optional[float] = None
+    ) -> Optional[float]:
+        now = _clock() if now is None else now
+        with self._lock:
+            if "X-RateLimit-Limit" in headers:
+                self.limit = int(headers["X-RateLimit-Limit"])
+            if "X-RateLimit-Remaining" in headers:
+                self.remaining = int(headers["X-RateLimit-Remaining"])
+            if "X-RateLimit-Reset" in headers:
+                self.reset_at = float(headers["X-RateLimit-Reset"])
+
+            if not _is_rate_limited(status, headers, body):
+                self.failures = 0
+                return None
+
+            self.failures += 1
+            if "Retry-After" in headers:
+                delay = float(headers["Retry-After"])
+            elif headers.get("X-RateLimit-Remaining") == "0" and self.reset_at is not None:
+                delay = max(self.reset_at - now, 0.0)
+            else:
+                delay = BACKOFF_BASE * 2 ** (self.failures - 1)
+            # spread the retries of concurrent workers
+            delay += random.uniform(0, delay / 2)
+            self.blocked_until = max(self.blocked_until, now + delay)
+            logger.warning(f"GitHub rate limited a call with {status}, backing off for {delay:.1f}s")
+            return delay
+
+    # Takes in the quota another worker saw, keeping whichever view is the more cautious
+    def merge(self, limit: int, remaining: int, reset_at: Optional[float], blocked_until: float):
+        with self._lock:
+            if reset_at is not None and (self.reset_at is None or reset_at > self.reset_at):
+                self.limit = limit
+                self.remaining = remaining
+                self.reset_at = reset_at
+            elif reset_at == self.reset_at:
+                self.remaining = min(self.remaining, remaining)
+            self.blocked_until = max(self.blocked_until, blocked_until)
+
+    def state(self) -> Tuple[int, int, Optional[float], float]:
+        with self._lock:
+            return self.limit, self.remaining, self.reset_at, self.blocked_until
+
+
+def _is_rate_limited(status: int, headers: Mapping[str, str], body: str) -> bool:
+    if status == 429:
+        return True
+    if status != 403:
+        return False
+    text = body.lower()
+    return (
+        "Retry-After" in headers
+        or headers.get("X-RateLimit-Remaining") == "0"
+        or "rate limit" in text
+        or "abuse" in text
+    )
+
+
+_limiters: Dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+_current = threading.local()
+_sleep = time.sleep
+_clock = time.time
+
+
+def get_limiter(key: str) -> RateLimiter:
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = _limiters[key] = RateLimiter()
+        return limiter
+
+
+def reset():
+    with _limiters_lock:
+        _limiters.clear()
+
+
+# Shares the installation's quota through the database, so a worker that is rate limited holds back the others as
+# well.  It is only done every SYNC_INTERVAL unless forced, and is best effort as the headers of every response
+# correct the quota anyway.
+def sync(key: str, force: bool = False):
+    limiter = get_limiter(key)
+    now = _clock()
+    if not force and limiter.synced_at is not None and now - limiter.synced_at < SYNC_INTERVAL:
+        return
+    limiter.synced_at = now
+
+    try:
+        with transaction.atomic():
+            shared = RateLimitState.objects.select_for_update().filter(installation_key=key).first()
+            if shared:
+                limiter.merge(shared.limit, shared.remaining, shared.reset_at, shared.blocked_until)
+            else:
+                shared = RateLimitState(installation_key=key)
+            shared.limit, shared.remaining, shared.reset_at, shared.blocked_until = limiter.state()
+            shared.save()
+    except DatabaseError as e:
+        logger.info(f"Unable to share the GitHub quota of {key}: {e}")
+
+
+@contextmanager
+def scheduled_calls(key: str, priority: Priority):
+    previous = getattr(_current, "call", None)
+    _current.call = (key, get_limiter(key), priority)
+    try:
+        yield
+    finally:
+        _current.call = previous
+
+
+# Runs the client method's API calls through its installation's limiter with the given priority
+def scheduled(priority: Priority):
+    def decorator(func):
+        if inspect.isgeneratorfunction(func):
+
+            @wraps(func)
+            def generator_wrapper(client, *args, **kwargs):
+                # only the generator's own steps are scheduled, not what the caller does between them
+                items = func(client, *args, **kwargs)
+                while True:
+                    with scheduled_calls(client.installation.remote_id, priority):
+                        try:
+                            item = next(items)
+                        except StopIteration:
+                            return
+                    yield item
+
+            return generator_wrapper
+
+        @wraps(func)
+        def wrapper(client, *args, **kwargs):
+            with scheduled_calls(client.installation.remote_id, priority):
+                return func(client, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# The installation the calls on this thread are made for, if they are scheduled
+def current_key() -> Optional[str]:
+    call = getattr(_current, "call", None)
+    return call[0] if call else None
+
+
+def before_request():
+    call = getattr(_current, "call", None)
+    if call:
+        key, limiter, priority = call
+        sync(key)
+        limiter.acquire(priority)
+
+
+def after_response(status: int, headers: Mapping[str, str], body: str) -> Optional[float]:
+    call = getattr(_current, "call", None)
+    if call:
+        key, limiter, _ = call
+        delay = limiter.observe(status, headers, body)
+        if delay is not None:
+            sync(key, force=True)
+        return delay
+    return None
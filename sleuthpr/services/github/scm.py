@@ -1,15 +1,12 @@
 import logging
-import os
-from datetime import timedelta
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
 from typing import List
 from typing import Optional
 from typing import Tuple
 
-import jwt
-import requests
 from django.conf import settings
-from django.core.cache import cache
-from django.utils.timezone import now
 from github import Github
 from github import GithubException
 from github import UnknownObjectException
@@ -21,23 +18,37 @@ from sleuthpr.models import MergeMethod
 from sleuthpr.models import PullRequest
 from sleuthpr.models import Repository
 from sleuthpr.models import RepositoryIdentifier
+from sleuthpr.services.github import api
+from sleuthpr.services.github import tokens
 from sleuthpr.services.github.events import _update_pull_request
 from sleuthpr.services.github.events import commit_data_to_commit
 from sleuthpr.services.github.events import graphql_commit_data_to_commit
+from sleuthpr.services.github.events import graphql_pull_request_data_to_details
+from sleuthpr.services.github.rate_limit import Priority
+from sleuthpr.services.github.rate_limit import scheduled
 from sleuthpr.services.scm import CheckDetails
 from sleuthpr.services.scm import Commit
 from sleuthpr.services.scm import InstallationClient
 from sleuthpr.services.scm import OperationException
+from sleuthpr.services.scm import PullRequestDetails
+from sleuthpr.util import closing_connection
 
 logger = logging.getLogger(__name__)
 
+# commits fetched per graphql query, each can bring up to 100 parents which count against the node limit
+COMMITS_BATCH_SIZE = 50
+COMMITS_WORKERS = 4
+
 
 class GitHubInstallationClient(InstallationClient):
     def __init__(self, installation: Installation):
         self.installation = installation
+        self._gh: Optional[Github] = None
+        self._gh_token: Optional[str] = None
 
+    @scheduled(Priority.LOW)
     def get_repositories(self) -> List[RepositoryIdentifier]:
-        repos = Github(self._get_installation_token()).get_installation(int(self.installation.remote_id)).get_repos()
+        repos = self._github().get_installation(int(self.installation.remote_id)).get_repos()
         result: List[RepositoryIdentifier] = []
         for repo in repos:
             if repo.permissions.push:
@@ -45,36 +56,39 @@ class GitHubInstallationClient(InstallationClient):
 
         return result
 
-    def get_pull_requests(self, repository: Repository) -> List[PullRequest]:
-        gh = Github(self._get_installation_token())
+    @scheduled(Priority.LOW)
+    def get_pull_requests(self, repository: Repository) -> Iterator[PullRequest]:
+        gh = self._github()
         repo = gh.get_repo(repository.full_name, lazy=True)
 
         def _new_pull_request(_, __, data, *args, **kwargs):
             pr, _ = _update_pull_request(self.installation, repository, data)
             return pr
 
-        result = []
+        # pages are only requested as the caller gets to them
+        count = 0
         for pr in PaginatedList(
             _new_pull_request,
             repo._requester,
             repo.url + "/pulls",
-            dict(state="open"),
+            dict(state="open", per_page=100),
         ):  # type: PullRequest
-            result.append(pr)
+            count += 1
+            yield pr
 
-        logger.info(f"Loaded {len(result)} pull requests")
-        return result
+        logger.info(f"Loaded {count} pull requests")
 
     def get_source_url(self, repository: RepositoryIdentifier, path: str) -> str:
         return f"https://github.com/{repository.full_name}/tree/master/{path}"
 
+    @scheduled(Priority.LOW)
     def get_pull_request_commits(
         self,
         repository: RepositoryIdentifier,
         pr_id: int,
     ) -> List[Commit]:
 
-        gh = Github(self._get_installation_token())
+        gh = self._github()
         repo = gh.get_repo(repository.full_name, lazy=True)
 
         def _new_commit(_, __, data, *args, **kwargs):
@@ -89,25 +103,97 @@ class GitHubInstallationClient(InstallationClient):
         logger.info(f"Loaded {len(result)} commits")
         return result
 
+    @scheduled(Priority.NORMAL)
+    def get_pull_request_details(
+        self,
+        repository: RepositoryIdentifier,
+        pr_id: int,
+        with_commits: bool = True,
+    ) -> Optional[PullRequestDetails]:
+        requester = getattr(self._github(), "_Github__requester")
+        variables = dict(
+            owner=repository.owner, name=repository.name, number=pr_id, cursor=None, withCommits=with_commits
+        )
+        details: Optional[PullRequestDetails] = None
+        while True:
+            headers, data = requester.requestJsonAndCheck(
+                "POST", "/graphql", input=dict(query=PULL_REQUEST_DETAILS_QUERY, variables=variables)
+            )
+            pr_data = (data.get("data") or {}).get("repository", {}).get("pullRequest")
+            if not pr_data:
+                logger.warning(f"Pull request {pr_id} not found on {repository.full_name}: {data.get('errors')}")
+                return None
+
+            if details is None:
+                details = graphql_pull_request_data_to_details(pr_data)
+            if not with_commits:
+                return details
+            details.commits.extend(
+                graphql_commit_data_to_commit(node["commit"]) for node in pr_data["commits"]["nodes"]
+            )
+            page_info = pr_data["commits"]["pageInfo"]
+            if not page_info["hasNextPage"]:
+                break
+            variables["cursor"] = page_info["endCursor"]
+
+        logger.info(f"Loaded pull request {pr_id} with {len(details.commits)} commits from graphql")
+        return details
+
+    @scheduled(Priority.NORMAL)
+    def compare_commits(self, repository: RepositoryIdentifier, base: str, head: str) -> Optional[List[Commit]]:
+        requester = getattr(self._github(), "_Github__requester")
+        try:
+            headers, data = requester.requestJsonAndCheck(
+                "GET", f"/repos/{repository.full_name}/compare/{base}...{head}"
+            )
+        except UnknownObjectException:
+            # base is gone, e.g. it was force pushed over and garbage collected
+            return None
+
+        # the comparison lists at most 250 commits
+        if data["status"] not in ("ahead", "identical") or len(data["commits"]) != data["total_commits"]:
+            return None
+        return [commit_data_to_commit(dict(c["commit"], sha=c["sha"], parents=c["parents"])) for c in data["commits"]]
+
     def get_commits(self, repository: Repository, shas: List[str]) -> List[Commit]:
-        gh = Github(self._get_installation_token())
+        return [commit for batch in self.stream_commits(repository, shas) for commit in batch]
+
+    def stream_commits(self, repository: Repository, shas: List[str]) -> Iterator[List[Commit]]:
+        requester = getattr(self._github(), "_Github__requester")
+        batches = [shas[i : i + COMMITS_BATCH_SIZE] for i in range(0, len(shas), COMMITS_BATCH_SIZE)]
+        if len(batches) <= 1:
+            for batch in batches:
+                yield self._get_commits_batch(requester, repository, batch)
+            return
+
+        with ThreadPoolExecutor(max_workers=min(COMMITS_WORKERS, len(batches))) as executor:
+            load = closing_connection(self._get_commits_batch)
+            futures = [executor.submit(load, requester, repository, batch) for batch in batches]
+            for future in as_completed(futures):
+                yield future.result()
+
+    @scheduled(Priority.NORMAL)
+    def _get_commits_batch(self, requester, repository: Repository, shas: List[str]) -> List[Commit]:
         post_parameters = {
             "query": _build_commits_query(repository.identifier, shas),
         }
-        headers, data = getattr(gh, "_Github__requester").requestJsonAndCheck(
-            "POST", "/graphql", input=post_parameters
-        )
+        headers, data = requester.requestJsonAndCheck("POST", "/graphql", input=post_parameters)
+        if data.get("errors"):
+            logger.warning(f"Errors loading commits from graphql: {data['errors']}")
 
+        repository_data = (data.get("data") or {}).get("repository") or {}
         result = []
         for sha in shas:
-            cdata = data["data"]["repository"][f"c_{sha}"]
+            cdata = repository_data.get(f"c_{sha}")
+            if not cdata:
+                logger.warning(f"Commit {sha} not found in {repository.full_name}")
+                continue
             result.append(graphql_commit_data_to_commit(cdata))
 
-        # todo: handle errors
-
         logger.info(f"Loaded {len(result)} commits from graphql")
         return result
 
+    @scheduled(Priority.NORMAL)
     def comment_on_pull_request(
         self,
         repository: RepositoryIdentifier,
@@ -115,7 +201,7 @@ class GitHubInstallationClient(InstallationClient):
         sha: str,
         message: str,
     ):
-        gh = Github(self._get_installation_token())
+        gh = self._github()
         repo = gh.get_repo(repository.full_name, lazy=True)
 
         post_parameters = {
@@ -127,8 +213,9 @@ class GitHubInstallationClient(InstallationClient):
         # todo: handle response better
         logger.info(f"Pull request commented for {pr_id}")
 
+    @scheduled(Priority.LOW)
     def get_statuses(self, repository: RepositoryIdentifier, sha: str) -> List[Tuple[str, CheckStatus]]:
-        gh = Github(self._get_installation_token())
+        gh = self._github()
         repo = gh.get_repo(repository.full_name, lazy=True)
         result = []
 
@@ -148,17 +235,19 @@ class GitHubInstallationClient(InstallationClient):
 
         return result
 
+    @scheduled(Priority.NORMAL)
     def get_content(self, repository: RepositoryIdentifier, path: str) -> Optional[str]:
 
-        gh = Github(self._get_installation_token())
+        gh = self._github()
         repo = gh.get_repo(repository.full_name, lazy=True)
         try:
             return repo.get_contents(path).decoded_content.decode("utf8")
         except UnknownObjectException:
             return None
 
+    @scheduled(Priority.HIGH)
     def add_label(self, repository: RepositoryIdentifier, pr_id: int, label_name: str):
-        gh = Github(self._get_installation_token())
+        gh = self._github()
         repo = gh.get_repo(repository.full_name, lazy=True)
 
         headers, data = repo._requester.requestJsonAndCheck(
@@ -166,6 +255,7 @@ class GitHubInstallationClient(InstallationClient):
         )
         logger.info(f"Added label {label_name} to pr {pr_id}")
 
+    @scheduled(Priority.HIGH)
     def merge(
         self,
         repository: Repository,
@@ -175,7 +265,7 @@ class GitHubInstallationClient(InstallationClient):
         method: MergeMethod,
         sha: str,
     ) -> str:
-        gh = Github(self._get_installation_token())
+        gh = self._github()
         repo = gh.get_repo(repository.identifier.full_name, lazy=True)
 
         status = repo.get_pull(pr_id).merge(
@@ -187,6 +277,7 @@ class GitHubInstallationClient(InstallationClient):
         logger.info(f"Merged pr {pr_id}")
         return status.sha
 
+    @scheduled(Priority.HIGH)
     def update_pull_request(
         self,
         repository: Repository,
@@ -194,7 +285,7 @@ class GitHubInstallationClient(InstallationClient):
         sha: str,
     ):
 
-        gh = Github(self._get_installation_token())
+        gh = self._github()
         repo = gh.get_repo(repository.full_name, lazy=True)
         try:
             headers, data = repo._requester.requestJsonAndCheck(
@@ -210,6 +301,7 @@ class GitHubInstallationClient(InstallationClient):
         except GithubException as ex:
             raise OperationException(ex.data.get("message"))
 
+    @scheduled(Priority.LOW)
     def add_check(
         self,
         repository: RepositoryIdentifier,
@@ -217,7 +309,7 @@ class GitHubInstallationClient(InstallationClient):
         source_sha: str,
         details: CheckDetails,
     ):
-        gh = Github(self._get_installation_token())
+        gh = self._github()
         repo = gh.get_repo(repository.full_name, lazy=True)
         headers, data = repo._requester.requestJsonAndCheck(
             "POST",
@@ -247,6 +339,7 @@ class GitHubInstallationClient(InstallationClient):
             conclusion = "neutral"
         return conclusion
 
+    @scheduled(Priority.LOW)
     def update_check(
         self,
         repository: RepositoryIdentifier,
@@ -255,7 +348,7 @@ class GitHubInstallationClient(InstallationClient):
         details: CheckDetails,
         remote_check_id: str,
     ):
-        gh = Github(self._get_installation_token())
+        gh = self._github()
         repo = gh.get_repo(repository.full_name, lazy=True)
         headers, data = repo._requester.requestJsonAndCheck(
             "PATCH",
@@ -275,31 +368,16 @@ class GitHubInstallationClient(InstallationClient):
         #     _update_pull_request(repo.installation, repo, pr_data)
         return data["id"]
 
-    def _get_installation_token(self):
-        key = f"installation_token.{self.installation.provider}.{self.installation.remote_id}"
-
-        token = cache.get(key)
-        if not token:
-            jwt_token = _gen_jwt()
-            body = {
-                "repository_ids": [repo.remote_id for repo in self.installation.repositories.all() if repo.remote_id]
-            }
-            resp = requests.post(
-                headers={
-                    "Authorization": f"Bearer {jwt_token}",
-                    "Accept": "application/vnd.github.v3+json,application/json",
-                },
-                url=f"https://api.github.com/app/installations/{self.installation.remote_id}/access_tokens",
-                json=body,
-            )
-            if resp.status_code < 299:
-                data = resp.json()
+    def _github(self) -> Github:
+        # the connections are pooled by the api module, so only a rotated token needs a new client
+        token = self._get_installation_token()
+        if self._gh is None or self._gh_token != token:
+            self._gh = api.github(token)
+            self._gh_token = token
+        return self._gh
 
-                token = data["token"]
-                cache.set(key, token, timeout=50)
-            else:
-                logger.error(f"Unable to get token: {resp.text}")
-        return token
+    def _get_installation_token(self):
+        return tokens.get_installation_token(self.installation)
 
 
 class GitHubActionInstallationClient(GitHubInstallationClient):
@@ -307,17 +385,105 @@ class GitHubActionInstallationClient(GitHubInstallationClient):
         return settings.GITHUB_TOKEN
 
 
-def _gen_jwt():
-    private_key = os.getenv("GITHUB_APP_PRIVATE_KEY").replace("\\n", "\n")
-    return jwt.encode(
-        payload={
-            "iat": now(),
-            "exp": now() + timedelta(minutes=10),
-            "iss": os.getenv("GITHUB_APP_ID"),
-        },
-        key=private_key,
-        algorithm="RS256",
-    ).decode()
+_COMMIT_FIELDS = """
+    oid
+    message
+    author {
+      name
+      email
+    }
+    committer {
+      name
+      email
+    }
+    parents(first: 100) {
+      edges {
+        node {
+          oid
+        }
+      }
+    }
+"""
+
+# Everything the rules need about a pull request, the commits are paged through with the cursor unless left out
+PULL_REQUEST_DETAILS_QUERY = f"""
+query($owner: String!, $name: String!, $number: Int!, $cursor: String, $withCommits: Boolean = true) {{
+  repository(owner: $owner, name: $name) {{
+    pullRequest(number: $number) {{
+      number
+      title
+      body
+      url
+      createdAt
+      isDraft
+      merged
+      mergeable
+      author {{
+        login
+        ... on User {{
+          databaseId
+        }}
+      }}
+      headRefName
+      headRefOid
+      baseRefName
+      baseRefOid
+      labels(first: 100) {{
+        nodes {{
+          name
+        }}
+      }}
+      assignees(first: 100) {{
+        nodes {{
+          login
+          databaseId
+        }}
+      }}
+      reviewRequests(first: 100) {{
+        nodes {{
+          requestedReviewer {{
+            ... on User {{
+              login
+              databaseId
+            }}
+          }}
+        }}
+      }}
+      latestReviews(first: 100) {{
+        nodes {{
+          author {{
+            login
+          }}
+          state
+        }}
+      }}
+      headCommit: commits(last: 1) {{
+        nodes {{
+          commit {{
+            status {{
+              contexts {{
+                context
+                state
+              }}
+            }}
+          }}
+        }}
+      }}
+      commits(first: 100, after: $cursor) @include(if: $withCommits) {{
+        pageInfo {{
+          hasNextPage
+          endCursor
+        }}
+        nodes {{
+          commit {{
+            {_COMMIT_FIELDS}
+          }}
+        }}
+      }}
+    }}
+  }}
+}}
+"""
 
 
 def _build_commits_query(repo: RepositoryIdentifier, commit_shas: List[str]) -> str:
@@ -1,18 +1,24 @@
+import json
 import logging
+import time
 from typing import Dict
 from typing import Optional
 
 from celery import shared_task
 from django.conf import settings
-from django.utils.text import slugify
 from opentracing import tracer
 
+from sleuthpr import lanes
 from sleuthpr import lock
+from sleuthpr import partitions
 from sleuthpr.models import Installation
 from sleuthpr.models import Repository
 from sleuthpr.models import RepositoryIdentifier
 from sleuthpr.services import installations
 from sleuthpr.services import repositories
+from sleuthpr.services import rules
+from sleuthpr.services.github import deliveries
+from sleuthpr.services.github import tokens
 from sleuthpr.services.github.events import on_check_run
 from sleuthpr.services.github.events import on_check_suite_requested
 from sleuthpr.services.github.events import on_installation_created
@@ -25,12 +31,14 @@ from sleuthpr.services.github.events import on_push
 from sleuthpr.services.github.events import on_repositories_added
 from sleuthpr.services.github.events import on_repositories_removed
 from sleuthpr.services.github.events import on_status
+from sleuthpr.services.scm import MAX_DEFERRALS
+from sleuthpr.services.scm import TransientOperationException
 
 logger = logging.getLogger(__name__)
 
 
 @shared_task
-def event_task(event_name: str, data: Dict, installation: Optional[Installation] = None, **_):
+def event_task(event_name: str, data: Dict, installation: Optional[Installation] = None, replayed: bool = False, **_):
     action = data.get("action")
     logger.info(f"GitHub action: {event_name} : {action if action else ''}")
     tracer.scope_manager.active.span.set_tag("event_name", event_name)
@@ -63,49 +71,154 @@ def event_task(event_name: str, data: Dict, installation: Optional[Installation]
         elif action == "removed":
             on_repositories_removed(installation, data)
     elif repository:
-        process_repository_task(event_name, action, data, installation.remote_id, repository.identifier.full_name)
+        _dispatch_repository_event(
+            event_name, action, data, installation.remote_id, repository.identifier.full_name, replayed
+        )
     else:
         logger.info(f"Ignored event {event_name}, action {action}")
 
 
-@shared_task(default_retry_delay=3)
+@shared_task
+def webhook_task(delivery_id: str, event_name: str):
+    delivery = deliveries.claim(delivery_id)
+    if not delivery:
+        return
+
+    try:
+        # the delivery was processed before but failed, possibly after some of its actions ran
+        event_task(event_name, json.loads(bytes(delivery.payload)), replayed=delivery.attempts > 1)
+    except Exception:
+        # processed again by the sweep, or a redelivery
+        deliveries.mark_failed(delivery)
+        raise
+    deliveries.mark_processed(delivery)
+
+
+@shared_task
+def sweep_deliveries_task():
+    for delivery in deliveries.sweep():
+        logger.info(f"Retrying delivery {delivery.delivery_id}")
+        webhook_task.apply_async(
+            (delivery.delivery_id, delivery.event_name), queue=lanes.queue_for(lanes.lane_for(delivery.event_name))
+        )
+
+    expired = lock.delete_expired_leases()
+    if expired:
+        logger.info(f"Deleted {expired} expired lock leases")
+
+
+# retried until the lease of a holder that died ran out, and queued again until the installation's GitHub quota allows
+# the calls
+@shared_task(default_retry_delay=3, max_retries=lock.DEFAULT_LEASE // 3)
 def process_repository_task(event_name, action, data, installation_id, repository_full_name, **kwargs):
     installation = installations.get(installation_id)
     repository_id = RepositoryIdentifier(full_name=repository_full_name)
     repository = repositories.get(installation, repository_id)
     tracer.scope_manager.active.span.set_tag("event_name", event_name)
     tracer.scope_manager.active.span.set_tag("action", action)
+    args = (event_name, action, data, installation_id, repository_full_name)
+
+    # a partition's events are consumed by a single worker in order, so the repository is already exclusive and the
+    # event waits for a slot, or for a transient failure to pass, rather than going back to the queue behind the
+    # repository's later events
+    if kwargs.get("partition") is not None:
+
+        def _process():
+            with rules.replaying(kwargs.get("replayed", False)):
+                _process_repository_event(event_name, action, data, installation, repository)
+
+        partitions.run_in_order(
+            lanes.INTERACTIVE, installation_id, f"{event_name} of {repository_full_name}", _process
+        )
+        return
+
+    queue = lanes.queue_for(lanes.INTERACTIVE)
+    slot = lanes.acquire_slot(lanes.INTERACTIVE, installation_id)
+    if slot is None:
+        logger.info(f"Installation {installation_id} has no free slot, retrying {repository_full_name}")
+        process_repository_task.retry(
+            args=args, kwargs=kwargs, countdown=lanes.RETRY_DELAYS[lanes.INTERACTIVE], queue=queue
+        )
+        return
 
+    # the lock isn't waited for, the task is retried instead so the worker can take other events meanwhile
+    lock_requested_at = kwargs.get("lock_requested_at") or time.time()
     try:
-        with lock.with_lock(f"{installation_id}:{slugify(repository.identifier.full_name)}"):
-            logger.info(f"Executing action for repository {repository_full_name}")
-            if event_name == "pull_request":
-                if action == "opened":
-                    on_pr_created(installation, repository, data["pull_request"])
-                elif action == "synchronize":
-                    on_pr_updated(installation, repository, data["pull_request"])
-                elif action == "closed":
-                    on_pr_closed(installation, repository, data["pull_request"])
-                elif action == "reopened":
-                    on_pr_reopened(installation, repository, data["pull_request"])
-                else:
-                    logger.info(f"Unhandled subevent: {action}")
-            elif event_name == "push":
-                on_push(installation, repository, data)
-            elif event_name == "check_suite":
-                if action == "requested":
-                    on_check_suite_requested(installation, repository, data["check_suite"])
-            elif event_name == "check_run":
-                app_id = data["check_run"]["check_suite"]["app"]["id"]
-                if str(app_id) != settings.GITHUB_APP_ID:
-                    on_check_run(installation, repository, data["check_run"])
-            elif event_name == "status":
-                on_status(installation, repository, data)
-            elif event_name == "pull_request_review":
-                on_pull_request_review(installation, repository, data)
+        with lock.with_lock(
+            lock.repository_lock_name(installation_id, repository.identifier.full_name),
+            requested_at=lock_requested_at,
+        ):
+            with rules.replaying(kwargs.get("replayed", False)):
+                _process_repository_event(event_name, action, data, installation, repository)
     except TimeoutError:
-        logger.info(f"Timeout waiting for lock of {repository_full_name}")
-        process_repository_task.retry()
+        logger.info(f"Lock of {repository_full_name} is held, retrying")
+        process_repository_task.retry(
+            args=args, kwargs=dict(kwargs, lock_requested_at=lock_requested_at), queue=queue
+        )
+    except TransientOperationException as e:
+        deferrals = kwargs.get("deferrals", 0)
+        if deferrals >= MAX_DEFERRALS:
+            logger.error(f"Giving up on {event_name} of {repository_full_name} after {deferrals} deferrals: {e}")
+            raise
+        logger.info(f"Deferring {event_name} of {repository_full_name} by {e.delay:.0f}s: {e}")
+        process_repository_task.apply_async(
+            args, dict(kwargs, deferrals=deferrals + 1), countdown=e.delay, queue=queue
+        )
+    finally:
+        lanes.release_slot(slot)
+
+
+def _dispatch_repository_event(event_name, action, data, installation_id, repository_full_name, replayed=False):
+    if not settings.REPOSITORY_PARTITIONS:
+        # queued rather than called, so a retry while the repository is locked puts the event back on the queue
+        process_repository_task.apply_async(
+            (event_name, action, data, installation_id, repository_full_name),
+            dict(replayed=replayed),
+            queue=lanes.queue_for(lanes.INTERACTIVE),
+        )
+        return
+
+    partition = partitions.partition_for(repository_full_name)
+    process_repository_task.apply_async(
+        (event_name, action, data, installation_id, repository_full_name),
+        dict(partition=partition, replayed=replayed),
+        queue=partitions.queue_name(partition),
+    )
+
+
+def _process_repository_event(event_name, action, data, installation: Installation, repository: Repository):
+    logger.info(f"Executing action for repository {repository.full_name}")
+    if event_name == "pull_request":
+        if action == "opened":
+            on_pr_created(installation, repository, data["pull_request"])
+        elif action == "synchronize":
+            on_pr_updated(installation, repository, data["pull_request"], data.get("before"))
+        elif action == "closed":
+            on_pr_closed(installation, repository, data["pull_request"])
+        elif action == "reopened":
+            on_pr_reopened(installation, repository, data["pull_request"])
+        else:
+            logger.info(f"Unhandled subevent: {action}")
+    elif event_name == "push":
+        on_push(installation, repository, data)
+    elif event_name == "check_suite":
+        if action == "requested":
+            on_check_suite_requested(installation, repository, data["check_suite"])
+    elif event_name == "check_run":
+        app_id = data["check_run"]["check_suite"]["app"]["id"]
+        if str(app_id) != settings.GITHUB_APP_ID:
+            on_check_run(installation, repository, data["check_run"])
+    elif event_name == "status":
+        on_status(installation, repository, data)
+    elif event_name == "pull_request_review":
+        on_pull_request_review(installation, repository, data)
+
+
+@shared_task
+def refresh_installation_token_task(installation_id: str):
+    installation = installations.get(installation_id)
+    if installation:
+        tokens.refresh(installation)
 
 
 def _get_repository(installation, data) -> Optional[Repository]:
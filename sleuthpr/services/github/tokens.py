@@ -0,0 +1,155 @@
+import logging
+import os
+import threading
+import time
+from typing import Dict
+from typing import Optional
+
+import jwt
+from dateutil import parser
+from django.conf import settings
+from django.core.cache import cache
+
+from sleuthpr.models import Installation
+from sleuthpr.services.github import api
+
+logger = logging.getLogger(__name__)
+
+# tokens are refreshed in the background once less than this many seconds of their validity is left
+TOKEN_REFRESH_MARGIN = 10 * 60
+# and never handed out with less than this left
+TOKEN_MIN_VALIDITY = 60
+JWT_VALIDITY = 10 * 60
+# how long a worker may hold the right to mint a token, and how long others wait for it before minting anyway
+MINT_LOCK_TIMEOUT = 30
+MINT_WAIT = 5
+
+
+# The app's JWT, which every installation's tokens are minted with
+class _JwtCache:
+    def __init__(self):
+        self.jwt: Optional[str] = None
+        self.expires_at = 0.0
+        self.lock = threading.Lock()
+
+
+_jwt_cache = _JwtCache()
+
+
+def get_installation_token(installation: Installation) -> Optional[str]:
+    cached = _get_cached(installation)
+    if cached:
+        if cached["expires_at"] - time.time() < TOKEN_REFRESH_MARGIN:
+            _schedule_refresh(installation)
+        return cached["token"]
+
+    return _mint_single_flight(installation)
+
+
+def refresh(installation: Installation) -> Optional[str]:
+    try:
+        return _mint(installation)
+    finally:
+        cache.delete(_refresh_key(installation))
+
+
+def _get_cached(installation: Installation) -> Optional[Dict]:
+    cached = cache.get(_token_key(installation))
+    if cached and cached["expires_at"] - time.time() > TOKEN_MIN_VALIDITY:
+        return cached
+    return None
+
+
+def _schedule_refresh(installation: Installation):
+    if cache.add(_refresh_key(installation), True, timeout=MINT_LOCK_TIMEOUT):
+        from sleuthpr.services.github.tasks import refresh_installation_token_task
+
+        logger.info(f"Installation token for {installation.remote_id} expires soon, refreshing")
+        refresh_installation_token_task.delay(installation.remote_id)
+
+
+# Only one worker mints a token at a time, the others wait for it to show up in the cache
+def _mint_single_flight(installation: Installation) -> Optional[str]:
+    lock_key = _mint_lock_key(installation)
+    deadline = time.monotonic() + MINT_WAIT
+    acquired = cache.add(lock_key, True, timeout=MINT_LOCK_TIMEOUT)
+    while not acquired and time.monotonic() < deadline:
+        time.sleep(0.1)
+        cached = _get_cached(installation)
+        if cached:
+            return cached["token"]
+        acquired = cache.add(lock_key, True, timeout=MINT_LOCK_TIMEOUT)
+
+    if not acquired:
+        logger.warning(f"Timed out waiting for the installation token of {installation.remote_id}, minting it")
+    try:
+        cached = _get_cached(installation)
+        if cached:
+            return cached["token"]
+        return _mint(installation)
+    finally:
+        if acquired:
+            cache.delete(lock_key)
+
+
+def _mint(installation: Installation) -> Optional[str]:
+    repository_ids = list(
+        installation.repositories.exclude(remote_id__isnull=True)
+        .exclude(remote_id="")
+        .values_list("remote_id", flat=True)
+    )
+    resp = api.session().post(
+        headers={
+            "Authorization": f"Bearer {_get_jwt()}",
+            "Accept": "application/vnd.github.v3+json,application/json",
+        },
+        url=f"{settings.GITHUB_API_URL}/app/installations/{installation.remote_id}/access_tokens",
+        json={"repository_ids": repository_ids},
+    )
+    if resp.status_code >= 300:
+        logger.error(f"Unable to get token: {resp.text}")
+        return None
+
+    data = resp.json()
+    expires_at = parser.parse(data["expires_at"]).timestamp()
+    cache.set(
+        _token_key(installation),
+        {"token": data["token"], "expires_at": expires_at},
+        timeout=max(int(expires_at - time.time() - TOKEN_MIN_VALIDITY), 1),
+    )
+    logger.info(f"Minted installation token for {installation.remote_id}")
+    return data["token"]
+
+
+def _get_jwt() -> str:
+    with _jwt_cache.lock:
+        if _jwt_cache.jwt is None or _jwt_cache.expires_at - time.time() < TOKEN_MIN_VALIDITY:
+            issued_at = int(time.time())
+            _jwt_cache.jwt = _gen_jwt(issued_at, issued_at + JWT_VALIDITY)
+            _jwt_cache.expires_at = issued_at + JWT_VALIDITY
+        return _jwt_cache.jwt
+
+
+def _gen_jwt(issued_at: int, expires_at: int) -> str:
+    private_key = os.getenv("GITHUB_APP_PRIVATE_KEY").replace("\\n", "\n")
+    return jwt.encode(
+        payload={
+            "iat": issued_at,
+            "exp": expires_at,
+            "iss": os.getenv("GITHUB_APP_ID"),
+        },
+        key=private_key,
+        algorithm="RS256",
+    ).decode()
+
+
+def _token_key(installation: Installation) -> str:
+    return f"installation_token.{installation.provider}.{installation.remote_id}"
+
+
+def _mint_lock_key(installation: Installation) -> str:
+    return f"{_token_key(installation)}.mint"
+
+
+def _refresh_key(installation: Installation) -> str:
+    return f"{_token_key(installation)}.refresh"
@@ -1,10 +1,15 @@
-import json
+import hashlib
+import hmac
 import logging
+import uuid
 
+from django.conf import settings
 from django.http import HttpResponse
 from django.views.decorators.csrf import csrf_exempt
 
-from sleuthpr.services.github.tasks import event_task
+from sleuthpr import lanes
+from sleuthpr.services.github import deliveries
+from sleuthpr.services.github.tasks import webhook_task
 
 logger = logging.getLogger(__name__)
 
@@ -12,14 +17,26 @@ logger = logging.getLogger(__name__)
 @csrf_exempt
 def on_event(request):
     event_name = request.headers.get("X-GitHub-Event")
-    # delivery_id = request.headers.get("X-GitHub-Delivery")
+    delivery_id = request.headers.get("X-GitHub-Delivery") or uuid.uuid4().hex
 
-    # todo: validate signature
+    if not _is_signed(request):
+        logger.warning(f"Rejected delivery {delivery_id} with an invalid signature")
+        return HttpResponse("Invalid signature", status=401)
 
-    body = request.body.decode()
-    data = json.loads(body)
-    logger.debug(f"event: {event_name}")
+    # the body is stored as is and only parsed by the worker
+    if not deliveries.record(delivery_id, event_name, request.body):
+        return HttpResponse("Duplicate", status=202)
+    logger.debug(f"event: {event_name}, delivery: {delivery_id}")
 
-    event_task.delay(event_name, data)
+    webhook_task.apply_async((delivery_id, event_name), queue=lanes.queue_for(lanes.lane_for(event_name)))
 
-    return HttpResponse(f"Event received! - {body}", status=202)
+    return HttpResponse("Accepted", status=202)
+
+
+def _is_signed(request) -> bool:
+    if not settings.GITHUB_WEBHOOK_SECRET:
+        return True
+
+    signature = request.headers.get("X-Hub-Signature-256", "")
+    expected = hmac.new(settings.GITHUB_WEBHOOK_SECRET.encode("utf8"), request.body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(signature, f"sha256={expected}")
@@ -1,12 +1,20 @@
 import logging
+from concurrent.futures import as_completed
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 from typing import Dict
+from typing import Iterable
 from typing import List
+from typing import Optional
 from typing import Set
 from typing import Tuple
 
 from django.db import transaction
 from django.db.models import Q
 
+from sleuthpr import lanes
 from sleuthpr.models import CheckStatus
 from sleuthpr.models import ExternalUser
 from sleuthpr.models import Installation
@@ -20,33 +28,84 @@ from sleuthpr.models import ReviewState
 from sleuthpr.services import external_users
 from sleuthpr.services import rules
 from sleuthpr.services.scm import Commit
+from sleuthpr.services.scm import PullRequestDetails
 from sleuthpr.triggers import BASE_BRANCH_UPDATED
 from sleuthpr.triggers import PR_CREATED
 from sleuthpr.triggers import PR_UPDATED
 from sleuthpr.triggers import REVIEW_UPDATED
 from sleuthpr.triggers import STATUS_UPDATED
+from sleuthpr.util import closing_connection
 from sleuthpr.util import dirty_set_all
 
 logger = logging.getLogger(__name__)
 
+# pull requests whose statuses and commits are loaded at the same time during a refresh
+REFRESH_WORKERS = 4
+REFRESH_PROGRESS_INTERVAL = 50
 
-def on_updated(installation: Installation, repository: Repository, pull_request: PullRequest):
+
+def on_updated(
+    installation: Installation,
+    repository: Repository,
+    pull_request: PullRequest,
+    details: Optional[PullRequestDetails] = None,
+):
     logger.info(f"Updated pull request: {pull_request.remote_id} on {repository.full_name}")
 
-    # refresh files and commits
-    refresh_commits(installation, repository, pull_request)
+    # refresh commits, statuses and reviews
+    hydrate(installation, repository, pull_request, details)
 
     rules.evaluate(repository, PR_UPDATED, {"pull_request": pull_request})
 
 
-def on_created(installation: Installation, repository: Repository, pull_request: PullRequest):
+def on_created(
+    installation: Installation,
+    repository: Repository,
+    pull_request: PullRequest,
+    details: Optional[PullRequestDetails] = None,
+):
     logger.info(f"Created pull request: {pull_request.remote_id} on {repository.full_name}")
-    # refresh files and commits
 
-    refresh_commits(installation, repository, pull_request)
+    # refresh commits, statuses and reviews
+    hydrate(installation, repository, pull_request, details)
+
     rules.evaluate(repository, PR_CREATED, {"pull_request": pull_request})
 
 
+# Brings the pull request's commits, statuses and review states up to date, from a single query where the
+# provider supports it
+def hydrate(
+    installation: Installation,
+    repository: Repository,
+    pull_request: PullRequest,
+    details: Optional[PullRequestDetails] = None,
+):
+    if details is None:
+        details = installation.client.get_pull_request_details(repository.identifier, int(pull_request.remote_id))
+    if details is None:
+        refresh_commits(installation, repository, pull_request)
+        return
+
+    if details.commits_since:
+        _attach_commits(repository, pull_request, details.commits)
+    else:
+        _set_commits(repository, pull_request, details.commits)
+
+    existing_statuses = {status.context: status for status in pull_request.statuses.all()}
+    for context, state in details.statuses:
+        status = existing_statuses.get(context)
+        if status:
+            if dirty_set_all(status, dict(state=str(state))):
+                status.save()
+        else:
+            PullRequestStatus.objects.create(pull_request=pull_request, context=context, state=state)
+
+    for review in pull_request.reviewers.select_related("user"):  # type: PullRequestReviewer
+        state = details.reviews.get(review.user.username)
+        if state and dirty_set_all(review, dict(state=state)):
+            review.save()
+
+
 def delete(repository: Repository, pull_request: PullRequest):
     pull_request.delete()
     logger.info(f"Deleted pull request: {pull_request.remote_id} on {repository.full_name}")
@@ -99,14 +158,59 @@ def on_source_change(installation: Installation, repository: Repository, name: s
 
 
 def refresh(installation: Installation, repository: Repository):
-    for pull_request in installation.client.get_pull_requests(repository):
-        for context, state in installation.client.get_statuses(repository.identifier, pull_request.source_sha):
-            status = PullRequestStatus.objects.create(pull_request=pull_request, context=context, state=state)
-            rules.evaluate(repository, STATUS_UPDATED, {"pull_request": pull_request, "status": status})
-
-        refresh_commits(installation, repository, pull_request)
-
-        rules.evaluate(repository, PR_CREATED, {"pull_request": pull_request})
+    loaded = refreshed = 0
+    with ThreadPoolExecutor(max_workers=REFRESH_WORKERS) as executor:
+        pending: Set[Future] = set()
+        for pull_request in installation.client.get_pull_requests(repository):
+            loaded += 1
+            pending.add(executor.submit(_fetch_refresh_data, installation, repository, pull_request))
+            # stop reading pages while the workers are behind, so only a few pull requests are held at once
+            if len(pending) >= REFRESH_WORKERS * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                refreshed = _apply_refresh_data(installation, repository, done, loaded, refreshed)
+
+        refreshed = _apply_refresh_data(installation, repository, pending, loaded, refreshed)
+
+    logger.info(f"Refreshed {refreshed} pull requests on {repository.full_name}")
+
+
+# Runs on the refresh workers, so leaves the pull requests to the refreshing thread.  Only the client touches the
+# database, e.g. when the token needs minting.
+@closing_connection
+def _fetch_refresh_data(
+    installation: Installation, repository: Repository, pull_request: PullRequest
+) -> Tuple[PullRequest, List[Tuple[str, CheckStatus]], List[Commit]]:
+    statuses = installation.client.get_statuses(repository.identifier, pull_request.source_sha)
+    commits = installation.client.get_pull_request_commits(repository.identifier, int(pull_request.remote_id))
+    return pull_request, statuses, commits
+
+
+# Refreshes are part of onboarding, so the rules they trigger are evaluated in the bulk lane
+def _apply_refresh_data(
+    installation: Installation, repository: Repository, futures: Iterable[Future], loaded: int, refreshed: int
+) -> int:
+    for future in as_completed(futures):
+        pull_request, statuses, commits = future.result()
+        # updated in place, as an onboarding that is retried refreshes the pull requests again
+        existing_statuses = {status.context: status for status in pull_request.statuses.all()}
+        for context, state in statuses:
+            status = existing_statuses.get(context)
+            if status:
+                if not dirty_set_all(status, dict(state=str(state))):
+                    continue
+                status.save()
+            else:
+                status = PullRequestStatus.objects.create(pull_request=pull_request, context=context, state=state)
+            rules.evaluate(repository, STATUS_UPDATED, {"pull_request": pull_request, "status": status}, lanes.BULK)
+
+        _set_commits(repository, pull_request, list(commits))
+
+        rules.evaluate(repository, PR_CREATED, {"pull_request": pull_request}, lanes.BULK)
+
+        refreshed += 1
+        if refreshed % REFRESH_PROGRESS_INTERVAL == 0:
+            logger.info(f"Refreshed {refreshed} of {loaded} loaded pull requests on {repository.full_name}")
+    return refreshed
 
 
 def refresh_commits(installation: Installation, repository: Repository, pull_request: PullRequest):
@@ -114,12 +218,40 @@ def refresh_commits(installation: Installation, repository: Repository, pull_req
     for commit in installation.client.get_pull_request_commits(repository.identifier, int(pull_request.remote_id)):
         all_commits.append(commit)
 
-    RepositoryCommit.objects.filter(pull_request=pull_request).update(pull_request=None)
+    _set_commits(repository, pull_request, all_commits)
+
+
+# Whether the pull request's commits were synced up to the given head
+def has_synced_head(repository: Repository, pr_id: str, sha: str) -> bool:
+    return (
+        repository.commits.filter(pull_request__remote_id=pr_id, pull_request__source_sha=sha, sha=sha)
+        .exclude(message__isnull=True, author__isnull=True)
+        .exists()
+    )
+
+
+# Only touches the rows of commits that were added to or dropped from the pull request since the last sync
+def _set_commits(repository: Repository, pull_request: PullRequest, all_commits: List[Commit]):
+    attached = RepositoryCommit.objects.filter(pull_request=pull_request).values_list("sha", "message", "author_id")
+    synced = {sha for sha, message, author_id in attached if message is not None or author_id is not None}
+    # e.g. commits force pushed away
+    dropped = {sha for sha, _, _ in attached} - {commit.sha for commit in all_commits}
+    if dropped:
+        RepositoryCommit.objects.filter(pull_request=pull_request, sha__in=dropped).update(pull_request=None)
+        logger.info(f"Detached {len(dropped)} commits no longer part of pull request {pull_request.remote_id}")
+
+    _attach_commits(repository, pull_request, [commit for commit in all_commits if commit.sha not in synced])
+
+
+def _attach_commits(repository: Repository, pull_request: PullRequest, commits: List[Commit]):
     chunk_size = 100
-    chunks: List[List[Commit]] = [all_commits[i : i + chunk_size] for i in range(0, len(all_commits), chunk_size)]
+    chunks: List[List[Commit]] = [commits[i : i + chunk_size] for i in range(0, len(commits), chunk_size)]
     for chunk in chunks:
-        changed_shas = add_commits(repository, chunk)
-        RepositoryCommit.objects.filter(sha__in=[sha for sha in changed_shas]).update(pull_request=pull_request)
+        add_commits(repository, chunk)
+        repository.commits.filter(sha__in=[commit.sha for commit in chunk]).exclude(pull_request=pull_request).update(
+            pull_request=pull_request
+        )
+    logger.info(f"Attached {len(commits)} commits to pull request {pull_request.remote_id}")
 
 
 @transaction.atomic
@@ -129,9 +261,9 @@ def add_commits(repository: Repository, commits: List[Commit]) -> Set[str]:
     links: List[Tuple] = []
     all_shas: List[str] = []
     for commit in commits:
+        all_shas.append(commit.sha)
         for parent in commit.parents:
             links.append((commit.sha, parent))
-            all_shas.append(commit.sha)
             all_shas.append(parent)
 
     logger.info(f"Passed links: {links}")
@@ -145,12 +277,7 @@ def add_commits(repository: Repository, commits: List[Commit]) -> Set[str]:
     for sha in {s for s in all_shas if s not in repo_commits}:
         commit = commits_by_child.get(sha, None)
         if commit:
-            author = external_users.get_or_create(
-                installation=repository.installation, name=commit.author_name, email=commit.author_email
-            )
-            committer = external_users.get_or_create(
-                installation=repository.installation, name=commit.author_name, email=commit.author_email
-            )
+            author, committer = _commit_users(repository, commit)
             message = commit.message
         else:
             message = author = committer = None
@@ -161,6 +288,17 @@ def add_commits(repository: Repository, commits: List[Commit]) -> Set[str]:
         repo_commits[repo_commit.sha] = repo_commit
         changed_shas.add(sha)
 
+    # Fill in commits only known as the parent of another one so far, i.e. from an earlier batch
+    for sha, repo_commit in repo_commits.items():
+        commit = commits_by_child.get(sha)
+        if commit and repo_commit.message is None and repo_commit.author_id is None:
+            author, committer = _commit_users(repository, commit)
+            repo_commit.message = commit.message
+            repo_commit.author = author
+            repo_commit.committer = committer
+            repo_commit.save(update_fields=["message", "author", "committer"])
+            changed_shas.add(sha)
+
     # Find existing RepositoryCommitParents
     saved_link_shas = {
         f"{c.child.sha}:{c.parent.sha}": c
@@ -181,3 +319,13 @@ def add_commits(repository: Repository, commits: List[Commit]) -> Set[str]:
 
     logger.info(f"Updated {len(changed_shas)} changed shas in the db")
     return changed_shas
+
+
+def _commit_users(repository: Repository, commit: Commit) -> Tuple[ExternalUser, ExternalUser]:
+    author = external_users.get_or_create(
+        installation=repository.installation, name=commit.author_name, email=commit.author_email
+    )
+    committer = external_users.get_or_create(
+        installation=repository.installation, name=commit.author_name, email=commit.author_email
+    )
+    return author, committer
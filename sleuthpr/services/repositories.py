@@ -2,8 +2,11 @@ import logging
 from typing import List
 from typing import Optional
 
+from celery import group
+from django.db.models import F
 from django.db.models import QuerySet
 
+from sleuthpr import lanes
 from sleuthpr.models import Installation
 from sleuthpr.models import Repository
 from sleuthpr.models import RepositoryIdentifier
@@ -17,16 +20,22 @@ def add(installation: Installation, repository_ids: List[RepositoryIdentifier]):
     if not repository_ids:
         raise ValueError("No repository_ids available for this installation")
 
+    existing = set(installation.repositories.values_list("full_name", flat=True))
+    added = []
     for repo in repository_ids:
-        repository = Repository.objects.create(
-            installation=installation,
-            full_name=repo.full_name,
-            remote_id=repo.remote_id,
+        if repo.full_name in existing:
+            logger.info(f"Repo {repo.full_name} already registered")
+            continue
+        added.append(
+            Repository.objects.create(
+                installation=installation,
+                full_name=repo.full_name,
+                remote_id=repo.remote_id,
+            )
         )
+        existing.add(repo.full_name)
 
-        rules.refresh(installation, repository)
-        pull_requests.refresh(installation, repository)
-        logger.info(f"Registered repo {repo.full_name}")
+    onboard(installation, added)
 
 
 def remove(installation: Installation, repository_ids: List[RepositoryIdentifier]):
@@ -34,14 +43,69 @@ def remove(installation: Installation, repository_ids: List[RepositoryIdentifier
         raise ValueError("No repository_ids available to remove")
 
     logger.info(f"Removing existing repositories {repository_ids} for the installation {installation.remote_id}")
-    Repository.objects.filter(installation=installation, full_name__in=repository_ids).delete()
-    logger.info(f"Deleted repos {repository_ids}")
+    full_names = [repo.full_name for repo in repository_ids]
+    Repository.objects.filter(installation=installation, full_name__in=full_names).delete()
+    logger.info(f"Deleted repos {full_names}")
 
 
 def set_repositories(installation: Installation, repository_ids: List[RepositoryIdentifier]):
-    logger.info(f"Removing existing repositories for the installation {installation.remote_id}")
-    Repository.objects.filter(installation=installation).delete()
-    return add(installation, repository_ids)
+    wanted = {repo.full_name: repo for repo in repository_ids}
+    existing = {repo.full_name: repo for repo in installation.repositories.all()}
+
+    # a repository with the same name but another remote id was recreated, so is onboarded again
+    replaced = [
+        RepositoryIdentifier(full_name=name)
+        for name, repo in existing.items()
+        if name not in wanted or _is_replaced(repo, wanted[name])
+    ]
+    if replaced:
+        remove(installation, replaced)
+
+    removed_names = {repo.full_name for repo in replaced}
+    added = [repo for name, repo in wanted.items() if name not in existing or name in removed_names]
+    logger.info(
+        f"Installation {installation.remote_id} has {len(added)} new and {len(replaced)} removed repositories, "
+        f"{len(wanted) - len(added)} unchanged"
+    )
+    if added:
+        add(installation, added)
+
+
+def _is_replaced(repository: Repository, repository_id: RepositoryIdentifier) -> bool:
+    return bool(repository.remote_id and repository_id.remote_id) and str(repository.remote_id) != str(
+        repository_id.remote_id
+    )
+
+
+# Onboards the repositories with a task each in the bulk lane, at most BULK_INSTALLATION_CONCURRENCY of an
+# installation at a time
+def onboard(installation: Installation, added: List[Repository]):
+    if not added:
+        return
+
+    from sleuthpr.tasks import onboard_repository_task
+
+    Installation.objects.filter(id=installation.id).update(onboarding_total=F("onboarding_total") + len(added))
+    logger.info(f"Onboarding {len(added)} repositories for the installation {installation.remote_id}")
+    queue = lanes.queue_for(lanes.BULK)
+    group(onboard_repository_task.si(repository.id).set(queue=queue) for repository in added).apply_async()
+
+
+def onboard_repository(installation: Installation, repository: Repository):
+    rules.refresh(installation, repository)
+    pull_requests.refresh(installation, repository)
+    logger.info(f"Registered repo {repository.full_name}")
+
+
+def record_onboarded(installation: Installation, failed: bool = False):
+    field = "onboarding_failed" if failed else "onboarding_completed"
+    Installation.objects.filter(id=installation.id).update(**{field: F(field) + 1})
+    installation.refresh_from_db(fields=["onboarding_total", "onboarding_completed", "onboarding_failed"])
+    if installation.onboarded:
+        logger.info(
+            f"Onboarded installation {installation.remote_id}: {installation.onboarding_completed} repositories, "
+            f"{installation.onboarding_failed} failed"
+        )
 
 
 def get_all(repository_id: RepositoryIdentifier) -> QuerySet[Repository]:
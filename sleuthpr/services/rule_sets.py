@@ -0,0 +1,173 @@
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from django.core.cache import cache
+from django.db.models import Prefetch
+
+from sleuthpr.models import Action
+from sleuthpr.models import Condition
+from sleuthpr.models import ConditionVariableType
+from sleuthpr.models import Repository
+from sleuthpr.models import Rule
+from sleuthpr.models import Trigger
+from sleuthpr.services.expression import ParsedExpression
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class CompiledCondition:
+    id: int
+    expression: str
+    description: str
+    line_number: int
+
+    @property
+    def parsed(self) -> ParsedExpression:
+        # parsed expressions hold compiled closures so aren't kept in the snapshot, the expression cache makes
+        # this cheap
+        return ParsedExpression(self.expression)
+
+
+@dataclass(frozen=True)
+class CompiledAction:
+    id: int
+    type: str
+    description: str
+    parameters: Dict
+    line_number: int
+
+
+@dataclass(frozen=True)
+class CompiledTrigger:
+    type: str
+    description: str
+    line_number: int
+
+
+@dataclass(frozen=True)
+class CompiledRule:
+    id: int
+    title: str
+    description: str
+    line_number: int
+    conditions: Tuple[CompiledCondition, ...]
+    actions: Tuple[CompiledAction, ...]
+    triggers: Tuple[CompiledTrigger, ...]
+
+    @property
+    def variables(self) -> List[ConditionVariableType]:
+        return [var for condition in self.conditions for var in condition.parsed.variables]
+
+
+# Everything needed to evaluate a repository's rules, built once per rules refresh
+@dataclass(frozen=True)
+class CompiledRuleSet:
+    repository_id: int
+    rules_hash: Optional[str]
+    rules: Tuple[CompiledRule, ...]
+    # trigger type key to the ids of the rules it triggers, in rule order
+    trigger_index: Dict[str, Tuple[int, ...]]
+
+    def for_trigger(self, trigger_type_key: str) -> List[CompiledRule]:
+        rule_ids = set(self.trigger_index.get(trigger_type_key, ()))
+        return [rule for rule in self.rules if rule.id in rule_ids]
+
+
+_snapshots: Dict[int, CompiledRuleSet] = {}
+_lock = threading.Lock()
+
+
+def get(repository: Repository) -> CompiledRuleSet:
+    # rules not loaded through a refresh have no hash to validate a snapshot against
+    if not repository.rules_hash:
+        return build(repository)
+
+    rule_set = _snapshots.get(repository.id)
+    if rule_set is not None and rule_set.rules_hash == repository.rules_hash:
+        return rule_set
+
+    rule_set = cache.get(_cache_key(repository.id, repository.rules_hash))
+    if rule_set is None:
+        logger.info(f"No rule set snapshot for repository {repository.id}, building it")
+        rule_set = build(repository)
+        cache.set(_cache_key(repository.id, repository.rules_hash), rule_set, timeout=None)
+
+    with _lock:
+        _snapshots[repository.id] = rule_set
+    return rule_set
+
+
+def store(rule_set: CompiledRuleSet):
+    if rule_set.rules_hash:
+        cache.set(_cache_key(rule_set.repository_id, rule_set.rules_hash), rule_set, timeout=None)
+    with _lock:
+        _snapshots[rule_set.repository_id] = rule_set
+
+
+def clear_cache():
+    with _lock:
+        _snapshots.clear()
+
+
+def build(repository: Repository) -> CompiledRuleSet:
+    rules: List[CompiledRule] = []
+    trigger_index: Dict[str, List[int]] = {}
+    for rule in repository.rules.order_by("order").prefetch_related(
+        Prefetch("conditions", queryset=Condition.objects.order_by("order")),
+        Prefetch("actions", queryset=Action.objects.order_by("order")),
+        Prefetch("triggers", queryset=Trigger.objects.order_by("id")),
+    ):
+        rules.append(_compile_rule(rule))
+        for trigger in rule.triggers.all():
+            rule_ids = trigger_index.setdefault(trigger.type, [])
+            if rule.id not in rule_ids:
+                rule_ids.append(rule.id)
+
+    return CompiledRuleSet(
+        repository_id=repository.id,
+        rules_hash=repository.rules_hash,
+        rules=tuple(rules),
+        trigger_index={key: tuple(rule_ids) for key, rule_ids in trigger_index.items()},
+    )
+
+
+def _compile_rule(rule: Rule) -> CompiledRule:
+    return CompiledRule(
+        id=rule.id,
+        title=rule.title,
+        description=rule.description,
+        line_number=rule.line_number,
+        conditions=tuple(
+            CompiledCondition(
+                id=condition.id,
+                expression=condition.expression,
+                description=condition.description,
+                line_number=condition.line_number,
+            )
+            for condition in rule.conditions.all()
+        ),
+        actions=tuple(
+            CompiledAction(
+                id=action.id,
+                type=action.type,
+                description=action.description,
+                parameters=action.parameters,
+                line_number=action.line_number,
+            )
+            for action in rule.actions.all()
+        ),
+        triggers=tuple(
+            CompiledTrigger(type=trigger.type, description=trigger.description, line_number=trigger.line_number)
+            for trigger in rule.triggers.all()
+        ),
+    )
+
+
+def _cache_key(repository_id: int, rules_hash: str) -> str:
+    return f"rule_sets.{repository_id}.{rules_hash}"
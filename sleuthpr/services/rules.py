@@ -1,28 +1,57 @@
+import hashlib
 import logging
+import threading
+from contextlib import contextmanager
 from dataclasses import dataclass
+from dataclasses import field
+from typing import Any
 from typing import Dict
 from typing import Iterable
 from typing import List
 from typing import Optional
 from typing import Set
+from typing import Tuple
 
 import strictyaml
-
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.db.models import prefetch_related_objects
+
+from sleuthpr import lanes
+from sleuthpr import lock
+from sleuthpr import partitions
 from sleuthpr import registry
 from sleuthpr.models import Action
 from sleuthpr.models import ActionResult
 from sleuthpr.models import CheckStatus
 from sleuthpr.models import Condition
+from sleuthpr.models import ConditionVariableType
 from sleuthpr.models import Installation
+from sleuthpr.models import PendingEvaluation
 from sleuthpr.models import PullRequest
 from sleuthpr.models import Repository
+from sleuthpr.models import RepositoryCommit
 from sleuthpr.models import Rule
 from sleuthpr.models import Trigger
 from sleuthpr.models import TriggerType
+from sleuthpr.services import rule_sets
+from sleuthpr.services.expression import EvaluationContext
 from sleuthpr.services.expression import ParsedExpression
+from sleuthpr.services.rule_sets import CompiledCondition
+from sleuthpr.services.rule_sets import CompiledRule
+from sleuthpr.services.scm import TransientOperationException
 
 logger = logging.getLogger(__name__)
 
+# Folded into the rule hashes, bump it when the way rules are loaded changes so they are all reloaded
+RULES_FORMAT_VERSION = 1
+# outlives any debounce window, so a lost scheduled evaluation doesn't hold up the next one for long
+DEBOUNCE_KEY_TIMEOUT = 5 * 60
+
+_replaying = threading.local()
+
 
 def refresh(installation: Installation, repository: Repository):
     contents = installation.client.get_content(repository.identifier, ".sleuth/rules.yml")
@@ -31,43 +60,145 @@ def refresh(installation: Installation, repository: Repository):
 
 
 def refresh_from_data(repository: Repository, data: str) -> List[Rule]:
-    doc_data = strictyaml.load(data)
+    rules_hash = _hash(data)
+    if repository.rules_hash == rules_hash:
+        logger.info("Rules unchanged, skipping refresh")
+        return list(repository.ordered_rules)
 
-    # clear out existing rules
-    repository.rules.all().delete()
+    # line numbers are counted from the first non-blank line
+    doc_data = strictyaml.load(data.lstrip("\n"))
 
-    rules: List[Rule] = []
+    # existing rules are kept if their source is unchanged so their check runs and action results survive
+    existing: Dict[str, List[Rule]] = {}
+    for rule in repository.ordered_rules:
+        existing.setdefault(rule.fingerprint, []).append(rule)
+
+    kept: List[Tuple[Rule, int]] = []
+    loaded: List[_LoadedRule] = []
     rules_data = doc_data.get("rules", [])
     for rule_data_orig in rules_data:
+        fingerprint = _hash(rule_data_orig.as_yaml())
+        unchanged = existing.get(fingerprint)
+        if unchanged:
+            kept.append((unchanged.pop(0), _start_line(rule_data_orig)))
+            continue
+
         rule_title = next(iter(rule_data_orig.keys()))
         rule_data = rule_data_orig.get(rule_title).value
         rule_description = rule_data.get("description").value if "description" in rule_data else ""
 
-        rule = Rule.objects.create(
+        rule = Rule(
             title=rule_title,
             description=rule_description,
             repository=repository,
-            order=len(rules),
-            line_number=rule_data_orig.start_line,
+            line_number=_start_line(rule_data_orig),
+            fingerprint=fingerprint,
         )
+        loaded.append(_LoadedRule(rule=rule, data=rule_data, conditions=_build_conditions(rule, rule_data)))
+
+    loaded = _validate(loaded)
+    for item in loaded:
+        item.actions = _build_actions(item.conditions, item.rule, item.data)
+        item.triggers = _build_triggers(item.conditions, item.rule, item.data)
+
+    # order the kept and new rules as they appear in the document
+    ordered = sorted(kept + [(item.rule, item.rule.line_number) for item in loaded], key=lambda item: item[1])
+    rules = [rule for rule, _ in ordered]
+    removed = [rule.id for unmatched in existing.values() for rule in unmatched]
+
+    with transaction.atomic():
+        # clear out rules that were changed or removed
+        if removed:
+            Rule.objects.filter(id__in=removed).delete()
+
+        for order, (rule, line_number) in enumerate(ordered):
+            if rule.pk:
+                _move_rule(rule, order=order, line_number=line_number)
+            else:
+                rule.order = order
 
-        conditions = _add_conditions(rule, rule_data)
-        if conditions is None:
-            rule.delete()
-            continue
-        else:
-            rules.append(rule)
+        _save_loaded_rules(repository, loaded)
 
-        _add_actions(conditions, rule, rule_data)
+        repository.rules_hash = rules_hash
+        repository.save(update_fields=["rules_hash"])
 
-        _add_triggers(conditions, rule, rule_data)
+    logger.info(f"Loaded {len(loaded)} rules, kept {len(kept)}, removed {len(removed)}")
 
-    logger.info(f"Loaded {len(rules)} rules")
+    rule_sets.store(rule_sets.build(repository))
 
     return rules
 
 
-def _add_triggers(conditions, rule, rule_data):
+@dataclass
+class _LoadedRule:
+    rule: Rule
+    data: Any
+    conditions: List[Condition]
+    actions: List[Action] = field(default_factory=list)
+    triggers: List[Trigger] = field(default_factory=list)
+
+
+def _validate(loaded: List[_LoadedRule]) -> List[_LoadedRule]:
+    valid: List[_LoadedRule] = []
+    for item in loaded:
+        try:
+            for condition in item.conditions:
+                ParsedExpression(condition.expression)
+        except Exception:
+            logger.warning(f"Invalid expression on line {condition.line_number}: {condition.expression}")
+            continue
+        valid.append(item)
+    return valid
+
+
+def _save_loaded_rules(repository: Repository, loaded: List[_LoadedRule]):
+    if not loaded:
+        return
+
+    Rule.objects.bulk_create([item.rule for item in loaded])
+    if any(item.rule.pk is None for item in loaded):
+        # not every database returns the primary keys from a bulk insert
+        ids = dict(repository.rules.filter(order__in=[item.rule.order for item in loaded]).values_list("order", "id"))
+        for item in loaded:
+            item.rule.pk = ids[item.rule.order]
+
+    for item in loaded:
+        # re-assign now the rule has a primary key
+        for child in (*item.conditions, *item.actions, *item.triggers):
+            child.rule = item.rule
+
+    Condition.objects.bulk_create([condition for item in loaded for condition in item.conditions])
+    Action.objects.bulk_create([action for item in loaded for action in item.actions])
+    Trigger.objects.bulk_create([trigger for item in loaded for trigger in item.triggers])
+
+
+def _start_line(item) -> int:
+    # strictyaml's start_line re-serializes the whole document on each call, so read the position the parser
+    # recorded for the sequence item instead
+    chunk = item._chunk
+    sequence = chunk.pointer.parent().get(chunk.whole_document)
+    line, _ = sequence.lc.item(chunk.pointer.last_index)
+    return line + 1
+
+
+def _hash(text: str) -> str:
+    return hashlib.sha256(f"{RULES_FORMAT_VERSION}:{text}".encode("utf8")).hexdigest()
+
+
+def _move_rule(rule: Rule, order: int, line_number: int):
+    delta = line_number - rule.line_number
+    if delta:
+        # the source of the rule is unchanged, so everything in it moved by the same number of lines
+        for related in (rule.conditions, rule.actions, rule.triggers):
+            related.update(line_number=F("line_number") + delta)
+    if delta or rule.order != order:
+        rule.order = order
+        rule.line_number = line_number
+        rule.save(update_fields=["order", "line_number"])
+
+
+def _build_triggers(conditions: List[Condition], rule: Rule, rule_data) -> List[Trigger]:
+    triggers: List[Trigger] = []
     trigger_types: Set[str] = set()
     if "triggers" in rule_data:
         trigger_types_map = {
@@ -77,7 +208,9 @@ def _add_triggers(conditions, rule, rule_data):
         for trigger_data, trigger_type in (
             item for item in trigger_types_map.items() if item[1] not in trigger_types
         ):
-            Trigger.objects.create(rule=rule, type=trigger_type, description="", line_number=trigger_data.start_line)
+            triggers.append(
+                Trigger(rule=rule, type=trigger_type, description="", line_number=_start_line(trigger_data))
+            )
             trigger_types.add(trigger_type)
     else:
         for condition in conditions:
@@ -88,16 +221,19 @@ def _add_triggers(conditions, rule, rule_data):
                 continue
             for var in exp.variables:
                 for trigger_type in (trig for trig in var.default_triggers if trig.key not in trigger_types):
-                    Trigger.objects.create(
-                        rule=rule,
-                        type=trigger_type.key,
-                        description=f"Implied from variable '{var.key}'",
-                        line_number=condition.line_number,
+                    triggers.append(
+                        Trigger(
+                            rule=rule,
+                            type=trigger_type.key,
+                            description=f"Implied from variable '{var.key}'",
+                            line_number=condition.line_number,
+                        )
                     )
                     trigger_types.add(trigger_type.key)
+    return triggers
 
 
-def _add_actions(conditions, rule, rule_data):
+def _build_actions(conditions: List[Condition], rule: Rule, rule_data) -> List[Action]:
     actions: List[Action] = []
     actions_data = rule_data.get("actions", [])
     used_conditions: Set[str] = {cond.expression for cond in conditions}
@@ -124,28 +260,30 @@ def _add_actions(conditions, rule, rule_data):
 
         for condition_str in (cond for cond in action_type.conditions if cond not in used_conditions):
             conditions.append(
-                Condition.objects.create(
+                Condition(
                     rule=rule,
                     description=f"Implied from action '{action_type.key}'",
                     expression=condition_str,
                     order=len(conditions),
-                    line_number=action_data.start_line,
+                    line_number=_start_line(action_data),
                 )
             )
             used_conditions.add(condition_str)
 
-        action = Action.objects.create(
-            rule=rule,
-            description=description,
-            parameters=parameters,
-            type=action_type.key,
-            order=len(actions),
-            line_number=action_data.start_line,
+        actions.append(
+            Action(
+                rule=rule,
+                description=description,
+                parameters=parameters,
+                type=action_type.key,
+                order=len(actions),
+                line_number=_start_line(action_data),
+            )
         )
-        actions.append(action)
+    return actions
 
 
-def _add_conditions(rule, rule_data):
+def _build_conditions(rule: Rule, rule_data) -> List[Condition]:
     conditions: List[Condition] = []
     conditions_data = rule_data.get("conditions", [])
     for condition_data_orig in conditions_data:
@@ -157,35 +295,35 @@ def _add_conditions(rule, rule_data):
             description = condition_data.get("description", "")
             expression = condition_data.get("expression")
 
-        try:
-            ParsedExpression(expression)
-        except Exception:
-            logger.warning(f"Invalid expression on line {condition_data_orig.start_line}: {expression}")
-            return None
-
-        condition = Condition.objects.create(
-            rule=rule,
-            description=description,
-            expression=expression,
-            order=len(conditions),
-            line_number=condition_data_orig.start_line,
+        conditions.append(
+            Condition(
+                rule=rule,
+                description=description,
+                expression=expression,
+                order=len(conditions),
+                line_number=_start_line(condition_data_orig),
+            )
         )
-        conditions.append(condition)
     return conditions
 
 
 @dataclass
 class EvaluatedCondition:
-    condition: Condition
+    condition: CompiledCondition
     evaluation: bool
 
 
 class EvaluatedRule:
-    def __init__(self, rule: Rule, conditions: List[EvaluatedCondition], results: List[ActionResult]):
+    def __init__(self, rule: CompiledRule, conditions: List[EvaluatedCondition], results: List[ActionResult]):
         self.conditions = conditions
         self.rule = rule
         self.id = rule.id
+        # one result per action of the rule, in the same order
         self.results = results
+        # results that have actually been recorded for the commit, keyed by action id
+        self.recorded_results: Dict[int, ActionResult] = {
+            result.action_id: result for result in results if result.pk is not None
+        }
         self.evaluation = CheckStatus.PENDING
         if results:
             for status in (CheckStatus(r.status) for r in results):
@@ -203,45 +341,266 @@ def evaluate_rules_no_execute(
     repository: Repository, context: Dict, rule: Optional[Rule] = None
 ) -> List[EvaluatedRule]:
     result = []
+    rules = list(rule_sets.get(repository).rules)
     if rule is not None:
-        rules: Iterable[Rule] = []
-    else:
-        rules: Iterable[Rule] = repository.ordered_rules
-
-    for rule in rules:
-        result.append(_evaluate_rule_no_execute(context, repository, rule))
+        rules = [compiled for compiled in rules if compiled.id == rule.id]
+
+    context = _as_evaluation_context(context)
+    with prefetched(rules, context):
+        commit = repository.commits.get(sha=context["pull_request"].source_sha)
+        action_results = _load_action_results(rules, commit)
+        for compiled in rules:
+            result.append(_evaluate_rule_no_execute(context, compiled, commit, action_results))
     return result
 
 
-def _evaluate_rule_no_execute(context, repository, rule) -> EvaluatedRule:
+def _evaluate_rule_no_execute(
+    context: EvaluationContext,
+    rule: CompiledRule,
+    commit: RepositoryCommit,
+    action_results: Dict[int, ActionResult],
+) -> EvaluatedRule:
     logger.info(f"[eval] Evaluating rule {rule.id}")
     conditions: List[EvaluatedCondition] = []
-    for condition in rule.ordered_conditions:
-        expression = ParsedExpression(condition.expression)
-        result = expression.execute(**context)
+    for condition in rule.conditions:
+        result = condition.parsed.evaluate(context)
         conditions.append(EvaluatedCondition(condition=condition, evaluation=result))
-    action_results = []
-    sha = repository.commits.get(sha=context.get("pull_request").source_sha)
-    for action in rule.ordered_actions.prefetch_related("results").all():  # type: Action
-        action_result = action.results.filter(commit=sha).first()
+    results = []
+    for action in rule.actions:
+        action_result = action_results.get(action.id)
         if not action_result:
-            action_result = ActionResult(action=action, commit=sha, status=CheckStatus.PENDING)
-        action_results.append(action_result)
-    return EvaluatedRule(rule, conditions, results=action_results)
+            action_result = ActionResult(action_id=action.id, commit=commit, status=CheckStatus.PENDING)
+        results.append(action_result)
+    return EvaluatedRule(rule, conditions, results=results)
+
+
+def _load_action_results(rules: List[CompiledRule], commit: RepositoryCommit) -> Dict[int, ActionResult]:
+    action_ids = [action.id for rule in rules for action in rule.actions]
+    if not action_ids:
+        return {}
+    results: Dict[int, ActionResult] = {}
+    for result in ActionResult.objects.filter(action_id__in=action_ids, commit=commit).order_by("id"):
+        results.setdefault(result.action_id, result)
+    return results
+
+
+def _save_action_results(results: List[ActionResult]):
+    existing = [result for result in results if result.pk]
+    if existing:
+        ActionResult.objects.bulk_update(existing, ["status", "message"])
+    created = [result for result in results if not result.pk]
+    if created:
+        ActionResult.objects.bulk_create(created)
+
+
+# The lane is the caller's, so the evaluations of e.g. an onboarding don't hold up the interactive ones
+def evaluate(repository: Repository, trigger_type: TriggerType, context: Dict, lane: str = lanes.INTERACTIVE):
+    if not rule_sets.get(repository).for_trigger(trigger_type.key):
+        return
+
+    pull_request: PullRequest = context["pull_request"]
+    replayed = _is_replaying()
+    _count(events=1)
+    if not settings.RULES_DEBOUNCE_WINDOW:
+        evaluate_triggers(repository, [trigger_type], _as_evaluation_context(context), replayed)
+        return
+
+    # the burst of events a push causes is evaluated once after the window, for all the triggers it fired.  Both
+    # the triggers and whether an evaluation is scheduled are kept in the database, so every worker sees them.
+    _add_pending(pull_request, {trigger_type.key: replayed})
+    scheduled = lock.get_backend().acquire(_scheduled_key(pull_request), DEBOUNCE_KEY_TIMEOUT)
+    if scheduled is not None:
+        _schedule_evaluation(pull_request, scheduled, lane)
+
+
+def _schedule_evaluation(pull_request: PullRequest, scheduled: int, lane: str):
+    from sleuthpr.tasks import evaluate_pull_request_task
+
+    repository = pull_request.repository
+    kwargs: Dict[str, Any] = dict(scheduled=scheduled, lane=lane)
+    queue = lanes.queue_for(lane)
+    # bulk work isn't ordered with the repository's events anyway, so it stays out of the partitions
+    if settings.REPOSITORY_PARTITIONS and lane == lanes.INTERACTIVE:
+        kwargs["partition"] = partitions.partition_for(repository.full_name)
+        queue = partitions.queue_name(kwargs["partition"])
+    evaluate_pull_request_task.apply_async(
+        (pull_request.id,), kwargs, queue=queue, countdown=settings.RULES_DEBOUNCE_WINDOW
+    )
+
+
+# Evaluates the rules of the triggers collected for the pull request since it was scheduled
+def evaluate_pending(pull_request: PullRequest, scheduled: Optional[int] = None):
+    # unscheduled first, so a trigger coming in from now on schedules another evaluation rather than being missed
+    if scheduled is not None:
+        lock.get_backend().release(_scheduled_key(pull_request), scheduled)
+    pending = _pop_pending(pull_request)
+    if not pending:
+        logger.info(f"No triggers pending for pull request {pull_request.remote_id}")
+        return
+
+    trigger_types = [registry.get_trigger_type(key) for key in sorted(pending)]
+    logger.info(f"Evaluating {[t.key for t in trigger_types]} for pull request {pull_request.remote_id}")
+    context = EvaluationContext(pull_request=pull_request)
+    try:
+        evaluate_triggers(pull_request.repository, trigger_types, context, all(pending.values()))
+    except TransientOperationException:
+        # pending again for when the task retries the evaluation
+        _add_pending(pull_request, pending)
+        raise
+    stats = coalescing_stats()
+    logger.info(f"Rules evaluated for {stats.events_per_evaluation:.1f} events per evaluation")
+
+
+# Only deletes the rows it read, a trigger that fired meanwhile stays pending
+@transaction.atomic
+def _pop_pending(pull_request: PullRequest) -> Dict[str, bool]:
+    pending = list(
+        PendingEvaluation.objects.select_for_update()
+        .filter(pull_request=pull_request)
+        .values_list("id", "trigger_type", "replayed")
+    )
+    PendingEvaluation.objects.filter(id__in=[id for id, _, _ in pending]).delete()
+    return {trigger_type: replayed for _, trigger_type, replayed in pending}
+
+
+# A trigger is only left replayed if every event firing it was
+def _add_pending(pull_request: PullRequest, triggers: Dict[str, bool]):
+    for trigger_type, replayed in triggers.items():
+        pending, created = PendingEvaluation.objects.get_or_create(
+            pull_request=pull_request, trigger_type=trigger_type, defaults=dict(replayed=replayed)
+        )
+        if not created and not replayed:
+            PendingEvaluation.objects.filter(id=pending.id, replayed=True).update(replayed=False)
+
+
+def evaluate_triggers(
+    repository: Repository, trigger_types: List[TriggerType], context: EvaluationContext, replayed: bool = False
+):
+    rule_set = rule_sets.get(repository)
+    rule_ids = {rule.id for trigger_type in trigger_types for rule in rule_set.for_trigger(trigger_type.key)}
+    rules = [rule for rule in rule_set.rules if rule.id in rule_ids]
+    if not rules:
+        return
+
+    _count(evaluations=1)
+    # the results of the actions executed by all the rules are written at once, also when one of them fails
+    executed: List[ActionResult] = []
+    with prefetched(rules, context):
+        commit = repository.commits.get(sha=context["pull_request"].source_sha)
+        action_results = _load_action_results(rules, commit)
+        try:
+            for rule in rules:
+                _evaluate_rule(repository, rule, context, commit, action_results, executed, replayed)
+        finally:
+            _save_action_results(executed)
+
+    if context.timings:
+        logger.info(f"Computed variables for {[t.key for t in trigger_types]}: {context.report()}")
+
+
+def _scheduled_key(pull_request: PullRequest) -> str:
+    return f"rules.scheduled.{pull_request.id}"
+
+
+@dataclass
+class CoalescingStats:
+    events: int = 0
+    evaluations: int = 0
+
+    @property
+    def events_per_evaluation(self) -> float:
+        return self.events / self.evaluations if self.evaluations else 0.0
+
+
+def coalescing_stats() -> CoalescingStats:
+    return CoalescingStats(
+        events=cache.get(_stats_key("events"), 0), evaluations=cache.get(_stats_key("evaluations"), 0)
+    )
+
+
+def reset_coalescing_stats():
+    cache.delete_many([_stats_key("events"), _stats_key("evaluations")])
+
+
+# counted in the cache, so the stats cover every worker
+def _count(**counts: int):
+    for name, value in counts.items():
+        key = _stats_key(name)
+        cache.add(key, 0, timeout=None)
+        cache.incr(key, value)
 
 
-def evaluate(repository: Repository, trigger_type: TriggerType, context: Dict):
-    rules = repository.rules.filter(triggers__type__contains=trigger_type.key).order_by("order").all()
-    for rule in rules:
-        _evaluate_rule(rule, context)
+def _stats_key(name: str) -> str:
+    return f"rules.stats.{name}"
 
 
-def _evaluate_rule(rule: Rule, context: Dict):
+# Marks the triggers fired meanwhile as replayed, i.e. by an event processed again such as a webhook delivery that
+# failed before, so the actions that already succeeded aren't repeated.  Events that merely look alike, e.g. two
+# reviews, are not replays.
+@contextmanager
+def replaying(replayed: bool = True):
+    previous = _is_replaying()
+    _replaying.value = replayed
+    try:
+        yield
+    finally:
+        _replaying.value = previous
+
+
+def _is_replaying() -> bool:
+    return getattr(_replaying, "value", False)
+
+
+def prefetch_plan(variables: Iterable[ConditionVariableType]) -> List[str]:
+    plan: List[str] = []
+    for var in variables:
+        plan.extend(lookup for lookup in var.prefetch if lookup not in plan)
+    return plan
+
+
+# Loads what the variables referenced by the rules need from the pull request in a handful of queries.  The
+# prefetched relations are dropped again afterwards so later changes to the pull request are seen.
+@contextmanager
+def prefetched(rules: List[CompiledRule], context: Dict):
+    pull_request: Optional[PullRequest] = context.get("pull_request")
+    if pull_request is None:
+        yield
+        return
+
+    plan = prefetch_plan(var for rule in rules for var in rule.variables)
+    _clear_prefetched(pull_request)
+    if plan:
+        logger.info(f"Prefetching {plan} for pull request {pull_request.remote_id}")
+        prefetch_related_objects([pull_request], *plan)
+    try:
+        yield
+    finally:
+        _clear_prefetched(pull_request)
+
+
+def _clear_prefetched(pull_request: PullRequest):
+    getattr(pull_request, "_prefetched_objects_cache", {}).clear()
+
+
+def _as_evaluation_context(context: Dict) -> EvaluationContext:
+    if isinstance(context, EvaluationContext):
+        return context
+    return EvaluationContext(context)
+
+
+def _evaluate_rule(
+    repository: Repository,
+    rule: CompiledRule,
+    context: EvaluationContext,
+    commit: RepositoryCommit,
+    action_results: Dict[int, ActionResult],
+    executed: List[ActionResult],
+    replayed: bool = False,
+):
     logger.info(f"[exec] Evaluating rule {rule.id} - {rule.title}")
-    repository = rule.repository
     installation = repository.installation
 
-    evaluated_rule = _evaluate_rule_no_execute(context, repository, rule=rule)
+    evaluated_rule = _evaluate_rule_no_execute(context, rule, commit, action_results)
 
     conditions_ok = True
     for evaluated_condition in evaluated_rule.conditions:
@@ -255,16 +614,24 @@ def _evaluate_rule(rule: Rule, context: Dict):
     if conditions_ok:
         logger.info("All conditions ok, executing actions")
 
-        head = pr.source_commit
-        for action in rule.actions.order_by("order").all():
+        for action, action_result in zip(rule.actions, evaluated_rule.results):
+            if replayed and action_result.pk and action_result.status == CheckStatus.SUCCESS:
+                logger.info(f"Action {action.type} already succeeded on {commit.sha}, skipping")
+                continue
             logger.info(f"Executing action {action.type} for {pr.remote_id}")
             action_type = registry.get_action_type(action.type)
             try:
                 result, message = action_type.execute(action, context)
+            except TransientOperationException:
+                # the whole evaluation is retried later rather than failing the action
+                raise
             except Exception as e:
                 result = CheckStatus.FAILURE
                 message = f"Error executing action: {e}"
-            _update_action_result(action, head, message, result)
+            action_result.status = result
+            action_result.message = message
+            evaluated_rule.recorded_results[action.id] = action_result
+            executed.append(action_result)
 
             if result != CheckStatus.SUCCESS:
                 logger.info(f"Action {action.type} failed on {pr.remote_id} with status {result}, aborting")
@@ -272,13 +639,4 @@ def _evaluate_rule(rule: Rule, context: Dict):
 
     from sleuthpr.services import checks
 
-    checks.update_checks_for_rule(installation, repository, pr, evaluated_rule=evaluated_rule)
-
-
-def _update_action_result(action, head, message, result):
-    existing_result = ActionResult.objects.filter(action=action, commit=head).first()
-    if not existing_result:
-        existing_result = ActionResult(action=action, commit=head)
-    existing_result.status = result
-    existing_result.message = message
-    existing_result.save()
+    checks.update_checks_for_rule(installation, repository, pr, evaluated_rule=evaluated_rule, context=context)
@@ -1,11 +1,18 @@
 from __future__ import annotations
 
+import logging
 from dataclasses import dataclass
+from dataclasses import field
+from typing import Dict
+from typing import Iterator
 from typing import List
 from typing import Optional
 from typing import Tuple
 from typing import TYPE_CHECKING
 
+import requests
+from django.conf import settings
+
 if TYPE_CHECKING:
     from sleuthpr.models import (
         Installation,
@@ -14,9 +21,13 @@ if TYPE_CHECKING:
         PullRequest,
         Repository,
         CheckStatus,
+        ReviewState,
     )
 
 
+logger = logging.getLogger(__name__)
+
+
 @dataclass
 class CheckDetails:
     title: str
@@ -25,6 +36,15 @@ class CheckDetails:
     status: CheckStatus
 
 
+# A check run to create, or to update when it already has a remote id
+@dataclass
+class CheckUpdate:
+    key: str
+    source_sha: str
+    details: CheckDetails
+    remote_check_id: Optional[str] = None
+
+
 @dataclass
 class Commit:
     sha: str
@@ -36,7 +56,29 @@ class Commit:
     parents: List[str]
 
 
+@dataclass
+class PullRequestDetails:
+    # the pull request in the shape of the provider's pull request event payloads
+    data: Dict
+    commits: List[Commit] = field(default_factory=list)
+    # status contexts of the head commit
+    statuses: List[Tuple[str, CheckStatus]] = field(default_factory=list)
+    # latest review state by reviewer username
+    reviews: Dict[str, ReviewState] = field(default_factory=dict)
+    # set when the commits are only the ones pushed on top of this sha rather than all of the pull request's
+    commits_since: Optional[str] = None
+
+
 def get_client(installation: Installation):
+    if installation.provider in ("github", "github_action") and settings.GITHUB_ASYNC_CLIENT:
+        from sleuthpr.services.github import aio
+
+        if aio.httpx is not None:
+            if installation.provider == "github":
+                return aio.GitHubAsyncInstallationClient(installation)
+            return aio.GitHubActionAsyncInstallationClient(installation)
+        logger.warning("GITHUB_ASYNC_CLIENT is set but httpx isn't installed, using the sync client")
+
     if installation.provider == "github":
         from sleuthpr.services.github import GitHubInstallationClient
 
@@ -53,6 +95,27 @@ class OperationException(Exception):
     pass
 
 
+# times a task is queued again for transient failures before it gives up, counted apart from its retries so they
+# don't use up the retries left for e.g. a held lock
+MAX_DEFERRALS = 20
+
+
+# A failure that passes on its own, so the operation is worth retrying after the delay
+class TransientOperationException(OperationException):
+    def __init__(self, message: str, delay: float):
+        super().__init__(message)
+        self.delay = delay
+
+
+# Whether the failure passes on its own, e.g. an exhausted rate limit, the network or a server error
+def is_transient(e: Exception) -> bool:
+    if isinstance(e, (TransientOperationException, requests.ConnectionError, requests.Timeout)):
+        return True
+    # e.g. PyGithub's exceptions
+    status = getattr(e, "status", None)
+    return isinstance(status, int) and status >= 500
+
+
 class InstallationClient:
     def get_repositories(self) -> List[RepositoryIdentifier]:
         pass
@@ -101,12 +164,26 @@ class InstallationClient:
     ):
         pass
 
-    def get_pull_requests(self, repository: Repository) -> List[PullRequest]:
+    # Yields the open pull requests, stored as they are loaded
+    def get_pull_requests(self, repository: Repository) -> Iterator[PullRequest]:
         pass
 
     def get_statuses(self, repository: RepositoryIdentifier, sha: str) -> List[Tuple[str, CheckStatus]]:
         pass
 
+    # Batch variant that clients able to make calls concurrently override
+    def save_checks(self, repository: RepositoryIdentifier, updates: List[CheckUpdate]) -> List[str]:
+        check_ids = []
+        for update in updates:
+            if update.remote_check_id:
+                self.update_check(
+                    repository, update.key, update.source_sha, update.details, remote_check_id=update.remote_check_id
+                )
+                check_ids.append(update.remote_check_id)
+            else:
+                check_ids.append(self.add_check(repository, update.key, update.source_sha, update.details))
+        return check_ids
+
     def comment_on_pull_request(
         self,
         repository: RepositoryIdentifier,
@@ -123,8 +200,24 @@ class InstallationClient:
     ) -> List[Commit]:
         pass
 
+    def get_pull_request_details(
+        self,
+        repository: RepositoryIdentifier,
+        pr_id: int,
+        with_commits: bool = True,
+    ) -> Optional[PullRequestDetails]:
+        pass
+
+    # The commits from base to head, or None if head doesn't simply follow on from base, e.g. after a force push
+    def compare_commits(self, repository: RepositoryIdentifier, base: str, head: str) -> Optional[List[Commit]]:
+        return None
+
     def get_source_url(self, repository: RepositoryIdentifier, path: str) -> str:
         pass
 
     def get_commits(self, repository: Repository, shas: List[str]) -> List[Commit]:
         pass
+
+    # Yields the commits in batches as they are loaded
+    def stream_commits(self, repository: Repository, shas: List[str]) -> Iterator[List[Commit]]:
+        yield self.get_commits(repository, shas)
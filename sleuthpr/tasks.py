@@ -0,0 +1,109 @@
+import logging
+from typing import Optional
+
+from celery import shared_task
+
+from sleuthpr import lanes
+from sleuthpr import lock
+from sleuthpr import partitions
+from sleuthpr.models import PullRequest
+from sleuthpr.models import Repository
+from sleuthpr.services import repositories
+from sleuthpr.services import rules
+from sleuthpr.services.scm import is_transient
+from sleuthpr.services.scm import MAX_DEFERRALS
+from sleuthpr.services.scm import TransientOperationException
+
+logger = logging.getLogger(__name__)
+
+# times a repository is onboarded before it is recorded as failed, and the first delay between them
+ONBOARDING_ATTEMPTS = 5
+ONBOARDING_BACKOFF = 30
+
+
+# a failure that passes on its own is retried after the delay it asks for or else with a growing backoff, the
+# repository is only recorded as failed once that ran out
+@shared_task(bind=True, max_retries=None)
+def onboard_repository_task(self, repository_id: int, attempt: int = 1):
+    repository = Repository.objects.filter(id=repository_id).select_related("installation").first()
+    if not repository:
+        logger.info(f"Repository {repository_id} was removed before it was onboarded")
+        return
+
+    installation = repository.installation
+    slot = lanes.acquire_slot(lanes.BULK, installation.remote_id)
+    if slot is None:
+        delay = lanes.RETRY_DELAYS[lanes.BULK]
+        logger.info(f"No free onboarding slot for {repository.full_name}, retrying in {delay}s")
+        raise self.retry(countdown=delay, queue=lanes.queue_for(lanes.BULK))
+
+    deferred: Optional[float] = None
+    try:
+        repositories.onboard_repository(installation, repository)
+    except Exception as e:
+        if not is_transient(e) or attempt >= ONBOARDING_ATTEMPTS:
+            logger.exception(f"Unable to onboard repository {repository.full_name}")
+            repositories.record_onboarded(installation, failed=True)
+            return
+        deferred = getattr(e, "delay", None) or ONBOARDING_BACKOFF * 2 ** (attempt - 1)
+        logger.warning(f"Onboarding {repository.full_name} failed, retrying in {deferred:.0f}s: {e}")
+    finally:
+        lanes.release_slot(slot)
+
+    if deferred is not None:
+        raise self.retry(kwargs=dict(attempt=attempt + 1), countdown=deferred, queue=lanes.queue_for(lanes.BULK))
+    repositories.record_onboarded(installation)
+
+
+# runs in the repository's partition or under its lock, like the events whose triggers it evaluates, and takes a slot
+# of its installation in the lane it was scheduled for
+@shared_task(default_retry_delay=3, max_retries=lock.DEFAULT_LEASE // 3)
+def evaluate_pull_request_task(pull_request_id: int, scheduled: Optional[int] = None, **kwargs):
+    pull_request = PullRequest.objects.filter(id=pull_request_id).select_related("repository__installation").first()
+    if not pull_request:
+        logger.info(f"Pull request {pull_request_id} was removed before its rules were evaluated")
+        return
+
+    lane = kwargs.get("lane", lanes.INTERACTIVE)
+    repository = pull_request.repository
+    installation_key = repository.installation.remote_id
+    if kwargs.get("partition") is not None:
+        partitions.run_in_order(
+            lane,
+            installation_key,
+            f"the evaluation of {pull_request.remote_id}",
+            lambda: rules.evaluate_pending(pull_request, scheduled),
+        )
+        return
+
+    queue = lanes.queue_for(lane)
+    slot = lanes.acquire_slot(lane, installation_key)
+    if slot is None:
+        logger.info(f"Installation {installation_key} has no free slot, retrying {pull_request.remote_id}")
+        evaluate_pull_request_task.retry(
+            args=(pull_request_id,),
+            kwargs=dict(kwargs, scheduled=scheduled),
+            countdown=lanes.RETRY_DELAYS[lane],
+            queue=queue,
+        )
+        return
+
+    try:
+        with lock.with_lock(lock.repository_lock_name(installation_key, repository.full_name)):
+            rules.evaluate_pending(pull_request, scheduled)
+    except TimeoutError:
+        logger.info(f"Lock of {repository.full_name} is held, retrying the evaluation of {pull_request.remote_id}")
+        evaluate_pull_request_task.retry(
+            args=(pull_request_id,), kwargs=dict(kwargs, scheduled=scheduled), queue=queue
+        )
+    except TransientOperationException as e:
+        deferrals = kwargs.get("deferrals", 0)
+        if deferrals >= MAX_DEFERRALS:
+            logger.error(f"Giving up on the evaluation of {pull_request.remote_id} after {deferrals} deferrals: {e}")
+            raise
+        logger.info(f"Deferring the evaluation of {pull_request.remote_id} by {e.delay:.0f}s: {e}")
+        evaluate_pull_request_task.apply_async(
+            (pull_request_id,), dict(kwargs, deferrals=deferrals + 1), countdown=e.delay, queue=queue
+        )
+    finally:
+        lanes.release_slot(slot)
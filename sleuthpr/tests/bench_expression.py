@@ -0,0 +1,66 @@
+"""
+Micro-benchmark comparing the interpreted (tree walking) and compiled evaluation of condition expressions.
+
+Not collected by default, run explicitly with:
+
+    pytest sleuthpr/tests/bench_expression.py -s
+"""
+import timeit
+
+from sleuthpr.models import TriState
+from sleuthpr.services.expression import ParsedExpression
+
+EXPRESSIONS = [
+    "var=2",
+    "var=3",
+    "list_var='foo'",
+    "list_var='baz'",
+    "list_var!='baz'",
+    "list_var=2",
+    "list_var>1",
+    "list_var>=2",
+    "list_var<3",
+    "list_var<=2",
+    "list_var!=3",
+    "var=2 or var=5",
+    "var=3 or var=5",
+    "var=2 and var=5",
+    "var=2 and var!=5",
+    "bool_var",
+    "bool_var and bool_var",
+    "bool_var or bool_var",
+    "bool_var=true or bool_var=false",
+    "tri_var=false",
+    "match_var~='f.*'",
+    "match_var~='b.*'",
+]
+
+ITERATIONS = 2000
+
+
+def test_benchmark_expressions(registry):
+    registry.add_var("var", lambda _: 2)
+    registry.add_var("list_var", lambda _: ["foo", "bar"])
+    registry.add_var("bool_var", lambda _: True)
+    registry.add_var("tri_var", lambda _: TriState.UNKNOWN)
+    registry.add_var("match_var", lambda _: "foo")
+
+    parsed = [ParsedExpression(text) for text in EXPRESSIONS]
+
+    def interpreted():
+        for exp in parsed:
+            exp.interpret()
+
+    def compiled():
+        for exp in parsed:
+            exp.execute()
+
+    interpreted_time = min(timeit.repeat(interpreted, number=ITERATIONS, repeat=5))
+    compiled_time = min(timeit.repeat(compiled, number=ITERATIONS, repeat=5))
+
+    evaluations = ITERATIONS * len(parsed)
+    print()
+    print(f"{len(parsed)} expressions x {ITERATIONS} iterations")
+    print(f"interpreted: {interpreted_time * 1e9 / evaluations:.0f} ns/evaluation")
+    print(f"compiled:    {compiled_time * 1e9 / evaluations:.0f} ns/evaluation")
+    print(f"speedup:     {interpreted_time / compiled_time:.2f}x")
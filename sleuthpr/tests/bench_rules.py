@@ -0,0 +1,55 @@
+"""
+Benchmark loading a generated rules document with hundreds of rules.
+
+Not collected by default, run explicitly with:
+
+    pytest sleuthpr/tests/bench_rules.py -s
+"""
+import time
+
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from sleuthpr.services.rules import refresh_from_data
+from sleuthpr.tests.factories import RepositoryFactory
+
+NUMBER_OF_RULES = 500
+
+
+def _generate_rules(count: int) -> str:
+    data = "rules:\n"
+    for i in range(count):
+        data += f"""  - rule-{i}:
+      description: "Generated rule {i}"
+      conditions:
+        - description: "Lots of reviewers"
+          expression: "number_reviewers>{i % 5}"
+        - "label='label-{i}' or title~='.*{i}.*'"
+      actions:
+        - add_pull_request_label: "label-{i}"
+        - merge_pull_request
+"""
+    return data
+
+
+@pytest.mark.django_db
+def test_benchmark_load_rules():
+    repository = RepositoryFactory()
+    data = _generate_rules(NUMBER_OF_RULES)
+
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        rules = refresh_from_data(repository, data)
+        duration = time.perf_counter() - start
+
+    assert NUMBER_OF_RULES == len(rules)
+    print()
+    print(f"Loaded {len(rules)} rules in {duration:.2f}s with {len(queries)} queries")
+
+    changed = data.replace("label-0", "label-zero")
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        refresh_from_data(repository, changed)
+        duration = time.perf_counter() - start
+    print(f"Reloaded with one rule changed in {duration:.2f}s with {len(queries)} queries")
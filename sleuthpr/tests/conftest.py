@@ -0,0 +1,32 @@
+from typing import Callable
+from typing import Union
+from unittest.mock import patch
+
+import pytest
+
+from sleuthpr.models import ConditionVariableType
+from sleuthpr.services.expression import clear_cache
+
+
+class StubRegistry:
+    _vars = {}
+
+    def get_condition_variable_type(self, key):
+        return self._vars[key]
+
+    def add_var(self, key: str, expression: Union[Callable, ConditionVariableType]):
+        if not isinstance(expression, ConditionVariableType):
+            expression = ConditionVariableType(key, f"Variable {key}", type(expression({})), [], expression)
+
+        self._vars[key] = expression
+
+
+@pytest.fixture
+def registry():
+
+    stub = StubRegistry()
+    stub.add_var("var", lambda _: 2)
+    clear_cache()
+    with patch("sleuthpr.services.expression.registry", new=stub):
+        yield stub
+    clear_cache()
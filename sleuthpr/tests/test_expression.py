@@ -1,38 +1,11 @@
-from typing import Callable
-from typing import Union
-from unittest.mock import patch
-
-import pytest
-
-from sleuthpr.models import ConditionVariableType
 from sleuthpr.models import TriState
+from sleuthpr.services import expression
+from sleuthpr.services.expression import EvaluationContext
 from sleuthpr.services.expression import ParsedExpression
 
 # pylint: disable=redefined-outer-name
 
 
-class StubRegistry:
-    _vars = {}
-
-    def get_condition_variable_type(self, key):
-        return self._vars[key]
-
-    def add_var(self, key: str, expression: Union[Callable, ConditionVariableType]):
-        if not isinstance(expression, ConditionVariableType):
-            expression = ConditionVariableType(key, f"Variable {key}", type(expression({})), [], expression)
-
-        self._vars[key] = expression
-
-
-@pytest.fixture
-def registry():
-
-    stub = StubRegistry()
-    stub.add_var("var", lambda _: 2)
-    with patch("sleuthpr.services.expression.registry", new=stub):
-        yield stub
-
-
 def test_expression(registry):
 
     exp = ParsedExpression("var=2")
@@ -117,3 +90,50 @@ def test_match(registry):
 
     assert not ParsedExpression("match_var~='b.*'").execute()
     assert ParsedExpression("match_var~='f.*'").execute()
+
+
+def test_cache(registry):
+    exp = ParsedExpression("var=2")
+    info = expression.cache_info()
+    assert 1 == info.misses
+
+    cached = ParsedExpression(" var=2 ")
+    assert cached.expression is exp.expression
+    assert {"var"} == {var.key for var in cached.variables}
+    assert cached.execute()
+    assert info.hits + 1 == expression.cache_info().hits
+    assert 1 == expression.cache_info().misses
+
+
+def test_compiled_matches_interpreted(registry):
+    registry.add_var("list_var", lambda _: ["foo", "bar"])
+    registry.add_var("match_var", lambda _: "foo")
+    registry.add_var("bool_var", lambda _: TriState.UNKNOWN)
+
+    for text in (
+        "var=2",
+        "var=3",
+        "var=2 or var=5",
+        "var=2 and var=5",
+        "(var=3 or var>1) and list_var='foo'",
+        "list_var<=2 and list_var!='baz'",
+        "match_var~='f.*'",
+        "bool_var",
+        "bool_var=false",
+    ):
+        exp = ParsedExpression(text)
+        assert exp.interpret() == exp.execute(), text
+
+
+def test_evaluation_context(registry):
+    calls = []
+    registry.add_var("counted_var", lambda _: calls.append(1) or 2)
+    calls.clear()
+
+    ctx = EvaluationContext()
+    assert ParsedExpression("counted_var=2").evaluate(ctx)
+    assert ParsedExpression("counted_var>1 and counted_var<3").evaluate(ctx)
+    assert not ParsedExpression("counted_var=3").evaluate(ctx)
+
+    assert 1 == len(calls)
+    assert {"counted_var"} == set(ctx.timings.keys())
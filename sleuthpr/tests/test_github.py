@@ -1,13 +1,53 @@
+import base64
+import hashlib
+import hmac
 import json
+import re
+import threading
+import time
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
 from os.path import dirname
 from os.path import join
+from types import SimpleNamespace
 
 import pytest
+from django.core.cache import cache
+from django.urls import reverse
+from django.utils.timezone import now
 
+from sleuthpr import util
+from sleuthpr.models import CheckStatus
+from sleuthpr.models import DeliveryStatus
+from sleuthpr.models import PullRequestStatus
+from sleuthpr.models import RateLimitState
+from sleuthpr.models import ReviewState
 from sleuthpr.models import TriState
+from sleuthpr.models import WebhookDelivery
+from sleuthpr.services import pull_requests
+from sleuthpr.services import repositories
+from sleuthpr.services.github import aio
+from sleuthpr.services.github import api
+from sleuthpr.services.github import deliveries
+from sleuthpr.services.github import events
+from sleuthpr.services.github import rate_limit
+from sleuthpr.services.github import scm
+from sleuthpr.services.github import tasks
+from sleuthpr.services.github import tokens
 from sleuthpr.services.github.events import _update_pull_request
+from sleuthpr.services.github.rate_limit import Priority
+from sleuthpr.services.github.rate_limit import RateLimiter
+from sleuthpr.services.github.rate_limit import RateLimitExceeded
+from sleuthpr.services.scm import CheckDetails
+from sleuthpr.services.scm import CheckUpdate
+from sleuthpr.tests.factories import InstallationFactory
 from sleuthpr.tests.factories import RepositoryFactory
 
+# pylint: disable=redefined-outer-name
+
 
 @pytest.mark.django_db
 def test_update_pull_request():
@@ -32,3 +72,670 @@ def test_update_pull_request():
     pr, dirty = _update_pull_request(repository.installation, repository, data)
 
     assert not dirty
+
+
+class _CountingServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _StubHandler)
+        self.connections = 0
+        self.requests = []
+        self.bodies = []
+        self.token_lifetime = timedelta(hours=1)
+        # responses to pop per graphql query, or a function building one from the request body
+        self.graphql = []
+        self.contents = {}
+        # statuses and headers to answer the next requests with before succeeding
+        self.failures = []
+        # seconds to hold every response, to see how many requests are in flight at once
+        self.delay = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._in_flight_lock = threading.Lock()
+
+    def track(self, change: int):
+        with self._in_flight_lock:
+            self.in_flight += change
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        super().process_request(request, client_address)
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _respond(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        request_body = json.loads(self.rfile.read(length)) if length else None
+        self.server.bodies.append(request_body)
+        self.server.requests.append((self.command, self.path))
+        self.server.track(1)
+        time.sleep(self.server.delay)
+        self.server.track(-1)
+        if self.server.failures:
+            status, headers = self.server.failures.pop(0)
+            body = json.dumps({"message": "You have exceeded a secondary rate limit"}).encode("utf8")
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.path == "/graphql":
+            graphql = self.server.graphql
+            data = graphql(request_body) if callable(graphql) else graphql.pop(0)
+        elif self.path.endswith("/access_tokens"):
+            expires_at = datetime.now(timezone.utc) + self.server.token_lifetime
+            data = {"token": f"token-{len(self.server.requests)}", "expires_at": expires_at.isoformat()}
+        else:
+            data = {"id": 1}
+        body = json.dumps(data).encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = _respond
+    do_PATCH = _respond
+
+    def do_GET(self):
+        self.server.requests.append((self.command, self.path))
+        self.server.track(1)
+        time.sleep(self.server.delay)
+        self.server.track(-1)
+        content = self.server.contents.get(self.path.split("?")[0])
+        etag = f'"{hash(json.dumps(content))}"'
+        if content is None:
+            self.send_response(404)
+            body = b'{"message": "Not Found"}'
+        elif self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            body = b""
+        else:
+            self.send_response(200)
+            self.send_header("ETag", etag)
+            body = json.dumps(content).encode("utf8")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_github(settings, monkeypatch):
+    server = _CountingServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    settings.GITHUB_API_URL = f"http://127.0.0.1:{server.server_port}"
+    settings.GITHUB_TOKEN = "token"
+    api.reset_session()
+    api.reset_conditional_cache_stats()
+    aio.reset()
+    rate_limit.reset()
+    cache.clear()
+    monkeypatch.setattr(tokens, "_jwt_cache", tokens._JwtCache())
+    yield server
+    api.reset_session()
+    aio.reset()
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.django_db
+def test_client_reuses_connections(stub_github):
+    installation = InstallationFactory(provider="github_action")
+    repository = RepositoryFactory(installation=installation, full_name="sleuth-io/sleuth-pr")
+    details = CheckDetails(title="title", summary="summary", body="body", status=CheckStatus.SUCCESS)
+
+    assert installation.client is installation.client
+    client = installation.client
+    client.add_label(repository.identifier, 1, "one")
+    client.add_label(repository.identifier, 1, "two")
+    check_id = client.add_check(repository.identifier, "key", "sha", details)
+    client.update_check(repository.identifier, "key", "sha", details, check_id)
+
+    assert 4 == len(stub_github.requests)
+    assert ("PATCH", "/repos/sleuth-io/sleuth-pr/check-runs/1") == stub_github.requests[-1]
+    assert 1 == stub_github.connections
+
+
+@pytest.mark.django_db
+def test_installation_token(stub_github, monkeypatch):
+    jwts = []
+    monkeypatch.setattr(tokens, "_gen_jwt", lambda issued_at, expires_at: jwts.append(issued_at) or "jwt")
+    installation = InstallationFactory()
+    RepositoryFactory(installation=installation, remote_id="42")
+    RepositoryFactory(installation=installation, remote_id=None)
+
+    assert "token-1" == tokens.get_installation_token(installation)
+    assert "token-1" == tokens.get_installation_token(installation)
+    assert 1 == len(stub_github.requests)
+    assert {"repository_ids": ["42"]} == stub_github.bodies[0]
+
+    # a token close to expiry is still used while a fresh one is minted in the background
+    cache.clear()
+    stub_github.token_lifetime = timedelta(seconds=tokens.TOKEN_REFRESH_MARGIN - 60)
+    assert "token-2" == tokens.get_installation_token(installation)
+    assert "token-2" == tokens.get_installation_token(installation)
+    assert "token-3" == tokens.get_installation_token(installation)
+    assert 4 == len(stub_github.requests)
+    assert 1 == len(jwts)
+
+
+@pytest.mark.django_db
+def test_installation_token_single_flight(stub_github, monkeypatch):
+    monkeypatch.setattr(tokens, "_gen_jwt", lambda issued_at, expires_at: "jwt")
+    installation = InstallationFactory()
+
+    # another worker is minting the token
+    cache.add(tokens._mint_lock_key(installation), True)
+
+    def _minted():
+        time.sleep(0.2)
+        cache.set(tokens._token_key(installation), {"token": "minted", "expires_at": time.time() + 3600})
+
+    thread = threading.Thread(target=_minted)
+    thread.start()
+    assert "minted" == tokens.get_installation_token(installation)
+    thread.join()
+    assert [] == stub_github.requests
+
+
+@pytest.mark.django_db
+def test_pull_request_details(stub_github):
+    installation = InstallationFactory(provider="github_action")
+    repository = RepositoryFactory(installation=installation, full_name="octocat/Hello-World")
+    with open(join(dirname(__file__), "pr_graphql.json")) as f:
+        stub_github.graphql = json.load(f)
+
+    details = installation.client.get_pull_request_details(repository.identifier, 1347)
+    assert 2 == len(stub_github.requests)
+    assert [None, "cursor1"] == [body["variables"]["cursor"] for body in stub_github.bodies]
+    assert ["sha1", "sha2"] == [commit.sha for commit in details.commits]
+    assert [("ci/build", CheckStatus.SUCCESS), ("ci/deploy", CheckStatus.PENDING)] == details.statuses
+
+    pr, dirty = _update_pull_request(installation, repository, details.data)
+    pull_requests.hydrate(installation, repository, pr, details)
+
+    assert "1347" == pr.remote_id
+    assert "sha2" == pr.source_sha
+    assert TriState.TRUE == pr.conflict
+    assert ["bug"] == [label.value for label in pr.labels.all()]
+    assert ["hubot"] == [assignee.user.username for assignee in pr.assignees.all()]
+    assert [ReviewState.APPROVED] == [reviewer.state for reviewer in pr.reviewers.all()]
+    assert {"sha1", "sha2"} == {commit.sha for commit in pr.commits.all()}
+    assert {"ci/build": CheckStatus.SUCCESS, "ci/deploy": CheckStatus.PENDING} == {
+        status.context: status.state for status in pr.statuses.all()
+    }
+    assert 2 == len(stub_github.requests)
+
+
+@pytest.mark.django_db
+def test_pull_request_synchronize_loads_new_commits(stub_github):
+    installation = InstallationFactory(provider="github_action")
+    repository = RepositoryFactory(installation=installation, full_name="octocat/Hello-World")
+    with open(join(dirname(__file__), "pr_graphql.json")) as f:
+        pages = json.load(f)
+    stub_github.graphql = list(pages)
+    events.on_pr_updated(installation, repository, dict(number=1347))
+    assert {"sha1", "sha2"} == {commit.sha for commit in repository.commits.filter(pull_request__remote_id="1347")}
+
+    pushed = json.loads(json.dumps(pages[1]))
+    pushed["data"]["repository"]["pullRequest"]["headRefOid"] = "sha3"
+    del pushed["data"]["repository"]["pullRequest"]["commits"]
+    stub_github.graphql = [pushed]
+    stub_github.contents["/repos/octocat/Hello-World/compare/sha2...sha3"] = dict(
+        status="ahead",
+        total_commits=1,
+        commits=[
+            dict(
+                sha="sha3",
+                commit=dict(
+                    message="message sha3",
+                    author=dict(name="Bob", email="bob@example.com"),
+                    committer=dict(name="Bob", email="bob@example.com"),
+                ),
+                parents=[dict(sha="sha2")],
+            )
+        ],
+    )
+    stub_github.requests.clear()
+    stub_github.bodies.clear()
+
+    events.on_pr_updated(installation, repository, dict(number=1347, head=dict(sha="sha3")), before="sha2")
+
+    assert [("GET", "/repos/octocat/Hello-World/compare/sha2...sha3"), ("POST", "/graphql")] == stub_github.requests
+    assert [False] == [body["variables"]["withCommits"] for body in stub_github.bodies if body]
+    pr = repository.pull_requests.get(remote_id="1347")
+    assert "sha3" == pr.source_sha
+    assert {"sha1", "sha2", "sha3"} == {commit.sha for commit in pr.commits.all()}
+    assert "message sha3" == pr.commits.get(sha="sha3").message
+    assert repository.commit_tree.filter(child__sha="sha3", parent__sha="sha2").exists()
+
+    # a head the commits weren't synced for loads all of them again
+    assert not pull_requests.has_synced_head(repository, "1347", "sha9")
+
+    # as does a push merging the base in, whose commits the comparison lists too
+    compared = stub_github.contents["/repos/octocat/Hello-World/compare/sha2...sha3"]
+    merge = json.loads(json.dumps(compared))
+    merge["commits"][0].update(sha="sha4", parents=[dict(sha="sha3"), dict(sha="base1")])
+    stub_github.contents["/repos/octocat/Hello-World/compare/sha3...sha4"] = merge
+    stub_github.graphql = list(pages)
+    stub_github.bodies.clear()
+    events.on_pr_updated(installation, repository, dict(number=1347, head=dict(sha="sha4")), before="sha3")
+    assert [True, True] == [body["variables"]["withCommits"] for body in stub_github.bodies if body]
+
+    # or a push to a retargeted pull request
+    assert pull_requests.has_synced_head(repository, "1347", "sha2")
+    stub_github.contents["/repos/octocat/Hello-World/compare/sha2...sha5"] = compared
+    stub_github.graphql = list(pages)
+    stub_github.bodies.clear()
+    data = dict(number=1347, head=dict(sha="sha5"), base=dict(ref="retargeted"))
+    events.on_pr_updated(installation, repository, data, before="sha2")
+    assert [True, True] == [body["variables"]["withCommits"] for body in stub_github.bodies if body]
+
+
+@pytest.mark.django_db
+def test_conditional_requests(stub_github, settings):
+    installation = InstallationFactory(provider="github_action")
+    repository = RepositoryFactory(installation=installation, full_name="sleuth-io/sleuth-pr")
+    path = "/repos/sleuth-io/sleuth-pr/contents/.sleuth/rules.yml"
+
+    def _set_rules(text: str):
+        stub_github.contents[path] = dict(
+            type="file",
+            encoding="base64",
+            path=".sleuth/rules.yml",
+            content=base64.b64encode(text.encode("utf8")).decode("utf8"),
+        )
+
+    _set_rules("rules: []")
+    assert "rules: []" == installation.client.get_content(repository.identifier, ".sleuth/rules.yml")
+    assert "rules: []" == installation.client.get_content(repository.identifier, ".sleuth/rules.yml")
+    _set_rules("rules: [changed]")
+    assert "rules: [changed]" == installation.client.get_content(repository.identifier, ".sleuth/rules.yml")
+    assert installation.client.get_content(repository.identifier, ".sleuth/other.yml") is None
+
+    # the cached responses outlive the installation's token
+    settings.GITHUB_TOKEN = "rotated"
+    assert "rules: [changed]" == installation.client.get_content(repository.identifier, ".sleuth/rules.yml")
+
+    stats = api.conditional_cache_stats()
+    assert (2, 2, 1) == (stats.hits, stats.misses, stats.uncacheable)
+    assert 2 / 4 == stats.hit_rate
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # a clock that only moves when the rate limiter sleeps
+    clock = dict(now=1000.0, sleeps=[])
+
+    def _sleep(delay):
+        clock["sleeps"].append(delay)
+        clock["now"] += delay
+
+    monkeypatch.setattr(rate_limit, "_clock", lambda: clock["now"])
+    monkeypatch.setattr(rate_limit, "_sleep", _sleep)
+    return clock
+
+
+def test_rate_limiter_priorities(clock):
+    limiter = RateLimiter()
+    now = 1000.0
+    headers = {"X-RateLimit-Limit": "100", "X-RateLimit-Remaining": "21", "X-RateLimit-Reset": "1600"}
+    assert limiter.observe(200, headers, now=now) is None
+
+    # low priority calls leave a fifth of the quota to the others
+    assert 0 == limiter.reserve(Priority.LOW, now=now)
+    assert 600 == limiter.reserve(Priority.LOW, now=now)
+    assert 0 == limiter.reserve(Priority.NORMAL, now=now)
+    with pytest.raises(RateLimitExceeded):
+        limiter.acquire(Priority.LOW)
+
+    limiter.remaining = 1
+    assert 600 == limiter.reserve(Priority.NORMAL, now=now)
+    assert 0 == limiter.reserve(Priority.HIGH, now=now)
+    assert 600 == limiter.reserve(Priority.HIGH, now=now)
+
+    # the quota comes back at the reset
+    assert 0 == limiter.reserve(Priority.LOW, now=1600)
+    assert 99 == limiter.remaining
+
+
+def test_rate_limiter_backoff():
+    limiter = RateLimiter()
+    delay = limiter.observe(429, {"Retry-After": "4"}, now=1000)
+    assert 4 <= delay <= 6
+    assert delay == pytest.approx(limiter.reserve(Priority.HIGH, now=1000))
+
+    limiter = RateLimiter()
+    first = limiter.observe(403, {}, "You have triggered an abuse detection mechanism", now=2000)
+    second = limiter.observe(403, {}, "You have triggered an abuse detection mechanism", now=2000)
+    assert 1 <= first <= 1.5
+    assert 2 <= second <= 3
+    assert limiter.observe(403, {}, "Resource not accessible by integration", now=2000) is None
+    assert 0 == limiter.failures
+
+
+@pytest.mark.django_db
+def test_rate_limiter_shared_between_workers(clock):
+    rate_limit.reset()
+    limiter = rate_limit.get_limiter("123")
+    headers = {"X-RateLimit-Limit": "100", "X-RateLimit-Remaining": "50", "X-RateLimit-Reset": "1600"}
+    limiter.observe(200, headers, now=1000)
+    rate_limit.sync("123")
+
+    # another worker got rate limited meanwhile
+    RateLimitState.objects.filter(installation_key="123").update(remaining=10, blocked_until=1100)
+    rate_limit.sync("123")
+    assert 50 == limiter.remaining
+    clock["now"] += rate_limit.SYNC_INTERVAL
+    rate_limit.sync("123")
+    assert 10 == limiter.remaining
+    assert 1100 - clock["now"] == limiter.reserve(Priority.HIGH)
+
+    # and the quota this worker saw is shared with the others
+    limiter.observe(429, {"Retry-After": "500"}, now=clock["now"])
+    rate_limit.sync("123", force=True)
+    assert RateLimitState.objects.get(installation_key="123").blocked_until >= clock["now"] + 500
+    rate_limit.reset()
+
+
+@pytest.mark.django_db
+def test_rate_limited_event_is_deferred(monkeypatch):
+    repository = RepositoryFactory(full_name="sleuth-io/sleuth-pr")
+    calls = []
+
+    def _process(*args):
+        calls.append(args)
+        if len(calls) == 1:
+            raise RateLimitExceeded(600)
+
+    monkeypatch.setattr(tasks, "_process_repository_event", _process)
+    apply_async = tasks.process_repository_task.apply_async
+    queued = []
+    monkeypatch.setattr(
+        tasks.process_repository_task,
+        "apply_async",
+        lambda *args, **kwargs: queued.append((args, kwargs)) or apply_async(*args, **kwargs),
+    )
+    tasks._dispatch_repository_event("push", None, {}, repository.installation.remote_id, "sleuth-io/sleuth-pr")
+
+    assert 2 == len(calls)
+    # queued again with a budget of its own rather than retried
+    assert 600 == queued[1][1]["countdown"]
+    assert 1 == queued[1][0][1]["deferrals"]
+
+
+@pytest.mark.django_db
+def test_deferrals_are_bounded(monkeypatch, caplog):
+    repository = RepositoryFactory(full_name="sleuth-io/sleuth-pr")
+    calls = []
+
+    def _process(*args):
+        calls.append(args)
+        raise RateLimitExceeded(600)
+
+    monkeypatch.setattr(tasks, "_process_repository_event", _process)
+    monkeypatch.setattr(tasks, "MAX_DEFERRALS", 2)
+    tasks._dispatch_repository_event("push", None, {}, repository.installation.remote_id, "sleuth-io/sleuth-pr")
+
+    assert 3 == len(calls)
+    assert "Giving up on push of sleuth-io/sleuth-pr after 2 deferrals" in caplog.text
+
+
+@pytest.mark.django_db
+def test_client_raises_when_rate_limited_too_long(stub_github, clock):
+    installation = InstallationFactory(provider="github_action")
+    repository = RepositoryFactory(installation=installation, full_name="sleuth-io/sleuth-pr")
+    stub_github.failures = [(429, {"Retry-After": "600"})]
+
+    with pytest.raises(RateLimitExceeded):
+        installation.client.add_label(repository.identifier, 1, "one")
+    assert 1 == len(stub_github.requests)
+
+
+@pytest.mark.django_db
+def test_client_backs_off_when_rate_limited(stub_github, clock):
+    installation = InstallationFactory(provider="github_action")
+    repository = RepositoryFactory(installation=installation, full_name="sleuth-io/sleuth-pr")
+    stub_github.failures = [
+        (429, {"Retry-After": "1"}),
+        (403, {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "1010"}),
+    ]
+
+    installation.client.add_label(repository.identifier, 1, "one")
+
+    assert 3 == len(stub_github.requests)
+    assert 2 == len(clock["sleeps"])
+    assert 1 <= clock["sleeps"][0] <= 1.5
+    assert clock["now"] >= 1010
+
+
+@pytest.mark.django_db
+def test_get_commits_in_batches(stub_github, monkeypatch):
+    monkeypatch.setattr(scm, "COMMITS_BATCH_SIZE", 2)
+    installation = InstallationFactory(provider="github_action")
+    repository = RepositoryFactory(installation=installation, full_name="sleuth-io/sleuth-pr")
+
+    def commits(body):
+        objects = {}
+        for sha in re.findall(r"c_(\w+): object", body["query"]):
+            objects[f"c_{sha}"] = (
+                None
+                if sha == "missing"
+                else {
+                    "oid": sha,
+                    "message": f"message {sha}",
+                    "author": {"name": "Bob", "email": "bob@example.com"},
+                    "committer": {"name": "Bob", "email": "bob@example.com"},
+                    "parents": {"edges": [{"node": {"oid": f"{sha}parent"}}]},
+                }
+            )
+        return {"data": {"repository": objects}}
+
+    stub_github.graphql = commits
+
+    batches = list(installation.client.stream_commits(repository, ["sha1", "sha2", "sha3", "missing", "sha5"]))
+
+    assert 3 == len(stub_github.requests)
+    assert [1, 1, 2] == sorted(len(batch) for batch in batches)
+    assert ["sha1", "sha2", "sha3", "sha5"] == sorted(commit.sha for batch in batches for commit in batch)
+
+
+@pytest.mark.django_db
+def test_async_client(stub_github, settings):
+    pytest.importorskip("httpx")
+    settings.GITHUB_ASYNC_CLIENT = True
+    settings.GITHUB_ASYNC_CONCURRENCY = 2
+    stub_github.delay = 0.1
+    installation = InstallationFactory(provider="github_action")
+    repository = RepositoryFactory(installation=installation, full_name="sleuth-io/sleuth-pr")
+    client = installation.client
+    assert isinstance(client, aio.GitHubActionAsyncInstallationClient)
+
+    details = CheckDetails(title="title", summary="summary", body="body", status=CheckStatus.SUCCESS)
+    updates = [
+        CheckUpdate(key="one", source_sha="sha", details=details),
+        CheckUpdate(key="two", source_sha="sha", details=details, remote_check_id="7"),
+        CheckUpdate(key="three", source_sha="sha", details=details),
+        CheckUpdate(key="four", source_sha="sha", details=details, remote_check_id="9"),
+    ]
+    assert [1, "7", 1, "9"] == client.save_checks(repository.identifier, updates)
+    assert 4 == len(stub_github.requests)
+    assert 2 == stub_github.max_in_flight
+    assert {
+        ("POST", "/repos/sleuth-io/sleuth-pr/check-runs"),
+        ("PATCH", "/repos/sleuth-io/sleuth-pr/check-runs/7"),
+        ("PATCH", "/repos/sleuth-io/sleuth-pr/check-runs/9"),
+    } == set(stub_github.requests)
+
+    # the next batch is sent over the connections the first one opened
+    stub_github.delay = 0
+    assert ["7"] == client.save_checks(repository.identifier, updates[1:2])
+    assert 2 == stub_github.connections
+
+
+@pytest.mark.django_db
+def test_refresh_pull_requests(stub_github, monkeypatch):
+    monkeypatch.setattr(pull_requests, "REFRESH_WORKERS", 1)
+    installation = InstallationFactory(provider="github_action")
+    repository = RepositoryFactory(installation=installation, full_name="sleuth-io/sleuth-pr")
+    _stub_pull_requests(stub_github)
+    closed = []
+    monkeypatch.setattr(util, "connection", SimpleNamespace(close=lambda: closed.append(threading.current_thread())))
+
+    pull_requests.refresh(installation, repository)
+
+    # by the workers, each for its own connection
+    assert 3 == len(closed)
+    assert threading.current_thread() not in closed
+    assert ["1", "2", "3"] == sorted(pr.remote_id for pr in repository.pull_requests.all())
+    for pr in repository.pull_requests.all():
+        assert [("ci/build", CheckStatus.SUCCESS)] == [(status.context, status.state) for status in pr.statuses.all()]
+        assert f"message {pr.remote_id}" == pr.commits.get(sha=pr.source_sha).message
+
+
+@pytest.mark.django_db
+def test_onboarding_again_updates_statuses(stub_github):
+    installation = InstallationFactory(provider="github_action")
+    repository = RepositoryFactory(installation=installation, full_name="sleuth-io/sleuth-pr")
+    _stub_pull_requests(stub_github)
+
+    # e.g. an onboarding retried after a transient failure
+    repositories.onboard_repository(installation, repository)
+    stub_github.contents["/repos/sleuth-io/sleuth-pr/commits/head1/status"] = {
+        "statuses": [{"context": "ci/build", "state": "failure"}]
+    }
+    repositories.onboard_repository(installation, repository)
+
+    statuses = PullRequestStatus.objects.filter(pull_request__repository=repository)
+    assert 3 == statuses.count()
+    assert CheckStatus.FAILURE == statuses.get(pull_request__remote_id="1").state
+
+
+def _stub_pull_requests(stub_github):
+    with open(join(dirname(__file__), "pr.json")) as f:
+        data = json.load(f)
+
+    pulls = []
+    for number in (1, 2, 3):
+        sha = f"head{number}"
+        pulls.append(dict(data, number=number, head=dict(data["head"], sha=sha)))
+        stub_github.contents[f"/repos/sleuth-io/sleuth-pr/commits/{sha}/status"] = {
+            "statuses": [{"context": "ci/build", "state": "success"}]
+        }
+        stub_github.contents[f"/repos/sleuth-io/sleuth-pr/pulls/{number}/commits"] = [
+            {
+                "sha": sha,
+                "message": f"message {number}",
+                "author": {"name": "Bob", "email": "bob@example.com"},
+                "committer": {"name": "Bob", "email": "bob@example.com"},
+                "parents": [{"sha": "base"}],
+            }
+        ]
+    stub_github.contents["/repos/sleuth-io/sleuth-pr/pulls"] = pulls
+
+
+@pytest.mark.django_db
+def test_webhook_enqueues_delivery(client, settings, monkeypatch):
+    settings.GITHUB_WEBHOOK_SECRET = "secret"
+    body = json.dumps({"zen": "Design for failure."}).encode("utf8")
+    signature = "sha256=" + hmac.new(b"secret", body, hashlib.sha256).hexdigest()
+    processed = []
+
+    def event_task(event_name, data, **kwargs):
+        assert WebhookDelivery.objects.filter(delivery_id="delivery-1").exists()
+        processed.append((event_name, data))
+
+    monkeypatch.setattr(tasks, "event_task", event_task)
+
+    headers = dict(HTTP_X_GITHUB_EVENT="ping", HTTP_X_GITHUB_DELIVERY="delivery-1")
+    response = client.post(
+        reverse("event"), data=body, content_type="application/json", HTTP_X_HUB_SIGNATURE_256="sha256=0", **headers
+    )
+    assert 401 == response.status_code
+    assert not processed
+
+    response = client.post(
+        reverse("event"), data=body, content_type="application/json", HTTP_X_HUB_SIGNATURE_256=signature, **headers
+    )
+    assert 202 == response.status_code
+    assert b"Accepted" == response.content
+    assert [("ping", {"zen": "Design for failure."})] == processed
+    delivery = WebhookDelivery.objects.get(delivery_id="delivery-1")
+    assert DeliveryStatus.PROCESSED == delivery.status
+    assert b"" == bytes(delivery.payload)
+
+
+@pytest.mark.django_db
+def test_webhook_drops_redeliveries(client, settings, monkeypatch):
+    settings.GITHUB_WEBHOOK_SECRET = None
+    cache.clear()
+    processed = []
+
+    def event_task(event_name, data, replayed):
+        processed.append((event_name, replayed))
+        if len(processed) == 1:
+            raise ValueError("boom")
+
+    monkeypatch.setattr(tasks, "event_task", event_task)
+
+    def deliver():
+        return client.post(
+            reverse("event"),
+            data="{}",
+            content_type="application/json",
+            HTTP_X_GITHUB_EVENT="ping",
+            HTTP_X_GITHUB_DELIVERY="delivery-1",
+        )
+
+    # a failed delivery can be redelivered, a processed one can't
+    deliver()
+    assert 202 == deliver().status_code
+    assert b"Duplicate" == deliver().content
+    # the redelivery is a replay of the failed one, so its actions that succeeded aren't repeated
+    assert [("ping", False), ("ping", True)] == processed
+
+    # a delivery enqueued twice only runs once
+    WebhookDelivery.objects.create(delivery_id="delivery-2", event_name="ping", payload=b"{}")
+    tasks.webhook_task("delivery-2", "ping")
+    tasks.webhook_task("delivery-2", "ping")
+    assert 3 == len(processed)
+    assert {DeliveryStatus.PROCESSED} == set(WebhookDelivery.objects.values_list("status", flat=True))
+
+
+@pytest.mark.django_db
+def test_sweep_deliveries(monkeypatch):
+    processed = []
+    monkeypatch.setattr(tasks, "event_task", lambda event_name, data, **kwargs: processed.append(event_name))
+    long_ago = now() - timedelta(seconds=deliveries.STALE_AFTER + 1)
+
+    def delivery(delivery_id, **kwargs):
+        return WebhookDelivery.objects.create(
+            delivery_id=delivery_id, event_name=delivery_id, payload=b"{}", updated_on=long_ago, **kwargs
+        )
+
+    delivery("failed", status=DeliveryStatus.FAILED, attempts=1)
+    delivery("lost", status=DeliveryStatus.PROCESSING, attempts=1)
+    delivery("given-up", status=DeliveryStatus.FAILED, attempts=deliveries.MAX_ATTEMPTS)
+    delivery("expired", status=DeliveryStatus.PROCESSED, on=now() - timedelta(seconds=deliveries.DELIVERY_TTL + 1))
+    WebhookDelivery.objects.create(delivery_id="queued", event_name="queued", payload=b"{}")
+
+    tasks.sweep_deliveries_task()
+
+    assert ["failed", "lost"] == sorted(processed)
+    assert {
+        "failed": DeliveryStatus.PROCESSED,
+        "lost": DeliveryStatus.PROCESSED,
+        "given-up": DeliveryStatus.FAILED,
+        "queued": DeliveryStatus.PENDING,
+    } == dict(WebhookDelivery.objects.values_list("delivery_id", "status"))
@@ -0,0 +1,152 @@
+import json
+import time
+from unittest.mock import patch
+
+import pytest
+from django.core.cache import cache
+from django.urls import reverse
+
+from sleuthpr import lanes
+from sleuthpr import tasks as sleuthpr_tasks
+from sleuthpr.services import rules
+from sleuthpr.services.github import tasks
+from sleuthpr.services.github import view
+from sleuthpr.tests.factories import PullRequestFactory
+from sleuthpr.tests.factories import RepositoryFactory
+from sleuthpr.triggers import PR_CREATED
+
+
+def test_lane_for():
+    assert lanes.INTERACTIVE == lanes.lane_for("pull_request_review")
+    assert lanes.INTERACTIVE == lanes.lane_for("check_run")
+    assert lanes.BULK == lanes.lane_for("installation")
+    assert lanes.BULK == lanes.lane_for("installation_repositories")
+
+
+@pytest.mark.django_db
+def test_installation_slots(settings):
+    settings.BULK_INSTALLATION_CONCURRENCY = 2
+    settings.INTERACTIVE_INSTALLATION_CONCURRENCY = 1
+
+    first = lanes.acquire_slot(lanes.BULK, "1")
+    second = lanes.acquire_slot(lanes.BULK, "1")
+    assert first and second and first.name != second.name
+    assert lanes.acquire_slot(lanes.BULK, "1") is None
+    assert lanes.acquire_slot(lanes.BULK, "2") is not None
+    # the lanes don't share their slots
+    assert lanes.acquire_slot(lanes.INTERACTIVE, "1") is not None
+    assert lanes.acquire_slot(lanes.INTERACTIVE, "1") is None
+
+    lanes.release_slot(first)
+    assert first.name == lanes.acquire_slot(lanes.BULK, "1").name
+
+
+@pytest.mark.django_db
+def test_webhook_routed_to_lane(client, settings):
+    settings.GITHUB_WEBHOOK_SECRET = None
+    settings.BULK_QUEUE = "bulk-queue"
+    cache.clear()
+
+    with patch.object(view, "webhook_task") as task:
+        for delivery_id, event_name in (("delivery-1", "status"), ("delivery-2", "installation_repositories")):
+            client.post(
+                reverse("event"),
+                data=json.dumps({}),
+                content_type="application/json",
+                HTTP_X_GITHUB_EVENT=event_name,
+                HTTP_X_GITHUB_DELIVERY=delivery_id,
+            )
+
+    assert ["interactive", "bulk-queue"] == [call[1]["queue"] for call in task.apply_async.call_args_list]
+
+
+@pytest.mark.django_db
+def test_event_without_free_slot_is_retried(settings):
+    settings.INTERACTIVE_INSTALLATION_CONCURRENCY = 1
+    repository = RepositoryFactory(full_name="sleuth-io/sleuth-pr")
+    installation_id = repository.installation.remote_id
+    held = lanes.acquire_slot(lanes.INTERACTIVE, installation_id)
+    acquire_slot = lanes.acquire_slot
+
+    # the other task of the installation finishes once the event found no free slot
+    def _busy_once(*args, **kwargs):
+        slot = acquire_slot(*args, **kwargs)
+        if slot is None:
+            lanes.release_slot(held)
+        return slot
+
+    with patch.object(lanes, "acquire_slot", side_effect=_busy_once) as acquire, patch.object(
+        tasks, "_process_repository_event"
+    ) as process:
+        tasks._dispatch_repository_event("push", None, {}, installation_id, "sleuth-io/sleuth-pr")
+
+    assert 2 == acquire.call_count
+    process.assert_called_once()
+
+
+@pytest.mark.django_db
+def test_partitioned_event_waits_for_slot(settings, monkeypatch):
+    settings.REPOSITORY_PARTITIONS = 2
+    settings.INTERACTIVE_INSTALLATION_CONCURRENCY = 1
+    monkeypatch.setattr(lanes, "SLOT_POLL_INTERVAL", 0.01)
+    repository = RepositoryFactory(full_name="sleuth-io/sleuth-pr")
+    installation_id = repository.installation.remote_id
+    held = lanes.acquire_slot(lanes.INTERACTIVE, installation_id)
+    sleep = time.sleep
+
+    def _sleep(delay):
+        lanes.release_slot(held)
+        sleep(delay)
+
+    monkeypatch.setattr(time, "sleep", _sleep)
+    with patch.object(tasks, "_process_repository_event") as process:
+        tasks._dispatch_repository_event("push", None, {}, installation_id, "sleuth-io/sleuth-pr")
+
+    process.assert_called_once()
+    # the slot was taken and given back again
+    assert lanes.acquire_slot(lanes.INTERACTIVE, installation_id) is not None
+
+
+@pytest.mark.django_db
+def test_bulk_evaluation_stays_in_its_lane(settings):
+    settings.REPOSITORY_PARTITIONS = 2
+    settings.BULK_QUEUE = "bulk-queue"
+    settings.BULK_INSTALLATION_CONCURRENCY = 1
+    repository = RepositoryFactory(full_name="sleuth-io/sleuth-pr")
+    pr = PullRequestFactory(repository=repository)
+    rules.refresh_from_data(
+        repository,
+        """
+rules:
+  - label-everything:
+      triggers:
+        - pr_created
+      actions:
+        - add_pull_request_label: "one"
+""",
+    )
+
+    with patch.object(sleuthpr_tasks.evaluate_pull_request_task, "apply_async") as apply_async:
+        rules.evaluate(repository, PR_CREATED, {"pull_request": pr}, lanes.BULK)
+    args, kwargs = apply_async.call_args
+    assert "bulk-queue" == kwargs["queue"]
+    assert lanes.BULK == args[1]["lane"]
+    assert "partition" not in args[1]
+
+    # and waits for a slot of the installation in it, like the onboarding filling it
+    held = lanes.acquire_slot(lanes.BULK, repository.installation.remote_id)
+    acquire_slot = lanes.acquire_slot
+
+    def _busy_once(*args, **kwargs):
+        slot = acquire_slot(*args, **kwargs)
+        if slot is None:
+            lanes.release_slot(held)
+        return slot
+
+    with patch.object(lanes, "acquire_slot", side_effect=_busy_once) as acquire, patch.object(
+        rules, "evaluate_pending"
+    ) as evaluate_pending:
+        sleuthpr_tasks.evaluate_pull_request_task.apply_async((pr.id,), args[1])
+
+    assert [lanes.BULK, lanes.BULK] == [call[0][0] for call in acquire.call_args_list]
+    evaluate_pending.assert_called_once()
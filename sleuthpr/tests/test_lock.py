@@ -0,0 +1,142 @@
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+
+from sleuthpr import lock
+from sleuthpr.lock import CacheLockBackend
+from sleuthpr.lock import DatabaseLockBackend
+from sleuthpr.lock import LocalLockBackend
+from sleuthpr.models import LockLease
+from sleuthpr.services.github import tasks
+from sleuthpr.tests.factories import RepositoryFactory
+
+
+@pytest.fixture(autouse=True)
+def clear_locks():
+    cache.clear()
+    lock.reset_backend()
+    yield
+    lock.reset_backend()
+
+
+# Runs the release script against the tests' cache, in place of Redis
+class FakeRedis:
+    def eval(self, script, numkeys, key, token):
+        name = key.split(":", 2)[2]
+        if cache.get(name) != token:
+            return 0
+        cache.delete(name)
+        return 1
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("backend", [LocalLockBackend, DatabaseLockBackend, CacheLockBackend])
+def test_lock_backend(backend, monkeypatch):
+    # the tests' cache is process local, which is all it takes here
+    monkeypatch.setattr(lock, "_redis_client", lambda _: FakeRedis())
+    backend = backend()
+
+    first = backend.acquire("repo", lease=10)
+    assert first is not None
+    assert backend.acquire("repo", lease=10) is None
+    assert backend.acquire("other", lease=10) is not None
+    assert backend.is_held("repo", first)
+
+    assert backend.release("repo", first)
+    assert not backend.release("repo", first)
+    second = backend.acquire("repo", lease=10)
+    assert second > first
+
+    # an expired lease can be taken over, after which the old holder can't release it
+    backend.release("repo", second)
+    expired = backend.acquire("repo", lease=0.05)
+    time.sleep(0.1)
+    assert not backend.is_held("repo", expired)
+    third = backend.acquire("repo", lease=10)
+    assert third is not None and third > expired
+    assert not backend.release("repo", expired)
+    assert backend.is_held("repo", third)
+
+
+def test_cache_backend_needs_shared_cache():
+    with pytest.raises(ImproperlyConfigured):
+        CacheLockBackend()
+
+
+@pytest.mark.django_db
+def test_database_backend_deletes_leases():
+    backend = DatabaseLockBackend()
+    first = backend.acquire("repo", lease=10)
+    backend.release("repo", first)
+    assert not LockLease.objects.exists()
+    # tokens keep increasing after the row is created again
+    assert backend.acquire("repo", lease=10) > first
+
+    backend.acquire("expired", lease=0)
+    assert lock.delete_expired_leases() == 1
+    assert list(LockLease.objects.values_list("name", flat=True)) == ["repo"]
+
+
+def test_local_backend_forgets_released_locks():
+    backend = LocalLockBackend()
+    for index in range(10):
+        backend.release(f"repo-{index}", backend.acquire(f"repo-{index}", lease=10))
+    assert not backend._leases
+
+
+def test_with_lock(settings):
+    settings.LOCK_BACKEND = "sleuthpr.lock.LocalLockBackend"
+
+    with lock.with_lock("repo", requested_at=time.time() - 2) as lease:
+        assert lock.is_held(lease)
+        errors = []
+
+        def _other_thread():
+            try:
+                with lock.with_lock("repo"):
+                    pass
+            except TimeoutError as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=_other_thread)
+        thread.start()
+        thread.join()
+        assert 1 == len(errors)
+
+        # the thread holding the lock can take it again
+        with lock.with_lock("repo") as reentered:
+            assert lease == reentered
+        assert lock.is_held(lease)
+    assert not lock.is_held(lease)
+
+    stats = lock.lock_stats("repo")
+    assert (1, 1) == (stats.acquired, stats.busy)
+    assert stats.average_wait >= 2
+    assert stats.hold_ms >= 0
+
+
+@pytest.mark.django_db
+def test_locked_repository_event_is_retried():
+    repository = RepositoryFactory(full_name="sleuth-io/sleuth-pr")
+    installation_id = repository.installation.remote_id
+    held = lock.try_acquire(f"{installation_id}:sleuth-iosleuth-pr")
+    try_acquire = lock.try_acquire
+
+    # the holder lets go of the lock once the event found it busy
+    def _busy_once(*args, **kwargs):
+        acquired = try_acquire(*args, **kwargs)
+        if acquired is None:
+            lock.release(held)
+        return acquired
+
+    with patch.object(lock, "try_acquire", side_effect=_busy_once) as acquire, patch.object(
+        tasks, "_process_repository_event"
+    ) as process:
+        tasks._dispatch_repository_event("push", None, {}, installation_id, "sleuth-io/sleuth-pr")
+
+    assert 2 == acquire.call_count
+    process.assert_called_once()
@@ -0,0 +1,62 @@
+from unittest.mock import patch
+
+import pytest
+
+from sleuthpr import partitions
+from sleuthpr.services.github import tasks
+from sleuthpr.services.scm import TransientOperationException
+from sleuthpr.tests.factories import RepositoryFactory
+
+
+def test_partition_for(settings):
+    settings.REPOSITORY_PARTITIONS = 8
+
+    assert partitions.partition_for("sleuth-io/sleuth-pr") == partitions.partition_for("sleuth-io/sleuth-pr")
+    assigned = {partitions.partition_for(f"org/repo-{index}") for index in range(200)}
+    assert set(range(8)) == assigned
+    assert [f"interactive-repository-{index}" for index in range(8)] == partitions.queue_names()
+
+
+def test_dispatch_repository_event(settings):
+    with patch.object(tasks, "process_repository_task") as task:
+        settings.REPOSITORY_PARTITIONS = 0
+        tasks._dispatch_repository_event("push", None, {}, "1", "sleuth-io/sleuth-pr")
+        task.apply_async.assert_called_once_with(
+            ("push", None, {}, "1", "sleuth-io/sleuth-pr"), dict(replayed=False), queue="interactive"
+        )
+        task.apply_async.reset_mock()
+
+        settings.REPOSITORY_PARTITIONS = 4
+        partition = partitions.partition_for("sleuth-io/sleuth-pr")
+        tasks._dispatch_repository_event("push", None, {}, "1", "sleuth-io/sleuth-pr")
+        task.apply_async.assert_called_once_with(
+            ("push", None, {}, "1", "sleuth-io/sleuth-pr"),
+            dict(partition=partition, replayed=False),
+            queue=f"interactive-repository-{partition}",
+        )
+
+
+@pytest.mark.django_db
+def test_transient_failure_holds_partition(settings, monkeypatch):
+    settings.REPOSITORY_PARTITIONS = 4
+    repository = RepositoryFactory(full_name="sleuth-io/sleuth-pr")
+    installation_id = repository.installation.remote_id
+    delays = []
+    monkeypatch.setattr(partitions, "_sleep", delays.append)
+    processed = []
+
+    def _process(event_name, action, *args):
+        processed.append(action)
+        if processed == ["first"]:
+            raise TransientOperationException("rate limited", 7)
+
+    with patch.object(tasks, "_process_repository_event", side_effect=_process), patch.object(
+        tasks.process_repository_task, "retry"
+    ) as retry:
+        tasks._dispatch_repository_event("pull_request", "first", {}, installation_id, "sleuth-io/sleuth-pr")
+        tasks._dispatch_repository_event("pull_request", "second", {}, installation_id, "sleuth-io/sleuth-pr")
+
+    # waited out in place rather than queued again behind the second event
+    retry.assert_not_called()
+    assert [7] == delays
+    assert ["first", "first", "second"] == processed
@@ -3,6 +3,7 @@ import pytest
 from sleuthpr.models import Repository
 from sleuthpr.services import pull_requests
 from sleuthpr.services.scm import Commit
+from sleuthpr.tests.factories import PullRequestFactory
 from sleuthpr.tests.factories import RepositoryCommitFactory
 from sleuthpr.tests.factories import RepositoryFactory
 
@@ -51,3 +52,71 @@ def test_sync_commits_with_priors():
     assert repo.commits.all().count() == 3
     assert repo.commits.filter(sha="sha2").first().message == "blah"
     assert repo.commit_tree.filter(child__sha="sha1", parent__sha="sha2").count() == 1
+
+
+@pytest.mark.django_db
+def test_sync_commits_fills_placeholders():
+    repo: Repository = RepositoryFactory()
+    pull_requests.add_commits(
+        repo,
+        [
+            Commit(
+                sha="sha1",
+                message="msg1",
+                parents=["sha2"],
+                author_name="Bob",
+                author_email="bob@example.com",
+                committer_name="Bob",
+                committer_email="bob@example.com",
+            )
+        ],
+    )
+    assert repo.commits.filter(sha="sha2").first().message is None
+
+    changed = pull_requests.add_commits(
+        repo,
+        [
+            Commit(
+                sha="sha2",
+                message="msg2",
+                parents=[],
+                author_name="Alice",
+                author_email="alice@example.com",
+                committer_name="Alice",
+                committer_email="alice@example.com",
+            )
+        ],
+    )
+    assert changed == {"sha2"}
+    sha2 = repo.commits.filter(sha="sha2").first()
+    assert sha2.message == "msg2"
+    assert sha2.author.email == "alice@example.com"
+
+
+def _commit(sha: str, parents) -> Commit:
+    return Commit(
+        sha=sha,
+        message=f"message {sha}",
+        parents=parents,
+        author_name="Bob",
+        author_email="bob@example.com",
+        committer_name="Bob",
+        committer_email="bob@example.com",
+    )
+
+
+@pytest.mark.django_db
+def test_set_commits_only_touches_changes(django_assert_max_num_queries):
+    repo: Repository = RepositoryFactory()
+    pr = PullRequestFactory(repository=repo)
+    pull_requests._set_commits(repo, pr, [_commit("sha1", []), _commit("sha2", ["sha1"])])
+    assert {"sha1", "sha2"} == {commit.sha for commit in pr.commits.all()}
+
+    # nothing changed, so only the pull request's commits are read
+    with django_assert_max_num_queries(1):
+        pull_requests._set_commits(repo, pr, [_commit("sha1", []), _commit("sha2", ["sha1"])])
+
+    # force pushed over sha2
+    pull_requests._set_commits(repo, pr, [_commit("sha1", []), _commit("sha3", ["sha1"])])
+    assert {"sha1", "sha3"} == {commit.sha for commit in pr.commits.all()}
+    assert repo.commits.get(sha="sha2").pull_request is None
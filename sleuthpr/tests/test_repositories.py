@@ -0,0 +1,86 @@
+from unittest.mock import patch
+
+import pytest
+import requests
+
+from sleuthpr import tasks
+from sleuthpr.models import RepositoryIdentifier
+from sleuthpr.services import repositories
+from sleuthpr.services.scm import TransientOperationException
+from sleuthpr.tests.factories import InstallationFactory
+from sleuthpr.tests.factories import RepositoryFactory
+
+
+@pytest.mark.django_db
+def test_set_repositories_only_onboards_changes():
+    installation = InstallationFactory()
+    removed = RepositoryFactory(installation=installation, full_name="org/removed")
+    kept = RepositoryFactory(installation=installation, full_name="org/kept", remote_id="1")
+    recreated = RepositoryFactory(installation=installation, full_name="org/recreated", remote_id="2")
+
+    with patch("sleuthpr.services.repositories.onboard_repository") as onboard_repository:
+        repositories.set_repositories(
+            installation,
+            [
+                RepositoryIdentifier(full_name="org/kept", remote_id="1"),
+                RepositoryIdentifier(full_name="org/recreated", remote_id="3"),
+                RepositoryIdentifier(full_name="org/added", remote_id="4"),
+            ],
+        )
+
+    assert ["org/added", "org/recreated"] == sorted(
+        call[0][1].full_name for call in onboard_repository.call_args_list
+    )
+    assert {"org/kept", "org/recreated", "org/added"} == {repo.full_name for repo in installation.repositories.all()}
+    assert installation.repositories.filter(id=kept.id).exists()
+    assert not installation.repositories.filter(id__in=[removed.id, recreated.id]).exists()
+
+    installation.refresh_from_db()
+    assert (2, 2, 0) == (
+        installation.onboarding_total,
+        installation.onboarding_completed,
+        installation.onboarding_failed,
+    )
+    assert installation.onboarded
+
+
+@pytest.mark.django_db
+def test_onboarding_failure_is_recorded():
+    installation = InstallationFactory()
+
+    with patch("sleuthpr.services.repositories.onboard_repository") as onboard_repository:
+        onboard_repository.side_effect = [ValueError("boom"), None]
+        repositories.add(
+            installation,
+            [RepositoryIdentifier(full_name="org/one"), RepositoryIdentifier(full_name="org/two")],
+        )
+
+    installation.refresh_from_db()
+    assert (2, 1, 1) == (
+        installation.onboarding_total,
+        installation.onboarding_completed,
+        installation.onboarding_failed,
+    )
+
+
+@pytest.mark.django_db
+def test_transient_onboarding_failure_is_retried():
+    installation = InstallationFactory()
+
+    with patch("sleuthpr.services.repositories.onboard_repository") as onboard_repository:
+        onboard_repository.side_effect = [TransientOperationException("rate limited", 60), None]
+        repositories.add(installation, [RepositoryIdentifier(full_name="org/one")])
+        assert 2 == onboard_repository.call_count
+
+        # until the attempts run out
+        onboard_repository.reset_mock()
+        onboard_repository.side_effect = requests.ConnectionError("unreachable")
+        repositories.add(installation, [RepositoryIdentifier(full_name="org/two")])
+        assert tasks.ONBOARDING_ATTEMPTS == onboard_repository.call_count
+
+    installation.refresh_from_db()
+    assert (2, 1, 1) == (
+        installation.onboarding_total,
+        installation.onboarding_completed,
+        installation.onboarding_failed,
+    )
@@ -1,7 +1,36 @@
+from unittest.mock import patch
+
 import pytest
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
+from sleuthpr import partitions
+from sleuthpr.models import ActionResult
+from sleuthpr.models import CheckStatus
+from sleuthpr.services import rule_sets
+from sleuthpr.services.rules import coalescing_stats
+from sleuthpr.services.rules import evaluate
+from sleuthpr.services.rules import evaluate_pending
 from sleuthpr.services.rules import refresh_from_data
+from sleuthpr.services.rules import replaying
+from sleuthpr.services.rules import reset_coalescing_stats
+from sleuthpr.tests.factories import PullRequestFactory
 from sleuthpr.tests.factories import RepositoryFactory
+from sleuthpr.triggers import PR_CREATED
+from sleuthpr.triggers import PR_UPDATED
+from sleuthpr.triggers import REVIEW_UPDATED
+from sleuthpr.triggers import STATUS_UPDATED
+
+
+@pytest.fixture(autouse=True)
+def clear_rule_sets():
+    # database ids are reused between tests, so snapshots can't outlive one
+    rule_sets.clear_cache()
+    cache.clear()
+    yield
+    rule_sets.clear_cache()
+    cache.clear()
 
 
 @pytest.mark.django_db
@@ -143,3 +172,244 @@ rules:
 
     assert 4 == len(rule.triggers.all())
     assert 3 == len(rule.conditions.all())
+
+
+@pytest.mark.django_db
+def test_evaluate_records_action_results():
+
+    data = """
+rules:
+  - label-everything:
+      triggers:
+        - pr_created
+        - review_updated
+      actions:
+        - add_pull_request_label: "one"
+        - add_pull_request_label: "two"
+"""
+    repository = RepositoryFactory()
+    refresh_from_data(repository, data)
+    pr = PullRequestFactory(repository=repository)
+    pr.source_sha = pr.commits.first().sha
+    pr.save()
+
+    with patch("sleuthpr.models.scm.get_client") as get_client:
+        get_client.return_value.add_check.return_value = "check-1"
+        evaluate(repository, PR_CREATED, {"pull_request": pr})
+        with replaying():
+            evaluate(repository, PR_CREATED, {"pull_request": pr})
+
+        # the replayed trigger doesn't repeat the successful actions
+        assert 2 == get_client.return_value.add_label.call_count
+        assert 1 == get_client.return_value.add_check.call_count
+
+        # nor send the check run again once it is unchanged
+        update_calls = get_client.return_value.update_check.call_count
+        with replaying():
+            evaluate(repository, PR_CREATED, {"pull_request": pr})
+        assert update_calls == get_client.return_value.update_check.call_count
+        assert 2 == get_client.return_value.add_label.call_count
+
+        # while a new event that merely looks the same runs them again
+        evaluate(repository, PR_CREATED, {"pull_request": pr})
+        assert 4 == get_client.return_value.add_label.call_count
+        evaluate(repository, REVIEW_UPDATED, {"pull_request": pr})
+        assert 6 == get_client.return_value.add_label.call_count
+
+    results = ActionResult.objects.filter(commit__sha=pr.source_sha).order_by("action__order")
+    assert [CheckStatus.SUCCESS, CheckStatus.SUCCESS] == [result.status for result in results]
+
+
+@pytest.mark.django_db
+def test_evaluate_saves_action_results_once():
+
+    data = """
+rules:
+  - label-one:
+      triggers:
+        - pr_created
+      actions:
+        - add_pull_request_label: "one"
+  - label-two:
+      triggers:
+        - pr_created
+      actions:
+        - add_pull_request_label: "two"
+"""
+    repository = RepositoryFactory()
+    refresh_from_data(repository, data)
+    pr = PullRequestFactory(repository=repository)
+    pr.source_sha = pr.commits.first().sha
+    pr.save()
+
+    with patch("sleuthpr.models.scm.get_client") as get_client, patch(
+        "sleuthpr.services.rules.ActionResult.objects.bulk_create", wraps=ActionResult.objects.bulk_create
+    ) as bulk_create:
+        get_client.return_value.add_check.return_value = "check-1"
+        evaluate(repository, PR_CREATED, {"pull_request": pr})
+
+    assert 1 == bulk_create.call_count
+    assert 2 == ActionResult.objects.filter(commit__sha=pr.source_sha, status=CheckStatus.SUCCESS).count()
+
+
+@pytest.mark.django_db
+def test_evaluate_coalesces_events(settings):
+
+    data = """
+rules:
+  - label-everything:
+      triggers:
+        - pr_updated
+        - status_updated
+      actions:
+        - add_pull_request_label: "one"
+"""
+    repository = RepositoryFactory()
+    refresh_from_data(repository, data)
+    pr = PullRequestFactory(repository=repository)
+    pr.source_sha = pr.commits.first().sha
+    pr.save()
+    reset_coalescing_stats()
+
+    with patch("sleuthpr.models.scm.get_client") as get_client, patch(
+        "sleuthpr.tasks.evaluate_pull_request_task.apply_async"
+    ) as apply_async:
+        get_client.return_value.add_check.return_value = "check-1"
+        evaluate(repository, PR_UPDATED, {"pull_request": pr})
+        with replaying():
+            evaluate(repository, STATUS_UPDATED, {"pull_request": pr})
+        evaluate(repository, STATUS_UPDATED, {"pull_request": pr})
+        # a trigger is only a replay if every event firing it was
+        assert not pr.pending_evaluations.filter(replayed=True).exists()
+        # no rule is triggered by a review
+        evaluate(repository, REVIEW_UPDATED, {"pull_request": pr})
+
+        assert 1 == apply_async.call_count
+        args, kwargs = apply_async.call_args
+        assert ((pr.id,), "interactive") == (args[0], kwargs["queue"])
+        assert 0 == get_client.return_value.add_label.call_count
+
+        evaluate_pending(pr)
+        assert 1 == get_client.return_value.add_label.call_count
+
+        # nothing left for a second scheduled run
+        evaluate_pending(pr)
+        assert 1 == get_client.return_value.add_label.call_count
+
+        # once the scheduled evaluation ran, the next trigger schedules another one in the repository's partition
+        settings.REPOSITORY_PARTITIONS = 4
+        evaluate_pending(pr, args[1]["scheduled"])
+        evaluate(repository, STATUS_UPDATED, {"pull_request": pr})
+        assert 2 == apply_async.call_count
+        partition = partitions.partition_for(repository.full_name)
+        assert partition == apply_async.call_args[0][1]["partition"]
+        assert partitions.queue_name(partition) == apply_async.call_args[1]["queue"]
+
+    stats = coalescing_stats()
+    assert (4, 1) == (stats.events, stats.evaluations)
+    assert 4 == stats.events_per_evaluation
+
+
+@pytest.mark.django_db
+def test_trigger_index():
+
+    data = """
+rules:
+  - first:
+      triggers:
+        - pr_updated
+        - pr_created
+      actions:
+        - update_pull_request_base
+  - second:
+      triggers:
+        - pr_updated
+      actions:
+        - update_pull_request_base
+"""
+    repository = RepositoryFactory()
+    first, second = refresh_from_data(repository, data)
+
+    index = rule_sets.get(repository).trigger_index
+    assert (first.id, second.id) == index["pr_updated"]
+    assert (first.id,) == index["pr_created"]
+    assert "pr_closed" not in index
+
+    (third,) = refresh_from_data(repository, data.split("  - second")[0].replace("first", "third"))
+    assert (third.id,) == rule_sets.get(repository).trigger_index["pr_updated"]
+
+
+@pytest.mark.django_db
+def test_refresh_keeps_unchanged_rules():
+
+    data = """
+rules:
+  - first:
+      triggers:
+        - pr_updated
+      actions:
+        - update_pull_request_base
+  - second:
+      conditions:
+        - "number_reviewers>3"
+      actions:
+        - add_pull_request_label: "lots-of-reviewers"
+"""
+    repository = RepositoryFactory()
+    first, second = refresh_from_data(repository, data)
+    assert [first.id, second.id] == [rule.id for rule in refresh_from_data(repository, data)]
+    condition_line_number = second.conditions.first().line_number
+
+    changed = data.replace("  - first:", "  - zero:\n      actions:\n        - update_pull_request_base\n  - first:")
+    zero, kept_first, kept_second = refresh_from_data(repository, changed)
+    assert first.id == kept_first.id
+    assert second.id == kept_second.id
+    assert 2 == kept_second.order
+    assert second.line_number + 3 == kept_second.line_number
+    assert condition_line_number + 3 == kept_second.conditions.first().line_number
+
+    (kept_zero,) = refresh_from_data(repository, changed.split("  - first:")[0])
+    assert zero.id == kept_zero.id
+    assert 1 == repository.rules.count()
+
+
+@pytest.mark.django_db
+def test_rule_set_snapshot():
+
+    data = """
+rules:
+  - label-big:
+      triggers:
+        - pr_created
+      conditions:
+        - "number_reviewers>3"
+      actions:
+        - add_pull_request_label: "big"
+"""
+    repository = RepositoryFactory()
+    (rule,) = refresh_from_data(repository, data)
+
+    rule_set = rule_sets.get(repository)
+    assert repository.rules_hash == rule_set.rules_hash
+    (compiled,) = rule_set.for_trigger("pr_created")
+    assert rule.id == compiled.id
+    assert "number_reviewers>3" == compiled.conditions[0].expression
+    assert {"value": "big"} == compiled.actions[0].parameters
+    assert [] == rule_set.for_trigger("pr_closed")
+
+    # a fresh process only finds the snapshot in the shared cache
+    rule_sets.clear_cache()
+    with CaptureQueriesContext(connection) as queries:
+        assert rule_set == rule_sets.get(repository)
+    assert 0 == len(queries)
+
+    pr = PullRequestFactory(repository=repository)
+    pr.source_sha = pr.commits.first().sha
+    pr.save()
+    with patch("sleuthpr.models.scm.get_client") as get_client:
+        get_client.return_value.add_check.return_value = "check-1"
+        with CaptureQueriesContext(connection) as queries:
+            evaluate(repository, PR_CREATED, {"pull_request": pr})
+
+    tables = ("sleuthpr_rule", "sleuthpr_condition", "sleuthpr_action", "sleuthpr_trigger")
+    assert not [query for query in queries if any(f'FROM "{table}"' in query["sql"] for table in tables)]
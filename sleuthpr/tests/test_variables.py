@@ -1,9 +1,14 @@
 import pytest
+from django.db import connection
+from django.db.models import prefetch_related_objects
+from django.test.utils import CaptureQueriesContext
 
 from sleuthpr.models import CheckStatus
 from sleuthpr.models import PullRequest
 from sleuthpr.models import ReviewState
 from sleuthpr.models import TriState
+from sleuthpr.services import rules
+from sleuthpr.services.expression import EvaluationContext
 from sleuthpr.services.expression import ParsedExpression
 from sleuthpr.tests.factories import PullRequestAssigneeFactory
 from sleuthpr.tests.factories import PullRequestFactory
@@ -91,3 +96,32 @@ def _get_pr() -> PullRequest:
     PullRequestLabelFactory(pull_request=pr, value="label1")
     PullRequestLabelFactory(pull_request=pr, value="label2")
     return pr
+
+
+@pytest.mark.django_db
+def test_prefetch_plan():
+    pr = _get_pr()
+    PullRequestStatusFactory(pull_request=pr, context="ci", state=CheckStatus.SUCCESS)
+    expressions = [
+        ParsedExpression(text)
+        for text in (
+            "number_reviewers=2",
+            f"reviewer='{pr.reviewers.first().user.username}'",
+            "review_pending=2",
+            "number_assignees=1",
+            "label='label1'",
+            "label!='blah'",
+            "status_success='ci'",
+            f"commit_author='{pr.commits.first().author.username}'",
+        )
+    ]
+    plan = rules.prefetch_plan(var for exp in expressions for var in exp.variables)
+    assert ["reviewers", "reviewers__user", "assignees", "labels", "statuses", "commits__author"] == plan
+
+    pr = PullRequest.objects.get(id=pr.id)
+    prefetch_related_objects([pr], *plan)
+    ctx = EvaluationContext(pull_request=pr)
+    with CaptureQueriesContext(connection) as queries:
+        for exp in expressions:
+            assert exp.evaluate(ctx)
+    assert 0 == len(queries)
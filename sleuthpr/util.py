@@ -1,7 +1,13 @@
 import logging
+from functools import wraps
 from typing import Any
+from typing import Callable
 from typing import Dict
+from typing import TypeVar
 
+from django.db import connection
+
+T = TypeVar("T")
 
 logger = logging.getLogger(__name__)
 
@@ -18,3 +24,16 @@ def dirty_set_all(target: Any, attributes: Dict[str, Any]) -> bool:
             dirty = True
 
     return dirty
+
+
+# For work run on a thread pool: the connection Django opens for the thread, e.g. to mint a token or share the rate
+# limit, is otherwise never closed
+def closing_connection(func: Callable[..., T]) -> Callable[..., T]:
+    @wraps(func)
+    def wrapper(*args, **kwargs) -> T:
+        try:
+            return func(*args, **kwargs)
+        finally:
+            connection.close()
+
+    return wrapper
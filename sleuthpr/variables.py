@@ -26,6 +26,7 @@ NUMBER_REVIEWERS = ConditionVariableType(
     type=int,
     default_triggers=[PR_CREATED, PR_UPDATED],
     evaluate=lambda context: len(context["pull_request"].reviewers.all()),
+    prefetch=["reviewers"],
 )
 
 REVIEWER = ConditionVariableType(
@@ -34,6 +35,7 @@ REVIEWER = ConditionVariableType(
     type=List[str],
     default_triggers=[PR_CREATED, PR_UPDATED],
     evaluate=lambda context: [reviewer.user.username for reviewer in context["pull_request"].reviewers.all()],
+    prefetch=["reviewers__user"],
 )
 
 NUMBER_ASSIGNEES = ConditionVariableType(
@@ -42,6 +44,7 @@ NUMBER_ASSIGNEES = ConditionVariableType(
     type=int,
     default_triggers=[PR_CREATED, PR_UPDATED],
     evaluate=lambda context: len(context["pull_request"].assignees.all()),
+    prefetch=["assignees"],
 )
 
 ASSIGNEE = ConditionVariableType(
@@ -50,6 +53,7 @@ ASSIGNEE = ConditionVariableType(
     type=List[str],
     default_triggers=[PR_CREATED, PR_UPDATED],
     evaluate=lambda context: [assignee.user.username for assignee in context["pull_request"].assignees.all()],
+    prefetch=["assignees__user"],
 )
 
 AUTHOR = ConditionVariableType(
@@ -58,7 +62,8 @@ AUTHOR = ConditionVariableType(
     type=List[str],
     default_triggers=[PR_CREATED, PR_UPDATED],
     evaluate=lambda context: [context["pull_request"].author.username]
-    + [c.author.username for c in context["pull_request"].commits if c.author],
+    + [c.author.username for c in context["pull_request"].commits.all() if c.author],
+    prefetch=["author", "commits__author"],
 )
 
 TITLE = ConditionVariableType(
@@ -83,6 +88,7 @@ PULL_REQUEST_AUTHOR = ConditionVariableType(
     type=str,
     default_triggers=[PR_CREATED, PR_UPDATED],
     evaluate=lambda context: context["pull_request"].author.username,
+    prefetch=["author"],
 )
 
 COMMIT_AUTHOR = ConditionVariableType(
@@ -90,7 +96,8 @@ COMMIT_AUTHOR = ConditionVariableType(
     label="Authors of commits in the pull request",
     type=List[str],
     default_triggers=[PR_CREATED, PR_UPDATED],
-    evaluate=lambda context: [c.author.username for c in context["pull_request"].commits if c.author],
+    evaluate=lambda context: [c.author.username for c in context["pull_request"].commits.all() if c.author],
+    prefetch=["commits__author"],
 )
 
 LABEL = ConditionVariableType(
@@ -99,6 +106,7 @@ LABEL = ConditionVariableType(
     type=List[str],
     default_triggers=[PR_CREATED, PR_UPDATED],
     evaluate=lambda context: [label.value for label in context["pull_request"].labels.all()],
+    prefetch=["labels"],
 )
 
 MERGEABLE = ConditionVariableType(
@@ -156,7 +164,8 @@ COMMIT_MESSAGE = ConditionVariableType(
     label="Commit messages",
     type=List[str],
     default_triggers=[PR_CREATED, PR_UPDATED],
-    evaluate=lambda context: [commit.message for commit in context["pull_request"].commits],
+    evaluate=lambda context: [commit.message for commit in context["pull_request"].commits.all()],
+    prefetch=["commits"],
 )
 
 
@@ -206,7 +215,8 @@ BEHIND = ConditionVariableType(
 
 
 def _get_context_list(context, status):
-    return [item.context for item in context["pull_request"].statuses.filter(state=status).all()]
+    # filtered in memory so the prefetched statuses are used
+    return [item.context for item in context["pull_request"].statuses.all() if item.state == status]
 
 
 STATUS_STATE_VARS = [
@@ -216,13 +226,15 @@ STATUS_STATE_VARS = [
         type=list,
         default_triggers=[STATUS_UPDATED],
         evaluate=partial(_get_context_list, status=status),  # noqa
+        prefetch=["statuses"],
     )
     for status, label in CheckStatus.choices
 ]
 
 
 def _get_username_list(context, status):
-    return [item.user.username for item in context["pull_request"].reviewers.filter(state=status).all()]
+    # filtered in memory so the prefetched reviewers are used
+    return [item.user.username for item in context["pull_request"].reviewers.all() if item.state == status]
 
 
 REVIEW_STATE_VARS = [
@@ -232,6 +244,7 @@ REVIEW_STATE_VARS = [
         type=list,
         default_triggers=[REVIEW_UPDATED],
         evaluate=partial(_get_username_list, status=status),  # noqa
+        prefetch=["reviewers__user"],
     )
     for status, label in ReviewState.choices
 ]